@@ -0,0 +1,11 @@
+################################################################################
+# Filename: __init__.py
+# Description: Installed as the video_processing_tools package, so the pipeline
+#              modules are imported as video_processing_tools.<module>. The scripts
+#              still run directly from notebooks/
+# Outputs: None
+# Author: Audrey Yin, ay2376@nyu.edu
+# Created On: 2022-07-26 10:20
+# Last Modified Date:
+# Last Modified By:
+################################################################################
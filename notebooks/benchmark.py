@@ -0,0 +1,392 @@
+################################################################################
+# Filename: benchmark.py
+# Description: Generates synthetic sessions (bonsai, arduino and video datafiles)
+#              and times every stage of ts_preprocessing and extract_frames
+#              across sweeps of animals, frames and trials
+# Outputs: benchmark_results.json
+# Author: Audrey Yin, ay2376@nyu.edu
+# Created On: 2022-07-14 09:40
+# Last Modified Date:
+# Last Modified By:
+################################################################################
+
+# import modules
+import pandas as pd
+import numpy as np
+import os
+import io
+import json
+import time
+import shutil
+import platform
+import tempfile
+import contextlib
+import subprocess
+import sys
+import cv2
+
+# relative imports when installed as the video_processing_tools package, flat ones when run from notebooks/
+if __package__:
+    from . import ts_preprocessing as tsp
+    from . import extract_frames as ef
+else:
+    import ts_preprocessing as tsp
+    import extract_frames as ef
+
+# where results are appended. One json record per stage and configuration
+resultsFp = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results.json')
+
+# sweeps. Every combination of animals, frames and trials is generated and timed
+sweepAnimals = [1, 4, 16]
+sweepFrames = [18000, 54000]
+sweepTrials = [10, 30]
+
+# synthetic session settings
+syntheticFps = 30.0
+syntheticDropRate = 0.001
+syntheticFrameSize = (32, 24)
+syntheticSeed = 0
+
+# number of times each stage is timed. The fastest run is kept
+repeats = 3
+
+# cold start budget (seconds) of each cli command, timed in a fresh interpreter
+coldStartBudget = {
+    'help': 0.2,
+    'validate': 1.5
+}
+
+# modules that must not be imported by `import cli`
+lazyModules = ('pandas', 'numpy', 'cv2', 'ts_preprocessing', 'extract_frames')
+
+def write_synthetic_session(
+    dir_fp: str,
+    animal_id: str,
+    n_frames: int,
+    n_trials: int,
+    fps: float = syntheticFps,
+    drop_rate: float = syntheticDropRate,
+    frame_size: tuple = syntheticFrameSize,
+    seed: int = syntheticSeed,
+    video: bool = True
+) -> list:
+    """ Write a synthetic bonsai csv, arduino csv and avi for one animal
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory receiving the datafiles
+    animal_id (str): six digit animal id
+    n_frames (int): frames recorded before drops
+    n_trials (int): trials in the arduino log, spread evenly after a 60 s acclimation
+    fps (float): nominal frame rate
+    drop_rate (float): probability that a frame is dropped
+    frame_size (tuple): (width, height) of the video
+    seed (int): random seed
+    video (bool): write the avi. Without it the avi is an empty placeholder
+
+    Returns
+    ----------
+    fp_list (list): bon_csv, ard_csv, vid_fp
+    """
+
+    rng = np.random.default_rng([seed, int(animal_id)])
+    basename = os.path.join(dir_fp, 'SYN_'+animal_id+'_')
+    offset = '-05:00'
+    t0 = np.datetime64('2022-02-15T10:00:00', 'ns')
+
+    # bonsai: one timestamp per frame with jitter, minus dropped frames
+    frame_ns = (np.arange(n_frames) * (1e9 / fps) + rng.normal(0, 5e5, n_frames)).astype(np.int64)
+    frame_ns = np.sort(frame_ns[rng.random(n_frames) >= drop_rate])
+    timestamps = np.datetime_as_string(t0 + frame_ns.astype('timedelta64[ns]'), unit='ns')
+    bon_csv = basename+'vid_ts_raw.csv'
+    with open(bon_csv, 'w') as f:
+        f.write('\n'.join(np.char.add(timestamps, offset)) + '\n')
+
+    # arduino: acclimation, then trials with a cs 1 s after the trial starts
+    duration_s = n_frames / fps
+    lines = [('SESSION > START', 0.0), ('ACCLIMATION > START', 1.0)]
+    trial_s = np.linspace(60.0, max(duration_s - 30.0, 61.0), n_trials)
+    cs_s = min(20.0, np.diff(trial_s).min() / 2) if n_trials > 1 else 20.0
+    for i, start in enumerate(trial_s, 1):
+        lines.append(('TRIAL NUMBER '+str(i)+' > START', start))
+        lines.append(('CS > ON', start + 1.0))
+        lines.append(('CS > OFF', start + 1.0 + cs_s))
+    lines.append(('SESSION > END', duration_s))
+    ard_ns = t0 + (np.array([second for _, second in lines]) * 1e9).astype('timedelta64[ns]')
+    ard_csv = basename+'ard_ts_raw.csv'
+    with open(ard_csv, 'w') as f:
+        for (log, _), timestamp in zip(lines, np.datetime_as_string(ard_ns, unit='ns')):
+            f.write(log+','+timestamp+offset+'\n')
+
+    # video: one small frame per logged timestamp, with a moving square
+    vid_fp = basename+'video.avi'
+    if video:
+        width, height = frame_size
+        writer = cv2.VideoWriter(vid_fp, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+        frame = np.zeros((height, width, 3), dtype=np.uint8)
+        for i in range(len(frame_ns)):
+            frame[:] = 0
+            x = i % max(width - 4, 1)
+            frame[height // 2 - 2:height // 2 + 2, x:x + 4] = 255
+            writer.write(frame)
+        writer.release()
+    else:
+        open(vid_fp, 'wb').close()
+
+    return [bon_csv, ard_csv, vid_fp]
+
+def generate_synthetic_experiment(
+    dir_fp: str,
+    n_animals: int,
+    n_frames: int,
+    n_trials: int,
+    **kwargs
+) -> dict:
+    """ Write synthetic datafiles for n_animals animals. See write_synthetic_session
+
+    Returns
+    ----------
+    fp_dict (dict): KEY = animal_id, VALUE = bon_csv, ard_csv, vid_fp
+    """
+
+    os.makedirs(dir_fp, exist_ok=True)
+    fp_dict = {}
+    for i in range(n_animals):
+        animal_id = str(100000 + i)
+        fp_dict[animal_id] = write_synthetic_session(dir_fp, animal_id, n_frames, n_trials, **kwargs)
+
+    return fp_dict
+
+def time_stage(
+    func,
+    *args,
+    repeat: int = repeats,
+    setup=None
+) -> tuple:
+    """ Time func(*args), keeping the fastest of repeat runs. Output printed by the
+    stage is discarded
+
+    Parameters
+    ----------
+    func (callable): stage to time
+    args: arguments of func
+    repeat (int): number of runs
+    setup (callable): Optional, called before every run and not timed
+
+    Returns
+    ----------
+    result: return value of the last run
+    seconds (float): fastest wall time
+    """
+
+    best = np.inf
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func(*args)
+            best = min(best, time.perf_counter() - start)
+
+    return result, best
+
+def _clear_outputs(
+    dir_fp: str
+):
+    """ Remove parse caches and sliced videos so every run starts cold
+    """
+
+    for entry in os.scandir(dir_fp):
+        if entry.name.endswith(('.cache.npy', '.cache.json')):
+            os.remove(entry.path)
+        elif entry.is_dir() and entry.name.endswith('_videos'):
+            shutil.rmtree(entry.path)
+
+def benchmark_configuration(
+    work_fp: str,
+    n_animals: int,
+    n_frames: int,
+    n_trials: int,
+    repeat: int = repeats
+) -> list:
+    """ Generate one synthetic experiment and time every pipeline stage on it
+
+    Parameters
+    ----------
+    work_fp (str): scratch directory. The experiment is written to a subdirectory
+    n_animals (int): animals in the experiment
+    n_frames (int): frames per animal
+    n_trials (int): trials per animal
+    repeat (int): runs per stage
+
+    Returns
+    ----------
+    records (list): one dict per stage with the configuration and wall time in seconds
+    """
+
+    dir_fp = os.path.join(work_fp, 'a'+str(n_animals)+'_f'+str(n_frames)+'_t'+str(n_trials))
+    has_ffmpeg = shutil.which('ffmpeg') is not None
+    generate_synthetic_experiment(dir_fp, n_animals, n_frames, n_trials)
+
+    timings = {}
+
+    # discovery
+    path_list, timings['get_datafiles'] = time_stage(tsp.get_datafiles, dir_fp, tsp.basenameExtensions, repeat=repeat)
+    fp_dict, timings['create_path_dict'] = time_stage(tsp.create_path_dict, path_list, repeat=repeat)
+    _, timings['discover_sessions'] = time_stage(tsp.discover_sessions, dir_fp, repeat=repeat)
+
+    # loading, cold (csv parsing) and from the parse cache
+    _, timings['load_csv'] = time_stage(tsp.load_csv, fp_dict, repeat=repeat,
+                                        setup=lambda: _clear_outputs(dir_fp))
+    session_dict, timings['load_csv_cached'] = time_stage(tsp.load_csv, fp_dict, repeat=repeat)
+
+    # extraction and alignment
+    df_cs, timings['extract_cs_timestamps'] = time_stage(tsp.extract_cs_timestamps, session_dict, repeat=repeat)
+    df_cs, timings['extract_acclimation_timestamps'] = time_stage(
+        tsp.extract_acclimation_timestamps, session_dict, df_cs, repeat=repeat)
+    df_cs, timings['align_cs_frames'] = time_stage(tsp.align_cs_frames, session_dict, df_cs, repeat=repeat)
+    df_framerate, timings['calculate_frame_rate'] = time_stage(tsp.calculate_frame_rate, session_dict, repeat=repeat)
+
+    # whole preprocessing, serial and across every core
+    _, timings['preprocess_animals_serial'] = time_stage(tsp.preprocess_animals, fp_dict, None, 1, repeat=repeat)
+    _, timings['preprocess_animals_parallel'] = time_stage(tsp.preprocess_animals, fp_dict, None, None, repeat=repeat)
+    _, timings['save_data'] = time_stage(tsp.save_data, dir_fp, df_cs.copy(), df_framerate, repeat=repeat)
+
+    # slicing and extraction
+    video_paths = ef.get_datafiles(dir_fp)
+    df_cs, df_framerate = ef.load_csv(dir_fp)
+    if has_ffmpeg:
+        for mode in ('trial', 'video'):
+            _, timings['slice_videos_'+mode] = time_stage(
+                ef.slice_videos, dir_fp, video_paths, df_cs, df_framerate, mode, repeat=repeat,
+                setup=lambda: _clear_outputs(dir_fp))
+    _, timings['extract_trial_frames'] = time_stage(ef.extract_trial_frames, dir_fp, video_paths, df_cs, 'npy',
+                                                    repeat=repeat, setup=lambda: _clear_outputs(dir_fp))
+
+    shutil.rmtree(dir_fp)
+
+    return [{
+        'stage': stage,
+        'n_animals': n_animals,
+        'n_frames': n_frames,
+        'n_trials': n_trials,
+        'seconds': seconds
+    } for stage, seconds in timings.items()]
+
+def benchmark_cold_start(
+    work_fp: str,
+    n_animals: int = 4,
+    repeat: int = repeats,
+    budget: dict = coldStartBudget
+) -> list:
+    """ Time the cli from a fresh interpreter, so imports are included, and warn when a
+    command is over its cold start budget or `import cli` loads a heavy module
+
+    Parameters
+    ----------
+    work_fp (str): scratch directory. A small experiment is written to a subdirectory
+    n_animals (int): animals in the experiment
+    repeat (int): runs per command. The fastest is kept
+    budget (dict): KEY = command, VALUE = seconds
+
+    Returns
+    ----------
+    records (list): one dict per command with the wall time in seconds
+    """
+
+    dir_fp = os.path.join(work_fp, 'cold_start')
+    generate_synthetic_experiment(dir_fp, n_animals, 1800, 10)
+    cli_fp = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+    commands = {
+        'help': [cli_fp, '--help'],
+        'validate': [cli_fp, 'validate', dir_fp]
+    }
+
+    loaded = subprocess.run([sys.executable, '-c', 'import sys, cli; print(*sorted(sys.modules))'],
+                            cwd=os.path.dirname(cli_fp), capture_output=True, text=True, check=True).stdout.split()
+    for module in set(lazyModules).intersection(loaded):
+        print('WARNING > import cli loads', module+'. Import it inside the subcommand instead.')
+
+    records = []
+    for command, argv in commands.items():
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable]+argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            best = min(best, time.perf_counter() - start)
+        if best > budget.get(command, np.inf):
+            print('WARNING > vpt', command, 'took', round(best, 3), 's, over its', budget[command], 's budget.')
+        records.append({'stage': 'cli_'+command, 'n_animals': n_animals, 'n_frames': 1800, 'n_trials': 10,
+                        'seconds': best})
+
+    shutil.rmtree(dir_fp)
+
+    return records
+
+def run_benchmarks(
+    animals: list = sweepAnimals,
+    frames: list = sweepFrames,
+    trials: list = sweepTrials,
+    results_fp: str = resultsFp,
+    repeat: int = repeats
+) -> pd.DataFrame:
+    """ Time every stage across the sweeps and append the results to results_fp
+
+    Parameters
+    ----------
+    animals (list): animals per experiment
+    frames (list): frames per animal
+    trials (list): trials per animal
+    results_fp (str): json file collecting every run. Each run is one entry with the
+        environment and its records
+    repeat (int): runs per stage
+
+    Returns
+    ----------
+    df_results (pd.DataFrame): records of this run
+    """
+
+    records = []
+    work_fp = tempfile.mkdtemp(prefix='vpt_benchmark_')
+    try:
+        for n_animals in animals:
+            for n_frames in frames:
+                for n_trials in trials:
+                    print('Benchmarking', n_animals, 'animals,', n_frames, 'frames,', n_trials, 'trials...')
+                    records.extend(benchmark_configuration(work_fp, n_animals, n_frames, n_trials, repeat))
+        print('Benchmarking cli cold start...')
+        records.extend(benchmark_cold_start(work_fp, repeat=repeat))
+    finally:
+        shutil.rmtree(work_fp, ignore_errors=True)
+
+    # append this run to the results file
+    run = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'ffmpeg': shutil.which('ffmpeg') is not None
+        },
+        'records': records
+    }
+    runs = []
+    if os.path.exists(results_fp):
+        with open(results_fp) as f:
+            runs = json.load(f)
+    runs.append(run)
+    with open(results_fp, 'w') as f:
+        json.dump(runs, f, indent=1)
+    print('Benchmark results saved at:', results_fp)
+
+    return pd.DataFrame(records)
+
+
+if __name__ == '__main__':
+    dfResults = run_benchmarks()
+    print(dfResults.pivot_table(index='stage', columns=['n_animals', 'n_frames', 'n_trials'],
+                                values='seconds').round(4).to_string())
@@ -0,0 +1,209 @@
+################################################################################
+# Filename: cli.py
+# Description: Command line entry point (vpt) for preprocessing, validation, frame
+#              rate checks, slicing and freezing scores. Paths and parallelism are
+#              arguments instead of the dirFp globals, and pandas, OpenCV and the
+#              pipeline modules are only imported by the subcommand that needs them
+# Outputs: the outputs of the subcommand
+# Author: Audrey Yin, ay2376@nyu.edu
+# Created On: 2022-07-26 10:20
+# Last Modified Date:
+# Last Modified By:
+################################################################################
+
+# import modules. Keep this list light: everything else is imported inside the subcommands
+import argparse
+import importlib
+import os
+import sys
+
+def _module(
+    name: str
+):
+    """ Pipeline module, from the video_processing_tools package when installed
+    """
+
+    return importlib.import_module('.'+name, __package__) if __package__ else importlib.import_module(name)
+
+def _add_common(
+    parser: argparse.ArgumentParser
+):
+    """ Arguments shared by every subcommand
+    """
+
+    parser.add_argument('dir', help='directory containing the datafiles')
+    parser.add_argument('--instrument', action='store_true',
+                        help='record stage timings, counters and peak memory in a run report')
+    parser.add_argument('--profile-stage', default=None, help='stage run under cProfile while instrumenting')
+
+def build_parser(
+) -> argparse.ArgumentParser:
+    """ Parser of every subcommand
+    """
+
+    parser = argparse.ArgumentParser(prog='vpt', description='Video processing tools for bonsai/arduino sessions')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    preprocess = subparsers.add_parser('preprocess', help='extract cs timestamps, frame indices and frame rates')
+    _add_common(preprocess)
+    preprocess.add_argument('--recursive', action='store_true', help='preprocess every session directory below dir')
+    preprocess.add_argument('--workers', type=int, default=None,
+                            help='animals preprocessed in parallel. Default every core, 1 runs serially')
+    preprocess.add_argument('--full', action='store_true', help='reprocess every animal, not only new or changed ones')
+    preprocess.add_argument('--policy', choices=['skip', 'fail', 'include-partial'], default='skip',
+                            help='what to do with animals that fail validation')
+    preprocess.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='output format')
+    preprocess.add_argument('--db', default=None, help='SQLite trial index to update')
+
+    validate = subparsers.add_parser('validate', help='check that every animal has complete datafiles')
+    _add_common(validate)
+    validate.add_argument('--workers', type=int, default=None, help='threads checking animals')
+    validate.add_argument('--tail-bytes', type=int, default=4096,
+                          help='bytes read from the end of each arduino csv')
+    validate.add_argument('--report', default=None, help='csv receiving the validation report')
+
+    framerate = subparsers.add_parser('framerate', help='frame rate, jitter, dropped frames and video frame counts')
+    _add_common(framerate)
+    framerate.add_argument('--output', default=None, help='csv receiving the frame rate table')
+
+    slice_ = subparsers.add_parser('slice', help='slice videos into trials with ffmpeg')
+    _add_common(slice_)
+    slice_.add_argument('--mode', choices=['trial', 'video', 'smart'], default='video', help='slicing mode')
+    slice_.add_argument('--jobs', type=int, default=4, help='ffmpeg processes run at the same time')
+    slice_.add_argument('--retries', type=int, default=1, help='times a failed ffmpeg job is retried')
+    slice_.add_argument('--full', action='store_true', help='slice every trial, even if its video is current')
+    slice_.add_argument('--db', default=None, help='SQLite trial index to update')
+
+    freeze = subparsers.add_parser('freeze', help='score freezing from filtered tracking coordinates')
+    _add_common(freeze)
+    freeze.add_argument('--threshold', type=float, default=20.0, help='speed (pixels per second) below which the animal is still')
+    freeze.add_argument('--min-frames', type=int, default=30, help='minimum length of a freezing bout')
+
+    return parser
+
+def run_preprocess(
+    args: argparse.Namespace
+) -> int:
+
+    tsp = _module('ts_preprocessing')
+
+    if args.recursive:
+        session_dict, _ = tsp.discover_sessions(args.dir)
+        dir_dict = tsp.group_sessions(session_dict)
+    else:
+        dir_dict = {args.dir: tsp.create_path_dict(tsp.get_datafiles(args.dir, tsp.basenameExtensions))}
+
+    for session_fp, fp_dict in dir_dict.items():
+        print()
+        print('Session', session_fp)
+        tsp.preprocess_session(session_fp, fp_dict, args.workers, not args.full, args.policy, args.format, args.db)
+
+    return 0
+
+def run_validate(
+    args: argparse.Namespace
+) -> int:
+
+    tsp = _module('ts_preprocessing')
+
+    fp_dict = tsp.create_path_dict(tsp.get_datafiles(args.dir, tsp.basenameExtensions))
+    df_validation = tsp.validate_datafiles(fp_dict, args.workers, args.tail_bytes)
+    tsp.check_datafile_complete(fp_dict, 'skip', df_validation=df_validation)
+    report = args.report or os.path.join(args.dir, 'validation_report.csv')
+    df_validation.to_csv(report)
+    print('Validation report saved at:', report)
+
+    # non-zero exit status if any animal failed, for schedulers
+    return int((df_validation['status'] != 'ok').any())
+
+def run_framerate(
+    args: argparse.Namespace
+) -> int:
+
+    tsp = _module('ts_preprocessing')
+
+    fp_dict = tsp.create_path_dict(tsp.get_datafiles(args.dir, tsp.basenameExtensions))
+    fp_dict = tsp.check_datafile_complete(fp_dict)
+    session_dict = tsp.load_csv(fp_dict)
+    df_framerate = tsp.check_video_frames(tsp.calculate_frame_rate(session_dict), fp_dict)
+
+    print(df_framerate[['animal_id', 'mean_framerate', 'std_framerate', 'n_frames', 'dropped_frames',
+                        'video_frames', 'frame_mismatch']].to_string(index=False))
+    if args.output:
+        df_framerate.to_csv(args.output)
+        print('Frame rate info saved at:', args.output)
+
+    return 0
+
+def run_slice(
+    args: argparse.Namespace
+) -> int:
+
+    ef = _module('extract_frames')
+    tsp = _module('ts_preprocessing')
+
+    video_paths = ef.get_datafiles(args.dir)
+    df_cs, df_framerate = ef.load_csv(args.dir)
+    manifest = None if args.full else tsp.load_manifest(args.dir)
+    df_report = ef.slice_videos(args.dir, video_paths, df_cs, df_framerate, args.mode, args.jobs, args.retries,
+                                manifest, args.db)
+    df_report.to_csv(os.path.join(args.dir, 'slice_report.csv'))
+    if manifest is not None:
+        tsp.save_manifest(args.dir, manifest)
+
+    return int(len(df_report) > 0 and (df_report['returncode'] != 0).any())
+
+def run_freeze(
+    args: argparse.Namespace
+) -> int:
+
+    freezing = _module('freezing')
+
+    coord_dict = freezing.get_datafiles(args.dir, freezing.basenameExtensions)
+    df_cs, df_framerate = freezing.load_csv(args.dir)
+    freezing_dict = freezing.detect_freezing(coord_dict, df_framerate, args.threshold, args.min_frames)
+    df_freezing = freezing.score_freezing(df_cs, freezing_dict)
+
+    fp = os.path.join(args.dir, 'freezing.csv')
+    df_freezing.to_csv(fp)
+    print('Freezing info saved at:', fp)
+
+    return 0
+
+def main(
+    argv: list = None
+) -> int:
+    """ Run a subcommand, e.g. vpt preprocess /data/EXP003 --recursive --workers 8
+
+    Returns
+    ----------
+    status (int): exit status. 1 if validation or slicing failed for any animal
+    """
+
+    args = build_parser().parse_args(argv)
+    args.dir = os.path.abspath(args.dir)
+    if not os.path.isdir(args.dir):
+        print('vpt: error:', args.dir, 'is not a directory', file=sys.stderr)
+        return 2
+
+    if args.instrument:
+        _module('instrumentation').enable(args.profile_stage, args.dir)
+
+    run = {
+        'preprocess': (run_preprocess, 'run_report.json'),
+        'validate': (run_validate, 'validate_run_report.json'),
+        'framerate': (run_framerate, 'framerate_run_report.json'),
+        'slice': (run_slice, 'slice_run_report.json'),
+        'freeze': (run_freeze, 'freeze_run_report.json')
+    }
+    subcommand, report = run[args.command]
+    status = subcommand(args)
+
+    if args.instrument:
+        _module('instrumentation').save_report(os.path.join(args.dir, report))
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
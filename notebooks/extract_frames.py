@@ -13,16 +13,60 @@ import pandas as pd
 import numpy as np
 import regex as re
 import os
-import glob
-import sys
-import csv
-import ffmpeg
-import cv2
-from os import listdir
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# relative imports when installed as the video_processing_tools package, flat ones when run from notebooks/
+if __package__:
+    from .ts_preprocessing import fingerprint_file, load_manifest, save_manifest, load_dataset
+    from .instrumentation import stage, count, enable, save_report
+    from .video_index import load_video_index, build_video_index, seek_point, frame_pts
+else:
+    from ts_preprocessing import fingerprint_file, load_manifest, save_manifest, load_dataset
+    from instrumentation import stage, count, enable, save_report
+    from video_index import load_video_index, build_video_index, seek_point, frame_pts
 
 # specify location of the datafiles
 dirFp = r'F:\LeDoux\EXP003\T01\SAC1'
 
+# number of ffmpeg processes run at the same time
+maxJobs = 4
+
+# number of times a failed ffmpeg job is retried
+maxRetries = 1
+
+# 'video' cuts every trial of a video in one ffmpeg pass over the source,
+# 'trial' runs one ffmpeg process (and one seek) per trial. Both snap the start to a keyframe.
+# 'smart' cuts frame-exact trials, re-encoding only the partial GOPs at both ends
+sliceMode = 'video'
+
+# encoder arguments used by 'smart' slicing, by source codec. Pieces are re-encoded with
+# the source codec so they can be concatenated with the stream-copied middle
+smartEncoders = {
+    'h264': ['-c:v', 'libx264', '-crf', '16', '-preset', 'veryfast'],
+    'hevc': ['-c:v', 'libx265', '-crf', '18', '-preset', 'veryfast'],
+    'mpeg4': ['-c:v', 'mpeg4', '-q:v', '2'],
+    'mjpeg': ['-c:v', 'mjpeg', '-q:v', '2']
+}
+
+# skip sliced videos that are already current (see manifest.json)
+incremental = True
+
+# Optional SQLite trial index recording every sliced video, see trial_index.py
+dbFp = None
+
+# analyze_trials reads trials from an ffmpeg pipe this many frames at a time, so memory
+# stays at a few frames per job. 'gray' or 'bgr24' frames are passed to the analyses
+pipeChunkFrames = 16
+pipeFormat = 'gray'
+
+# record stage timings, counters and peak memory, saved to slice_run_report.json in dirFp
+instrument = False
+
+# Optional stage run under cProfile while instrumenting, e.g. 'slice_videos'
+profileStage = None
+
 def get_datafiles(
     dir_fp: str,
     suffix = '.avi'
@@ -54,13 +98,15 @@ def get_datafiles(
     return video_paths
 
 def load_csv(
-    dir_fp: str
+    dir_fp: str,
+    animal_ids: list = None
 ):
-    """ Load csv files into dataframes and preprocess timestamps
+    """ Load the outputs of ts_preprocessing (csv or parquet) with typed columns
 
     Parameters
     ----------
     dir_fp (str): Absolute path to the directory containing datafiles
+    animal_ids (list): Optional animal_ids to load. Defaults to every animal
 
     Returns
     ----------
@@ -71,28 +117,162 @@ def load_csv(
     # Make sure path is valid
     assert os.path.isdir(dir_fp), "The path provided does not point to a directory."
 
-    # Pull data from csvs made in ts_preprocessing
-    df_cs = pd.read_csv(dirFp+'/cs_timestamps.csv', index_col = 0)
-    df_cs['animal_id'] = df_cs['animal_id'].astype(str).apply(lambda x: x.zfill(6))
-    df_cs['frame_start'] = pd.to_datetime(df_cs.frame_start).dt.time
-    df_cs['frame_end'] = pd.to_datetime(df_cs.frame_end).dt.time
-    df_framerate = pd.read_csv(dirFp+'/frame_rate.csv', index_col = 0)
-    df_framerate['animal_id'] = df_framerate['animal_id'].astype(str).apply(lambda x: x.zfill(6))
+    # Pull data made in ts_preprocessing. Only the columns needed here are read
+    df_cs = load_dataset(dir_fp, 'cs_timestamps', ['cs_id', 'vid_start', 'vid_end', 'idx_start', 'idx_end'],
+                         animal_ids)
+    df_framerate = load_dataset(dir_fp, 'frame_rate', ['mean_framerate', 'std_framerate'], animal_ids)
 
     return df_cs, df_framerate
 
-def slice_videos(
+def build_smart_cut(
+    filename: str,
+    file_out: str,
+    idx_start: int,
+    idx_end: int,
+    index: dict,
+    fps: float = None
+) -> dict:
+    """ Build the ffmpeg commands of a frame-exact cut of frames idx_start to idx_end
+    (inclusive). The GOPs fully inside the trial are stream copied. The partial GOPs
+    before the first and after the last keyframe of the trial are re-encoded, and the
+    pieces are joined with the concat demuxer:
+
+        idx_start ... k1 - 1 | k1 ... k2 - 1 | k2 ... idx_end
+          re-encoded head    | stream copy   | re-encoded tail
+
+    Intra-only videos are stream copied exactly. Trials without a keyframe inside,
+    or videos without a keyframe table, are re-encoded whole. AVIs store no
+    presentation timestamps, so sources with B-frames are not cut frame-exact
+
+    Parameters
+    ----------
+    filename (str): source video
+    file_out (str): sliced video
+    idx_start (int): first frame of the trial
+    idx_end (int): last frame of the trial
+    index (dict): video index, see video_index.load_video_index. None if the video
+        could not be probed
+    fps (float): frame rate used without an index
+
+    Returns
+    ----------
+    cut (dict): containing:
+        commands (list): ffmpeg argument lists, run in order
+        concat (dict): KEY = concat list written before the commands, VALUE = pieces
+        scratch (list): temporary files removed after the commands
+    """
+
+    ffmpeg_args = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error']
+    n_frames = idx_end - idx_start + 1
+
+    if index is None:
+        index = {'fps': fps, 'start_s': 0.0, 'codec': None, 'intra_only': False, 'keyframes': []}
+    encoder = smartEncoders.get(index['codec'], ['-c:v', 'mpeg4', '-q:v', '2'])
+
+    def copy(start, n, out):
+        # stream copies start at the last keyframe before the seek point. Seeking a quarter
+        # frame after the keyframe keeps pts rounding from landing on the previous one
+        seek = seek_point(index, start)[1] + 0.25 / index['fps']
+        return ffmpeg_args + ['-ss', '%.6f' % seek, '-i', filename,
+                              '-map', '0:v:0', '-frames:v', str(n), '-c', 'copy', out]
+
+    def encode(start, n, out):
+        # accurate input seek: frames ending before the seek point are decoded and dropped.
+        # Seeking a quarter frame late keeps pts rounding from keeping the previous frame
+        seek = frame_pts(index, start) + 0.25 / index['fps']
+        return ffmpeg_args + ['-ss', '%.6f' % seek, '-i', filename, '-map', '0:v:0',
+                              '-frames:v', str(n)] + encoder + [out]
+
+    if index['intra_only']:
+        return {'commands': [copy(idx_start, n_frames, file_out)], 'concat': {}, 'scratch': []}
+
+    # first and last keyframes bounding the stream-copied middle
+    keyframes = np.array([idx for idx, _ in index['keyframes']], dtype=np.int64)
+    inside = keyframes[(keyframes >= idx_start) & (keyframes <= idx_end + 1)]
+    if len(inside) < 2:
+        return {'commands': [encode(idx_start, n_frames, file_out)], 'concat': {}, 'scratch': []}
+    k1 = int(inside[0])
+    k2 = int(inside[-1])
+
+    base, ext = os.path.splitext(file_out)
+    commands = []
+    pieces = []
+    if idx_start < k1:
+        pieces.append(base+'.head'+ext)
+        commands.append(encode(idx_start, k1 - idx_start, pieces[-1]))
+    pieces.append(base+'.copy'+ext)
+    commands.append(copy(k1, k2 - k1, pieces[-1]))
+    if k2 <= idx_end:
+        pieces.append(base+'.tail'+ext)
+        commands.append(encode(k2, idx_end - k2 + 1, pieces[-1]))
+
+    concat_list = base+'.concat.txt'
+    commands.append(ffmpeg_args + ['-f', 'concat', '-safe', '0', '-i', concat_list, '-c', 'copy', file_out])
+
+    return {'commands': commands, 'concat': {concat_list: pieces}, 'scratch': pieces + [concat_list]}
+
+def build_slice_jobs(
     dir_fp: str,
     video_paths: list,
-    df_cs: pd.DataFrame
-):
-    """
+    df_cs: pd.DataFrame,
+    df_framerate: pd.DataFrame,
+    mode: str = sliceMode,
+    manifest: dict = None
+) -> list:
+    """ Build the ffmpeg jobs that slice videos into trials. Seek positions are taken
+    from the frame indices (idx_start, idx_end) and the video index (see
+    video_index.load_video_index): stream copies can only start on a keyframe, so
+    every slice starts at the keyframe at or before idx_start. Without an index the
+    bonsai frame rate is used
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    video_paths (list): List with all absolute paths for video datafiles
+    df_cs (pd.DataFrame): Info of animal id, trial id, timestamps, frame indices
+    df_framerate (pd.DataFrame): Info on video frame rate
+    mode (str): 'trial' builds one job per trial, each seeking into the source.
+        'video' builds one job per video: a single ffmpeg process reads the source
+        once and writes every trial as a separate mapped output. 'smart' builds one
+        frame-exact job per trial, see build_smart_cut
+    manifest (dict): Optional manifest, see ts_preprocessing.load_manifest. Sliced videos
+        written from the same source with the same arguments are skipped
+
+    Returns
+    ----------
+    jobs (list): List of dicts, one per trial or video, containing:
+        animal_id (str)
+        cs_id (str): cs_ids of the job, separated by ;
+        file_in (str): source video
+        outputs (list): sliced videos written by the job
+        records (list): manifest record of every output, see record_slice_jobs
+        commands (list): ffmpeg argument lists, run in order
+        concat (dict): concat lists written before the commands, see build_smart_cut
+        scratch (list): temporary files removed after the commands
     """
-    check = []
+
+    assert mode in ('trial', 'video', 'smart'), "mode must be 'trial', 'video' or 'smart'"
+
+    fps_dict = dict(zip(df_framerate['animal_id'], df_framerate['mean_framerate']))
+
+    # trials without frame indices (-1, e.g. a NaT cs time or an include-partial animal) have no clip
+    valid = (df_cs['idx_start'] >= 0) & (df_cs['idx_end'] >= df_cs['idx_start'])
+    for row in df_cs.loc[~valid].itertuples():
+        print('WARNING > No frames for', str(row.animal_id), row.cs_id+'. Not sliced.')
+
+    # group the trials by animal once, instead of scanning df_cs for every video
+    rows_dict = {str(key): rows for key, rows in df_cs.loc[valid].groupby('animal_id', observed=True, sort=False)}
+
+    jobs = []
     for filename in video_paths:
         # Find rows where video file id matches dataframe id
         id = re.search(r'_(\d{6})_', filename).group(0).lstrip('_').rstrip('_')
-        search_id = df_cs.loc[df_cs['animal_id'] == id]
+        search_id = rows_dict.get(id, df_cs.iloc[:0])
+        index = load_video_index(filename)
+        if index is None and id not in fps_dict:
+            print('WARNING > No frame rate for', id+'. Skipping', filename)
+            continue
+        fps = fps_dict.get(id)
 
         # Create new directory with to place new sliced videos
         final_dir = os.path.join(dir_fp, id+'_videos')
@@ -105,16 +285,715 @@ def slice_videos(
         else:
             print('Directory '+id+'_videos already exists.')
 
-        # slice videos and place in corresponding folder
-        for index, row in enumerate(search_id.itertuples(), 0):
-            file_in = filename
-            file_out = final_dir+'\\'+id+'_'+row[2].replace(' ', '_')+'.avi'
-            print(row[5])
-            print(row[6])
-            ffmpeg_command = 'ffmpeg -ss '+str(row[5])+' -to '+str(row[6])+' -i '+file_in+' -c copy '+file_out
-            os.system(ffmpeg_command)
+        # fingerprint the source once, reusing the manifest's hash if it did not change
+        source_hash = None
+        if manifest is not None:
+            rel = os.path.relpath(filename, dir_fp)
+            manifest['files'][rel] = fingerprint_file(filename, manifest['files'].get(rel))
+            source_hash = manifest['files'][rel]['hash']
+
+        # output arguments for every trial. Arguments are passed straight to ffmpeg, without a shell
+        cs_ids = []
+        outputs = []
+        segments = []
+        frames = []
+        records = []
+        for row in search_id.itertuples():
+            file_out = os.path.join(final_dir, id+'_'+row.cs_id.replace(' ', '_')+'.avi')
+            if mode == 'smart':
+                segment = ['-frames', str(int(row.idx_start)), str(int(row.idx_end))]
+            elif index is not None:
+                # -to is exclusive, so the trial ends at the pts of the frame after idx_end
+                segment = ['-ss', '%.6f' % seek_point(index, int(row.idx_start))[1],
+                           '-to', '%.6f' % frame_pts(index, int(row.idx_end) + 1)]
+            else:
+                segment = ['-ss', '%.6f' % (row.idx_start / fps), '-to', '%.6f' % ((row.idx_end + 1) / fps)]
+            record = {'source': source_hash, 'args': segment}
+
+            # skip sliced videos that are already current
+            if manifest is not None:
+                previous = manifest['clips'].get(os.path.relpath(file_out, dir_fp))
+                if (previous and previous['source'] == source_hash and previous['args'] == segment
+                        and os.path.exists(file_out) and os.path.getsize(file_out) == previous['size']):
+                    continue
+
+            cs_ids.append(row.cs_id)
+            outputs.append(file_out)
+            segments.append(segment)
+            frames.append((int(row.idx_start), int(row.idx_end)))
+            records.append(record)
+
+        ffmpeg_args = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error']
+        if mode == 'trial':
+            # one job per trial. -ss/-to before -i seeks in the source for every trial
+            for cs_id, file_out, segment, record in zip(cs_ids, outputs, segments, records):
+                jobs.append({
+                    'animal_id': id,
+                    'cs_id': cs_id,
+                    'file_in': filename,
+                    'outputs': [file_out],
+                    'records': [record],
+                    'commands': [ffmpeg_args + segment + ['-i', filename, '-c', 'copy', file_out]],
+                    'concat': {},
+                    'scratch': []
+                })
+        elif mode == 'smart':
+            # one job per trial, each with several ffmpeg commands
+            for cs_id, file_out, (start, end), record in zip(cs_ids, outputs, frames, records):
+                jobs.append({
+                    'animal_id': id,
+                    'cs_id': cs_id,
+                    'file_in': filename,
+                    'outputs': [file_out],
+                    'records': [record],
+                    **build_smart_cut(filename, file_out, start, end, index, fps)
+                })
+        elif outputs:
+            # one job per video. -ss/-to after -i apply to each output, so the source is read once
+            command = ffmpeg_args + ['-i', filename]
+            for file_out, segment in zip(outputs, segments):
+                command += ['-map', '0'] + segment + ['-c', 'copy', file_out]
+            jobs.append({
+                'animal_id': id,
+                'cs_id': ';'.join(cs_ids),
+                'file_in': filename,
+                'outputs': outputs,
+                'records': records,
+                'commands': [command],
+                'concat': {},
+                'scratch': []
+            })
+
+    return jobs
+
+def split_slice_job(
+    job: dict
+) -> list:
+    """ Split a 'video' job into one 'trial' job per output, so a failed trial does not
+    take down the other trials of its source
+
+    Parameters
+    ----------
+    job (dict): see build_slice_jobs
+
+    Returns
+    ----------
+    jobs (list): one job per output, with the same manifest records
+    """
+
+    ffmpeg_args = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error']
+    return [{
+        'animal_id': job['animal_id'],
+        'cs_id': cs_id,
+        'file_in': job['file_in'],
+        'outputs': [file_out],
+        'records': [record],
+        'commands': [ffmpeg_args + record['args'] + ['-i', job['file_in'], '-c', 'copy', file_out]],
+        'concat': {},
+        'scratch': []
+    } for cs_id, file_out, record in zip(job['cs_id'].split(';'), job['outputs'], job['records'])]
+
+def record_slice_jobs(
+    dir_fp: str,
+    jobs: list,
+    df_report: pd.DataFrame,
+    manifest: dict
+):
+    """ Record the outputs of successful jobs in the manifest, so later runs skip them
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    jobs (list): see build_slice_jobs
+    df_report (pd.DataFrame): see run_slice_jobs, in the same order as jobs
+    manifest (dict): see ts_preprocessing.load_manifest
+    """
+
+    for job, returncode in zip(jobs, df_report['returncode']):
+        if returncode != 0:
+            continue
+        for file_out, record in zip(job['outputs'], job['records']):
+            if os.path.exists(file_out):
+                manifest['clips'][os.path.relpath(file_out, dir_fp)] = {**record, 'size': os.path.getsize(file_out)}
+
+def _run_slice_job(
+    job: dict
+) -> dict:
+    """ Run the ffmpeg commands of a job in order, stopping at the first failure.
+    Concat lists are written first and scratch files are removed afterwards
+
+    Parameters
+    ----------
+    job (dict): see build_slice_jobs
+
+    Returns
+    ----------
+    result (dict): returncode, wall_time_s, output_bytes and error (stderr) of the job
+    """
+
+    start = time.perf_counter()
+    returncode = 0
+    error = ''
+    for concat_list, pieces in job.get('concat', {}).items():
+        with open(concat_list, 'w') as f:
+            for piece in pieces:
+                f.write("file '"+piece.replace("'", "'\\''")+"'\n")
+    try:
+        for args in job['commands']:
+            proc = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.PIPE)
+            returncode = proc.returncode
+            if returncode != 0:
+                error = proc.stderr.decode(errors='replace').strip()[-500:]
+                break
+    finally:
+        for file in job.get('scratch', []):
+            if os.path.exists(file):
+                os.remove(file)
+    wall_time = time.perf_counter() - start
+
+    output_bytes = sum(os.path.getsize(file) for file in job['outputs'] if os.path.exists(file))
+
+    return {'returncode': returncode, 'wall_time_s': wall_time,
+            'output_bytes': output_bytes, 'error': error}
+
+def run_slice_jobs(
+    jobs: list,
+    max_jobs: int = maxJobs,
+    max_retries: int = maxRetries
+) -> pd.DataFrame:
+    """ Run ffmpeg jobs with at most max_jobs running at the same time. Failed jobs
+    are retried up to max_retries times, without re-running jobs that succeeded
+
+    Parameters
+    ----------
+    jobs (list): see build_slice_jobs
+    max_jobs (int): number of ffmpeg processes run at the same time
+    max_retries (int): number of times a failed job is retried
+
+    Returns
+    ----------
+    df_report (pd.DataFrame): One row per job, containing columns:
+        animal_id (str)
+        cs_id (str): cs_ids of the job, separated by ;
+        outputs (str): sliced videos, separated by ;
+        returncode (int): ffmpeg exit status of the last attempt
+        attempts (int)
+        wall_time_s (float): wall time of the last attempt
+        output_bytes (int): total size of the outputs
+        error (str): end of ffmpeg's stderr if the job failed
+    """
+
+    results = [None] * len(jobs)
+    attempts = [0] * len(jobs)
+    pending = list(range(len(jobs)))
+
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        for attempt in range(max_retries + 1):
+            if not pending:
+                break
+            if attempt > 0:
+                print('Retrying', len(pending), 'failed jobs...')
+
+            for i, result in zip(pending, executor.map(_run_slice_job, [jobs[i] for i in pending])):
+                results[i] = result
+                attempts[i] += 1
+            pending = [i for i in pending if results[i]['returncode'] != 0]
+
+    df_report = pd.DataFrame([{
+        'animal_id': job['animal_id'],
+        'cs_id': job['cs_id'],
+        'outputs': ';'.join(job['outputs']),
+        'attempts': n,
+        **result
+    } for job, result, n in zip(jobs, results, attempts)])
+
+    return df_report
+
+@stage('slice_videos', message='Slicing videos')
+def slice_videos(
+    dir_fp: str,
+    video_paths: list,
+    df_cs: pd.DataFrame,
+    df_framerate: pd.DataFrame,
+    mode: str = sliceMode,
+    max_jobs: int = maxJobs,
+    max_retries: int = maxRetries,
+    manifest: dict = None,
+    db_path: str = dbFp
+) -> pd.DataFrame:
+    """ Slice every video into trials with ffmpeg. Places sliced videos in <id>_videos
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    video_paths (list): List with all absolute paths for video datafiles
+    df_cs (pd.DataFrame): Info of animal id, trial id, timestamps, frame indices
+    df_framerate (pd.DataFrame): Info on video frame rate
+    mode (str): 'trial', 'video' or 'smart'. See build_slice_jobs. 'video' jobs that
+        still fail after max_retries are split into 'trial' jobs, see split_slice_job
+    max_jobs (int): number of ffmpeg processes run at the same time
+    max_retries (int): number of times a failed job is retried
+    manifest (dict): Optional manifest. Current sliced videos are skipped and new ones
+        are recorded. See build_slice_jobs
+    db_path (str): Optional SQLite trial index receiving the sliced videos, see
+        trial_index.upsert_clips
+
+    Returns
+    ----------
+    df_report (pd.DataFrame): exit status, wall time and output size of every job. See run_slice_jobs
+    """
+
+    # probe videos without a current index in parallel, before the jobs read them
+    build_video_index(video_paths, max_jobs)
+
+    jobs = build_slice_jobs(dir_fp, video_paths, df_cs, df_framerate, mode, manifest)
+    df_report = run_slice_jobs(jobs, max_jobs, max_retries)
+
+    # a failed video job would lose every trial of its source. Run its trials one per job instead
+    failed = [i for i, returncode in enumerate(df_report.get('returncode', []))
+              if returncode != 0 and len(jobs[i]['outputs']) > 1]
+    if failed:
+        print('Splitting', len(failed), 'failed video jobs into trial jobs...')
+        split_jobs = [split for i in failed for split in split_slice_job(jobs[i])]
+        keep = [i for i in range(len(jobs)) if i not in set(failed)]
+        jobs = [jobs[i] for i in keep] + split_jobs
+        df_report = pd.concat([df_report.iloc[keep], run_slice_jobs(split_jobs, max_jobs, max_retries)],
+                              ignore_index=True)
+
+    if manifest is not None and len(df_report):
+        record_slice_jobs(dir_fp, jobs, df_report, manifest)
+    if db_path is not None and len(df_report):
+        if __package__:
+            from .trial_index import upsert_clips
+        else:
+            from trial_index import upsert_clips
+        upsert_clips(db_path, dir_fp, jobs, df_report, mode)
+
+    # jobs run in threads, so they are counted here from the report
+    for job, row in zip(jobs, df_report.itertuples()):
+        if row.returncode == 0:
+            count('clips_written', len(job['outputs']), animal_id=row.animal_id)
+            count('bytes_written', row.output_bytes, animal_id=row.animal_id)
+        count('ffmpeg_s', row.wall_time_s, animal_id=row.animal_id)
+
+    # print message to user
+    failed = df_report[df_report['returncode'] != 0] if len(df_report) else df_report
+    print(len(df_report) - len(failed), 'of', len(df_report), 'jobs succeeded.')
+    for row in failed.itertuples():
+        print('FAILED >', row.animal_id, row.cs_id+':', row.error)
+
+    return df_report
+
+def build_pipe_command(
+    filename: str,
+    idx_start: int,
+    idx_end: int,
+    index: dict,
+    pix_fmt: str = pipeFormat,
+    clip_out: str = None
+) -> list:
+    """ Build the ffmpeg command decoding frames idx_start to idx_end (inclusive) to
+    raw frames on stdout. The seek is frame-exact, see build_smart_cut
+
+    Parameters
+    ----------
+    filename (str): source video
+    idx_start (int): first frame of the trial
+    idx_end (int): last frame of the trial
+    index (dict): video index, see video_index.load_video_index
+    pix_fmt (str): 'gray' or 'bgr24'
+    clip_out (str): Optional clip written by the same ffmpeg process, re-encoded with
+        the source codec (see smartEncoders)
+
+    Returns
+    ----------
+    command (list): ffmpeg arguments
+    """
+
+    n_frames = str(idx_end - idx_start + 1)
+    seek = frame_pts(index, idx_start) + 0.25 / index['fps']
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-ss', '%.6f' % seek, '-i', filename]
+    if clip_out is not None:
+        encoder = smartEncoders.get(index['codec'], ['-c:v', 'mpeg4', '-q:v', '2'])
+        command += ['-y', '-map', '0:v:0', '-frames:v', n_frames] + encoder + [clip_out]
+
+    return command + ['-map', '0:v:0', '-frames:v', n_frames, '-f', 'rawvideo', '-pix_fmt', pix_fmt, 'pipe:1']
+
+def iter_pipe_frames(
+    command: list,
+    frame_shape: tuple,
+    chunk_frames: int = pipeChunkFrames
+):
+    """ Run an ffmpeg command writing raw frames to stdout and yield them in chunks.
+    Frames are read into one buffer, reused for every chunk, so nothing is copied
+
+    Parameters
+    ----------
+    command (list): ffmpeg arguments, see build_pipe_command
+    frame_shape (tuple): (height, width) for gray frames, (height, width, 3) for bgr24
+    chunk_frames (int): frames per chunk
+
+    Yields
+    ----------
+    frames (np.ndarray): uint8 view of shape (n, *frame_shape) over the buffer. Only
+        valid until the next chunk is read, copy it to keep it
+    """
+
+    frame_bytes = int(np.prod(frame_shape))
+    buffer = bytearray(chunk_frames * frame_bytes)
+    view = memoryview(buffer)
+
+    proc = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            # fill the buffer. A short read only happens at the end of the stream
+            filled = 0
+            while filled < len(buffer):
+                n = proc.stdout.readinto(view[filled:])
+                if not n:
+                    break
+                filled += n
+            n_frames = filled // frame_bytes
+            if n_frames:
+                yield np.frombuffer(buffer, dtype=np.uint8, count=n_frames * frame_bytes).reshape(
+                    (n_frames,) + tuple(frame_shape))
+            if filled < len(buffer):
+                break
+    finally:
+        proc.stdout.close()
+        error = proc.stderr.read().decode(errors='replace').strip()
+        proc.stderr.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, stderr=error[-500:])
+
+def _analyze_trial(
+    trial: dict,
+    analyses: list,
+    pix_fmt: str,
+    chunk_frames: int
+) -> dict:
+    """ Stream one trial through every analysis. See analyze_trials
+    """
+
+    index = trial['index']
+    frame_shape = (index['height'], index['width']) + ((3,) if pix_fmt == 'bgr24' else ())
+    command = build_pipe_command(trial['file_in'], trial['idx_start'], trial['idx_end'], index, pix_fmt,
+                                 trial['output'] or None)
+    running = [factory(trial['animal_id'], trial['cs_id'], trial['idx_start'], trial['idx_end'])
+               for factory in analyses]
+
+    start = time.perf_counter()
+    frames_read = 0
+    error = ''
+    try:
+        for frames in iter_pipe_frames(command, frame_shape, chunk_frames):
+            for analysis in running:
+                analysis.update(frames, trial['idx_start'] + frames_read)
+            frames_read += len(frames)
+    except subprocess.CalledProcessError as failure:
+        error = failure.stderr
+
+    result = {key: trial[key] for key in ('animal_id', 'cs_id', 'idx_start', 'idx_end', 'output')}
+    result.update({'frames_read': frames_read, 'wall_time_s': time.perf_counter() - start, 'error': error})
+    for analysis in running:
+        result.update(analysis.result())
+
+    return result
+
+@stage('analyze_trials', message='Analyzing trials')
+def analyze_trials(
+    dir_fp: str,
+    video_paths: list,
+    df_cs: pd.DataFrame,
+    analyses: list,
+    pix_fmt: str = pipeFormat,
+    clips: bool = False,
+    chunk_frames: int = pipeChunkFrames,
+    max_jobs: int = maxJobs
+) -> pd.DataFrame:
+    """ Feed the frames of every trial straight from ffmpeg to analysis callbacks,
+    without writing sliced videos first. ffmpeg decodes each trial to raw frames on a
+    pipe, which are read chunk_frames at a time into a reused buffer
+
+    An analysis is a factory called as factory(animal_id, cs_id, idx_start, idx_end) for
+    every trial. It returns an object with:
+        update(frames, frame_idx): called for every chunk. frames is a uint8 array of
+            shape (n, height, width) for gray or (n, height, width, 3) for bgr24, only
+            valid during the call. frame_idx is the video frame index of frames[0]
+        result(): dict of values added to the trial's row of the report
+    See motion_energy.TrialMotionEnergy
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    video_paths (list): List with all absolute paths for video datafiles
+    df_cs (pd.DataFrame): Info of animal id, trial id, timestamps, frame indices
+    analyses (list): analysis factories
+    pix_fmt (str): 'gray' or 'bgr24'
+    clips (bool): also write <id>_videos/<id>_<cs_id>.avi, from the same decode
+    chunk_frames (int): frames read from the pipe at a time
+    max_jobs (int): number of trials decoded at the same time
+
+    Returns
+    ----------
+    df_report (pd.DataFrame): One row per trial, containing columns:
+        animal_id (str)
+        cs_id (str)
+        idx_start (int)
+        idx_end (int)
+        output (str): clip written, empty without clips
+        frames_read (int): less than idx_end - idx_start + 1 if the video ends early
+        wall_time_s (float)
+        error (str): end of ffmpeg's stderr if decoding failed
+        and the values returned by every analysis
+    """
+
+    assert pix_fmt in ('gray', 'bgr24'), "pix_fmt must be 'gray' or 'bgr24'"
+
+    # frame-exact seeks need the frame rate and start time of every video
+    index_dict = build_video_index(video_paths, max_jobs)
+
+    trials = []
+    for filename in video_paths:
+        id = re.search(r'_(\d{6})_', filename).group(1)
+        index = index_dict[filename]
+        if index is None:
+            print('WARNING > Cannot probe', filename+'. Skipping.')
+            continue
+        final_dir = os.path.join(dir_fp, id+'_videos')
+        if clips:
+            os.makedirs(final_dir, exist_ok=True)
+
+        rows = df_cs.loc[(df_cs['animal_id'] == id) & (df_cs['idx_start'] >= 0)]
+        for row in rows.itertuples():
+            trials.append({
+                'animal_id': id,
+                'cs_id': row.cs_id,
+                'file_in': filename,
+                'index': index,
+                'idx_start': int(row.idx_start),
+                'idx_end': int(row.idx_end),
+                'output': os.path.join(final_dir, id+'_'+row.cs_id.replace(' ', '_')+'.avi') if clips else ''
+            })
+
+    # decoding runs in ffmpeg and reading from the pipe releases the GIL, so threads are enough
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        results = list(executor.map(lambda trial: _analyze_trial(trial, analyses, pix_fmt, chunk_frames), trials))
+
+    df_report = pd.DataFrame(results, columns=['animal_id', 'cs_id', 'idx_start', 'idx_end', 'output',
+                                               'frames_read', 'wall_time_s', 'error'] if not results else None)
+
+    for row in df_report.itertuples():
+        count('frames', row.frames_read, animal_id=row.animal_id)
+        count('ffmpeg_s', row.wall_time_s, animal_id=row.animal_id)
+        if row.output and os.path.exists(row.output):
+            count('clips_written', 1, animal_id=row.animal_id)
+            count('bytes_written', os.path.getsize(row.output), animal_id=row.animal_id)
+
+    # print message to user
+    failed = df_report[df_report['error'] != ''] if len(df_report) else df_report
+    print(len(df_report) - len(failed), 'of', len(df_report), 'trials analyzed.')
+    for row in failed.itertuples():
+        print('FAILED >', row.animal_id, row.cs_id+':', row.error)
+
+    return df_report
+
+def iter_frame_ranges(
+    video_path: str,
+    ranges: list
+):
+    """ Decode a video once, front to back, and yield the frames inside the given
+    index ranges. Frames outside every range are grabbed but never retrieved, and
+    decoding stops after the last frame needed, so there are no per-trial seeks
+
+    Parameters
+    ----------
+    video_path (str): Absolute path to the video
+    ranges (list): (idx_start, idx_end) pairs of frame indices, both inclusive.
+        Ranges may overlap
+
+    Yields
+    ----------
+    range_ids (list): positions in ranges of every range containing the frame
+    frame_idx (int): frame index in the video
+    frame (np.ndarray): BGR frame. Reused by OpenCV, copy it to keep it
+    """
+
+    if not ranges:
+        return
+
+    import cv2
+
+    # walk the ranges in order of their first frame
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+    last_frame = max(end for _, end in ranges)
+    next_range = 0
+    active = []
+
+    cap = cv2.VideoCapture(video_path)
+    assert cap.isOpened(), "Could not open video " + video_path
+    try:
+        frame_idx = 0
+        while frame_idx <= last_frame:
+            # update the ranges containing this frame
+            while next_range < len(order) and ranges[order[next_range]][0] <= frame_idx:
+                active.append(order[next_range])
+                next_range += 1
+            active = [i for i in active if ranges[i][1] >= frame_idx]
+
+            if not cap.grab():
+                break
+            if active:
+                ok, frame = cap.retrieve()
+                if not ok:
+                    break
+                yield sorted(active), frame_idx, frame
+            frame_idx += 1
+    finally:
+        cap.release()
+
+def _extract_video_frames(
+    filename: str,
+    rows: pd.DataFrame,
+    final_dir: str,
+    output: str
+) -> list:
+    """ Write every trial of one video to final_dir. See extract_trial_frames
+    """
+
+    import cv2
+
+    id = re.search(r'_(\d{6})_', filename).group(0).lstrip('_').rstrip('_')
+    ranges = [(int(start), int(end)) for start, end in zip(rows['idx_start'], rows['idx_end'])]
+
+    # pull video properties from the source so output videos match it
+    cap = cv2.VideoCapture(filename)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    fourcc = int(cap.get(cv2.CAP_PROP_FOURCC)) or cv2.VideoWriter_fourcc(*'MJPG')
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+
+    # open one sink per trial
+    outputs = []
+    sinks = []
+    for cs_id, (start, end) in zip(rows['cs_id'], ranges):
+        file_out = os.path.join(final_dir, id+'_'+cs_id.replace(' ', '_'))
+        if output == 'video':
+            file_out += '.avi'
+            sink = cv2.VideoWriter(file_out, fourcc, fps, (width, height))
+            if not sink.isOpened():
+                sink = cv2.VideoWriter(file_out, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+        else:
+            file_out += '.npy'
+            sink = np.lib.format.open_memmap(file_out, mode='w+', dtype=np.uint8,
+                                             shape=(end - start + 1, height, width, 3))
+        outputs.append(file_out)
+        sinks.append(sink)
+
+    # one decoder pass over the video feeds every trial
+    frames_written = [0] * len(ranges)
+    for range_ids, frame_idx, frame in iter_frame_ranges(filename, ranges):
+        for i in range_ids:
+            if output == 'video':
+                sinks[i].write(frame)
+            else:
+                sinks[i][frame_idx - ranges[i][0]] = frame
+            frames_written[i] += 1
+
+    for sink in sinks:
+        if output == 'video':
+            sink.release()
+        else:
+            sink.flush()
+
+    return [{
+        'animal_id': id,
+        'cs_id': cs_id,
+        'output': file_out,
+        'idx_start': start,
+        'idx_end': end,
+        'frames_written': n
+    } for cs_id, file_out, (start, end), n in zip(rows['cs_id'], outputs, ranges, frames_written)]
+
+@stage('extract_trial_frames', message='Extracting trial frames')
+def extract_trial_frames(
+    dir_fp: str,
+    video_paths: list,
+    df_cs: pd.DataFrame,
+    output: str = 'video',
+    max_jobs: int = maxJobs
+) -> pd.DataFrame:
+    """ Frame-accurate alternative to slice_videos. Reads frames idx_start to idx_end
+    (inclusive) of every trial with OpenCV, in a single decoder pass per video.
+    Places trials in <id>_videos
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    video_paths (list): List with all absolute paths for video datafiles
+    df_cs (pd.DataFrame): Info of animal id, trial id, timestamps, frame indices
+    output (str): 'video' writes <id>_<cs_id>.avi with the source codec (MJPG if
+        OpenCV cannot write it). 'npy' writes <id>_<cs_id>.npy uint8 arrays of shape
+        (frames, height, width, 3), which can be opened with np.load(mmap_mode='r')
+    max_jobs (int): number of videos decoded at the same time
+
+    Returns
+    ----------
+    df_report (pd.DataFrame): One row per trial, containing columns:
+        animal_id (str)
+        cs_id (str)
+        output (str): filepath of the extracted trial
+        idx_start (int)
+        idx_end (int)
+        frames_written (int): less than idx_end - idx_start + 1 if the video ends early
+    """
+
+    assert output in ('video', 'npy'), "output must be 'video' or 'npy'"
+
+    args = []
+    for filename in video_paths:
+        id = re.search(r'_(\d{6})_', filename).group(0).lstrip('_').rstrip('_')
+        rows = df_cs.loc[(df_cs['animal_id'] == id) & (df_cs['idx_start'] >= 0)]
+        if rows.empty:
+            continue
+
+        final_dir = os.path.join(dir_fp, id+'_videos')
+        os.makedirs(final_dir, exist_ok=True)
+        args.append((filename, rows, final_dir, output))
+
+    # OpenCV releases the GIL while decoding, so videos are decoded in threads
+    results = []
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        for result in executor.map(lambda a: _extract_video_frames(*a), args):
+            results.extend(result)
+
+    df_report = pd.DataFrame(results, columns=['animal_id', 'cs_id', 'output', 'idx_start',
+                                               'idx_end', 'frames_written'])
+
+    for row in df_report.itertuples():
+        count('clips_written', 1, animal_id=row.animal_id)
+        count('frames_written', row.frames_written, animal_id=row.animal_id)
+        count('bytes_written', os.path.getsize(row.output), animal_id=row.animal_id)
+
+    # print message to user
+    print(len(df_report), 'trials from', len(args), 'videos.')
+
+    return df_report
 
 if __name__ == '__main__':
+    if instrument:
+        enable(profileStage, dirFp)
+
     videoPathList = get_datafiles(dirFp)
     dfMaster, dfFrameRate = load_csv(dirFp)
-    slice_videos(dirFp, videoPathList, dfMaster)
+    manifest = load_manifest(dirFp) if incremental else None
+    dfReport = slice_videos(dirFp, videoPathList, dfMaster, dfFrameRate, manifest=manifest)
+    dfReport.to_csv(os.path.join(dirFp, 'slice_report.csv'))
+    if manifest is not None:
+        save_manifest(dirFp, manifest)
+
+    if instrument:
+        save_report(os.path.join(dirFp, 'slice_run_report.json'))
@@ -0,0 +1,294 @@
+################################################################################
+# Filename: frame_cache.py
+# Description: Decodes each trial's frame range once into a memory-mapped .npy
+#              file so repeated analyses read frames without re-decoding videos
+# Outputs: frame_cache/<id>_<cs_id>_<idx_start>-<idx_end>_<variant>.npy, frame_cache/index.json
+# Author: Audrey Yin, ay2376@nyu.edu
+# Created On: 2022-07-12 11:02
+# Last Modified Date:
+# Last Modified By:
+################################################################################
+
+# import modules
+import pandas as pd
+import numpy as np
+import regex as re
+import os
+import json
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+# relative imports when installed as the video_processing_tools package, flat ones when run from notebooks/
+if __package__:
+    from .extract_frames import iter_frame_ranges, maxJobs
+else:
+    from extract_frames import iter_frame_ranges, maxJobs
+
+# name of the cache directory created inside the datafile directory
+cacheDirname = 'frame_cache'
+
+# name of the metadata index inside the cache directory
+indexBasename = 'index.json'
+
+def _variant(
+    grayscale: bool,
+    scale: float
+) -> str:
+    """ Name of a decoding variant, e.g. 'bgr_s1' or 'gray_s0.5'
+    """
+
+    return ('gray' if grayscale else 'bgr')+'_s'+format(scale, 'g')
+
+def _cache_basename(
+    animal_id: str,
+    cs_id: str,
+    idx_start: int,
+    idx_end: int,
+    grayscale: bool,
+    scale: float
+) -> str:
+    """ Basename of a cached trial, keyed by animal_id, cs_id, frame range and variant
+    """
+
+    return (animal_id+'_'+cs_id.replace(' ', '_')+'_'+str(idx_start)+'-'+str(idx_end)
+            +'_'+_variant(grayscale, scale)+'.npy')
+
+def load_index(
+    cache_dir: str
+) -> dict:
+    """ Load the metadata index of a cache directory
+
+    Parameters
+    ----------
+    cache_dir (str): Absolute path to the cache directory
+
+    Returns
+    ----------
+    index (dict): KEY = cache basename, VALUE = dict with animal_id, cs_id, idx_start,
+        idx_end, grayscale, scale, shape, source, source_size, source_mtime
+    """
+
+    fp = os.path.join(cache_dir, indexBasename)
+    if not os.path.exists(fp):
+        return {}
+    with open(fp) as f:
+        return json.load(f)
+
+def _update_index(
+    cache_dir: str,
+    entries: dict
+):
+    """ Merge entries into the index. The index is replaced atomically, and lookups
+    fall back to the deterministic basenames if a concurrent writer drops an entry
+    """
+
+    index = load_index(cache_dir)
+    index.update(entries)
+    tmp = os.path.join(cache_dir, indexBasename+'.'+str(os.getpid())+'.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, os.path.join(cache_dir, indexBasename))
+
+def _is_current(
+    cache_dir: str,
+    basename: str,
+    entry: dict,
+    video_path: str
+) -> bool:
+    """ Check that a cached trial exists and was decoded from the current source
+    """
+
+    if entry is None or not os.path.exists(os.path.join(cache_dir, basename)):
+        return False
+    stat = os.stat(video_path)
+    return entry['source_size'] == stat.st_size and entry['source_mtime'] == stat.st_mtime
+
+def cache_trial_frames(
+    cache_dir: str,
+    video_path: str,
+    rows: pd.DataFrame,
+    grayscale: bool = False,
+    scale: float = 1.0
+) -> dict:
+    """ Decode the frame range of every trial in rows into the cache, in a single
+    decoder pass over the video. Trials that are already cached are skipped
+
+    Parameters
+    ----------
+    cache_dir (str): Absolute path to the cache directory
+    video_path (str): Absolute path to the source video
+    rows (pd.DataFrame): rows of df_cs for this video (animal_id, cs_id, idx_start, idx_end)
+    grayscale (bool): store single-channel frames
+    scale (float): resize factor applied to width and height
+
+    Returns
+    ----------
+    entries (dict): index entries of the trials decoded by this call
+    """
+
+    index = load_index(cache_dir)
+    stat = os.stat(video_path)
+
+    # find trials that still need decoding
+    todo = []
+    for row in rows.itertuples():
+        basename = _cache_basename(row.animal_id, row.cs_id, int(row.idx_start), int(row.idx_end),
+                                   grayscale, scale)
+        if not _is_current(cache_dir, basename, index.get(basename), video_path):
+            todo.append((basename, row.animal_id, row.cs_id, int(row.idx_start), int(row.idx_end)))
+    if not todo:
+        return {}
+
+    # output frame shape
+    cap = cv2.VideoCapture(video_path)
+    width = int(round(cap.get(cv2.CAP_PROP_FRAME_WIDTH) * scale))
+    height = int(round(cap.get(cv2.CAP_PROP_FRAME_HEIGHT) * scale))
+    cap.release()
+    frame_shape = (height, width) if grayscale else (height, width, 3)
+
+    # write to temporary files so readers never see a partial trial
+    tmp_paths = []
+    arrays = []
+    for basename, _, _, start, end in todo:
+        tmp = os.path.join(cache_dir, basename+'.'+str(os.getpid())+'.tmp')
+        tmp_paths.append(tmp)
+        arrays.append(np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8,
+                                                shape=(end - start + 1,) + frame_shape))
+
+    # decode once, convert each needed frame once, and copy it into every trial containing it
+    ranges = [(start, end) for _, _, _, start, end in todo]
+    for range_ids, frame_idx, frame in iter_frame_ranges(video_path, ranges):
+        if grayscale:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if scale != 1.0:
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        for i in range_ids:
+            arrays[i][frame_idx - ranges[i][0]] = frame
+
+    # close the memory maps before moving the files into place
+    for array in arrays:
+        array.flush()
+    del arrays, array
+
+    entries = {}
+    for (basename, animal_id, cs_id, start, end), tmp in zip(todo, tmp_paths):
+        os.replace(tmp, os.path.join(cache_dir, basename))
+        entries[basename] = {
+            'animal_id': animal_id,
+            'cs_id': cs_id,
+            'idx_start': start,
+            'idx_end': end,
+            'grayscale': grayscale,
+            'scale': scale,
+            'shape': [end - start + 1, *frame_shape],
+            'source': video_path,
+            'source_size': stat.st_size,
+            'source_mtime': stat.st_mtime
+        }
+
+    return entries
+
+def build_frame_cache(
+    dir_fp: str,
+    video_paths: list,
+    df_cs: pd.DataFrame,
+    grayscale: bool = False,
+    scale: float = 1.0,
+    cache_dir: str = None,
+    max_jobs: int = maxJobs
+) -> str:
+    """ Cache the frames of every trial in df_cs. See cache_trial_frames
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    video_paths (list): List with all absolute paths for video datafiles
+    df_cs (pd.DataFrame): Info of animal id, trial id, timestamps, frame indices
+    grayscale (bool): store single-channel frames
+    scale (float): resize factor applied to width and height
+    cache_dir (str): cache directory. Defaults to <dir_fp>/frame_cache
+    max_jobs (int): number of videos decoded at the same time
+
+    Returns
+    ----------
+    cache_dir (str): Absolute path to the cache directory
+    """
+
+    # print message to user
+    print()
+    print('Caching trial frames...')
+
+    if cache_dir is None:
+        cache_dir = os.path.join(dir_fp, cacheDirname)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    args = []
+    for filename in video_paths:
+        id = re.search(r'_(\d{6})_', filename).group(0).lstrip('_').rstrip('_')
+        rows = df_cs.loc[(df_cs['animal_id'] == id) & (df_cs['idx_start'] >= 0)]
+        if not rows.empty:
+            args.append((cache_dir, filename, rows, grayscale, scale))
+
+    # OpenCV releases the GIL while decoding, so videos are decoded in threads
+    entries = {}
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        for result in executor.map(lambda a: cache_trial_frames(*a), args):
+            entries.update(result)
+    _update_index(cache_dir, entries)
+
+    # print message to user
+    print('Caching trial frames done.', len(entries), 'trials decoded.')
+
+    return cache_dir
+
+def load_trial_frames(
+    cache_dir: str,
+    animal_id: str,
+    cs_id: str,
+    grayscale: bool = False,
+    scale: float = 1.0,
+    frames: tuple = None
+) -> np.ndarray:
+    """ Open a cached trial as a read-only memory map. No frames are decoded or copied
+
+    Parameters
+    ----------
+    cache_dir (str): Absolute path to the cache directory
+    animal_id (str)
+    cs_id (str): TRIAL 01, TRIAL 02, etc
+    grayscale (bool): variant to open, see cache_trial_frames
+    scale (float): variant to open, see cache_trial_frames
+    frames (tuple): Optional (start, end) video frame indices, both inclusive. Returns a
+        view of only those frames
+
+    Returns
+    ----------
+    trial_frames (np.ndarray): uint8 array of shape (frames, height, width[, 3])
+    """
+
+    variant = _variant(grayscale, scale)
+    index = load_index(cache_dir)
+    matches = [(basename, entry) for basename, entry in index.items()
+               if entry['animal_id'] == animal_id and entry['cs_id'] == cs_id
+               and _variant(entry['grayscale'], entry['scale']) == variant]
+
+    # fall back to the cache basenames if the index misses the trial
+    if not matches:
+        prefix = animal_id+'_'+cs_id.replace(' ', '_')+'_'
+        pattern = re.compile(re.escape(prefix)+r'(\d+)-(\d+)_'+re.escape(variant)+r'\.npy$')
+        for basename in os.listdir(cache_dir):
+            match = pattern.match(basename)
+            if match:
+                matches.append((basename, {'idx_start': int(match.group(1)), 'idx_end': int(match.group(2))}))
+    if not matches:
+        raise KeyError('No cached frames for '+animal_id+' '+cs_id+' ('+variant+') in '+cache_dir)
+
+    basename, entry = matches[0]
+    trial_frames = np.load(os.path.join(cache_dir, basename), mmap_mode='r')
+
+    if frames is not None:
+        start, end = frames
+        assert entry['idx_start'] <= start <= end <= entry['idx_end'], "frames are outside of the cached trial"
+        trial_frames = trial_frames[start - entry['idx_start']:end - entry['idx_start'] + 1]
+
+    return trial_frames
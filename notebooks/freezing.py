@@ -1,20 +1,25 @@
 ################################################################################
 # Filename: freezing.py
-# Description:
-# Outputs:
+# Description: Detects freezing bouts from filtered tracking coordinates and scores
+#              percent freezing for every acclimation and trial window
+# Outputs: freezing.csv
 # Author: Audrey Yin, ay2376@nyu.edu
 # Created On: 2022-07-07 15:01
 # Last Modified Date:
 # Last Modified By: Audrey Yin
 ################################################################################
 
-import modules
+#import modules
 import pandas as pd
 import numpy as np
 import regex as re
 import os # can also us os.system to call for ffmpeg
-import sys
-import csv
+
+# relative imports when installed as the video_processing_tools package, flat ones when run from notebooks/
+if __package__:
+    from .extract_frames import load_csv
+else:
+    from extract_frames import load_csv
 
 # specify location of the datafiles
 dirFp = r'/Users/audreyyin/Documents/LeDoux/Sample Data'
@@ -24,3 +29,264 @@ basenameExtensions = {
     'aoi': 'cs_timestamps.csv',
     'raw_coord': 'el_filtered.csv'
 }
+
+# bodypart coordinates with a likelihood below pCutoff are ignored
+pCutoff = 0.9
+
+# animal is considered still below freezeThreshold (pixels per second)...
+freezeThreshold = 20.0
+
+# ...for at least minFreezeFrames consecutive frames
+minFreezeFrames = 30
+
+def get_datafiles(
+    dir_fp: str,
+    basename_extensions: dict
+) -> dict:
+    """ Returns abs filepath for the tracking coordinates of every animal in a directory
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    basename_extensions (dict): basename identifies as keys and extensions as values
+        MUST CONTAIN the key: raw_coord
+
+    Returns
+    ----------
+    coord_dict (dict): KEY = animal_id, VALUE = abs filepath of the coordinates csv
+    """
+
+    # Make sure path is valid
+    assert os.path.isdir(dir_fp), "The path provided does not point to a directory."
+
+    # Check contents of the directory
+    dirname, _, basename_list = next(os.walk(dir_fp))
+
+    coord_dict = {}
+    for basename in basename_list:
+        animal_id = re.search(r'_(\d{6})_', basename)
+        if basename.endswith(basename_extensions.get('raw_coord')) and animal_id:
+            coord_dict[animal_id.group(1)] = os.path.abspath(os.path.join(dirname, basename))
+
+    return coord_dict
+
+def load_tracks(
+    coord_csv: str,
+    bodyparts: list = None,
+    p_cutoff: float = pCutoff
+) -> np.ndarray:
+    """ Load filtered tracking coordinates (DeepLabCut csv layout) as a centroid track
+
+    The header rows (scorer, [individuals,] bodyparts, coords) are read separately so
+    the data itself is parsed by the C engine straight into a float array. Coordinates
+    below p_cutoff are interpolated along each bodypart's own track, then the centroid
+    is the mean of every bodypart. Averaging only the bodyparts above p_cutoff in each
+    frame would make the centroid jump whenever that set changes
+
+    Parameters
+    ----------
+    coord_csv (str): filepath for the coordinates csv
+    bodyparts (list): bodyparts used for the centroid. Defaults to every bodypart
+    p_cutoff (float): minimum likelihood of a coordinate
+
+    Returns
+    ----------
+    xy (np.ndarray): float64 array of shape (frames, 2)
+    """
+
+    # read the header rows. The last one holds x, y, likelihood for every column
+    header = []
+    with open(coord_csv) as f:
+        for line in f:
+            row = line.rstrip('\r\n').split(',')
+            header.append(row)
+            if row[0] == 'coords':
+                break
+    bodypart_row = [row for row in header if row[0] == 'bodyparts'][0]
+    coords_row = header[-1]
+
+    data = pd.read_csv(coord_csv, skiprows=len(header), header=None, dtype=np.float64,
+                       engine='c').to_numpy()
+
+    # pick the x, y and likelihood columns of the requested bodyparts
+    keep = np.array([bodyparts is None or part in bodyparts for part in bodypart_row])
+    coords = np.array(coords_row)
+    x = data[:, keep & (coords == 'x')]
+    y = data[:, keep & (coords == 'y')]
+    likelihood = data[:, keep & (coords == 'likelihood')]
+
+    # interpolate unreliable coordinates of every bodypart from its reliable frames.
+    # Bodyparts that are never reliable are left out of the centroid
+    reliable = likelihood >= p_cutoff
+    frames = np.arange(len(data))
+    x_list = []
+    y_list = []
+    for i in np.flatnonzero(reliable.any(axis=0)):
+        valid = reliable[:, i]
+        x_list.append(np.interp(frames, frames[valid], x[valid, i]))
+        y_list.append(np.interp(frames, frames[valid], y[valid, i]))
+    if not x_list:
+        return np.full((len(data), 2), np.nan)
+
+    return np.column_stack([np.mean(x_list, axis=0), np.mean(y_list, axis=0)])
+
+def compute_speed(
+    xy: np.ndarray,
+    fps: float
+) -> np.ndarray:
+    """ Per-frame speed of a track
+
+    Parameters
+    ----------
+    xy (np.ndarray): array of shape (frames, 2)
+    fps (float): video frame rate
+
+    Returns
+    ----------
+    speed (np.ndarray): pixels per second, one value per frame. The first frame gets
+        the speed of the second
+    """
+
+    step = np.hypot(np.diff(xy[:, 0]), np.diff(xy[:, 1])) * fps
+    if len(step) == 0:
+        return np.zeros(len(xy))
+
+    return np.concatenate([step[:1], step])
+
+def find_freezing_bouts(
+    speed: np.ndarray,
+    threshold: float = freezeThreshold,
+    min_frames: int = minFreezeFrames
+) -> tuple:
+    """ Find runs of frames below threshold lasting at least min_frames, using
+    run-length encoding of the below-threshold mask
+
+    Parameters
+    ----------
+    speed (np.ndarray): per-frame speed, see compute_speed
+    threshold (float): speed below which the animal is still
+    min_frames (int): minimum length of a bout
+
+    Returns
+    ----------
+    bout_start (np.ndarray): first frame of every bout
+    bout_end (np.ndarray): frame after the last frame of every bout
+    freezing (np.ndarray): bool per frame, True inside a bout
+    """
+
+    # run boundaries are where the padded mask changes
+    still = np.concatenate([[0], (speed < threshold).view(np.int8), [0]])
+    change = np.diff(still)
+    run_start = np.flatnonzero(change == 1)
+    run_end = np.flatnonzero(change == -1)
+
+    # keep runs long enough to be a bout
+    long_enough = (run_end - run_start) >= min_frames
+    bout_start = run_start[long_enough]
+    bout_end = run_end[long_enough]
+
+    # paint the bouts back onto the frames
+    marks = np.zeros(len(speed) + 1, dtype=np.int32)
+    marks[bout_start] += 1
+    marks[bout_end] -= 1
+    freezing = np.cumsum(marks[:-1]) > 0
+
+    return bout_start, bout_end, freezing
+
+def score_freezing(
+    df_cs: pd.DataFrame,
+    freezing_dict: dict
+) -> pd.DataFrame:
+    """ Percent freezing inside every acclimation and trial window
+
+    Parameters
+    ----------
+    df_cs (pd.DataFrame): Info of animal id, trial id, timestamps, frame indices
+    freezing_dict (dict): KEY = animal_id, VALUE = (bout_start, bout_end, freezing),
+        see find_freezing_bouts
+
+    Returns
+    ----------
+    df_freezing (pd.DataFrame): Dataframe containing columns:
+        animal_id (str)
+        cs_id (str)
+        idx_start (int)
+        idx_end (int)
+        freezing_frames (int): frames between idx_start and idx_end (inclusive) inside a bout
+        percent_freezing (float): freezing_frames over the tracked frames of the window
+        n_bouts (int): bouts starting inside the window
+    """
+
+    df_list = []
+    for key, (bout_start, _, freezing) in freezing_dict.items():
+        rows = df_cs.loc[(df_cs['animal_id'] == key) & (df_cs['idx_start'] >= 0),
+                         ['animal_id', 'cs_id', 'idx_start', 'idx_end']].copy()
+        # clip windows to the tracked frames
+        start = np.minimum(rows['idx_start'].to_numpy(dtype=np.int64), len(freezing))
+        stop = np.clip(rows['idx_end'].to_numpy(dtype=np.int64) + 1, start, len(freezing))
+
+        # frozen frames in every window from one cumulative sum
+        frozen = np.concatenate([[0], np.cumsum(freezing)])
+        rows['freezing_frames'] = frozen[stop] - frozen[start]
+        rows['percent_freezing'] = 100 * rows['freezing_frames'] / np.maximum(stop - start, 1)
+        rows['n_bouts'] = np.searchsorted(bout_start, stop) - np.searchsorted(bout_start, start)
+        df_list.append(rows)
+
+    df_freezing = pd.concat(df_list, ignore_index=True) if df_list else pd.DataFrame(
+        columns=['animal_id', 'cs_id', 'idx_start', 'idx_end', 'freezing_frames', 'percent_freezing', 'n_bouts'])
+
+    return df_freezing
+
+def detect_freezing(
+    coord_dict: dict,
+    df_framerate: pd.DataFrame,
+    threshold: float = freezeThreshold,
+    min_frames: int = minFreezeFrames
+) -> dict:
+    """ Load the track of every animal and find its freezing bouts
+
+    Parameters
+    ----------
+    coord_dict (dict): KEY = animal_id, VALUE = abs filepath of the coordinates csv
+    df_framerate (pd.DataFrame): Info on video frame rate
+    threshold (float): speed (pixels per second) below which the animal is still
+    min_frames (int): minimum length of a bout
+
+    Returns
+    ----------
+    freezing_dict (dict): KEY = animal_id, VALUE = (bout_start, bout_end, freezing)
+    """
+
+    # print message to user
+    print()
+    print('Detecting freezing bouts...')
+
+    fps_dict = dict(zip(df_framerate['animal_id'], df_framerate['mean_framerate']))
+
+    freezing_dict = {}
+    for key, coord_csv in coord_dict.items():
+        if key not in fps_dict:
+            print('WARNING > No frame rate for', key+'. Skipping', coord_csv)
+            continue
+        speed = compute_speed(load_tracks(coord_csv), fps_dict[key])
+        freezing_dict[key] = find_freezing_bouts(speed, threshold, min_frames)
+
+    # print message to user
+    print('Detecting freezing bouts done.')
+
+    return freezing_dict
+
+
+if __name__ == '__main__':
+    # Grab tracking data and trial windows
+    coordDict = get_datafiles(dirFp, basenameExtensions)
+    dfMaster, dfFrameRate = load_csv(dirFp)
+
+    # Detect and score freezing
+    freezingDict = detect_freezing(coordDict, dfFrameRate)
+    dfFreezing = score_freezing(dfMaster, freezingDict)
+
+    # Save data
+    freezing = os.path.join(dirFp, 'freezing.csv')
+    dfFreezing.to_csv(freezing)
+    print('Freezing info saved at:', freezing)
@@ -0,0 +1,392 @@
+################################################################################
+# Filename: instrumentation.py
+# Description: Stage and animal scoped timers, counters and peak memory for the
+#              preprocessing and slicing scripts, with optional cProfile capture
+#              of one stage. Reports are saved as json with a readable summary
+# Outputs: run_report.json, <profile_dir>/<stage>.<pid>.prof
+# Author: Audrey Yin, ay2376@nyu.edu
+# Created On: 2022-07-15 10:12
+# Last Modified Date:
+# Last Modified By:
+################################################################################
+
+# import modules
+import os
+import sys
+import json
+import time
+import cProfile
+import contextlib
+import threading
+
+# resource only exists on unix. Peak memory is not reported elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# state of this process. Stages and counters are only recorded while enabled. Each thread
+# has its own stack of open stages. Records are shared and only updated while holding lock
+_state = {
+    'enabled': False,
+    'started': None,
+    'profile_stage': None,
+    'profile_dir': None,
+    'profiler': None,
+    'records': {},
+    'stack': threading.local(),
+    'lock': threading.Lock(),
+    'worker_peak_rss_mb': 0.0
+}
+
+def peak_rss_mb(
+) -> float:
+    """ Peak resident memory of this process in MiB, or nan if unavailable
+    """
+
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB on linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def enable(
+    profile_stage: str = None,
+    profile_dir: str = None
+):
+    """ Start recording. Previous records are cleared
+
+    Parameters
+    ----------
+    profile_stage (str): Optional stage to run under cProfile, e.g. 'align_cs_frames'
+    profile_dir (str): directory receiving <stage>.<pid>.prof. Defaults to the
+        working directory
+    """
+
+    reset()
+    _state['enabled'] = True
+    _state['started'] = time.perf_counter()
+    _state['profile_stage'] = profile_stage
+    _state['profile_dir'] = profile_dir or os.getcwd()
+
+def disable(
+):
+    """ Stop recording. Records are kept until the next enable or reset
+    """
+
+    _state['enabled'] = False
+
+def is_enabled(
+) -> bool:
+
+    return _state['enabled']
+
+def reset(
+):
+    """ Clear every record of this process
+    """
+
+    _state['records'] = {}
+    _state['stack'] = threading.local()
+    _state['profiler'] = None
+    _state['worker_peak_rss_mb'] = 0.0
+
+def settings(
+) -> dict:
+    """ Settings passed to worker processes, see call_with_snapshot. None if disabled
+    """
+
+    if not _state['enabled']:
+        return None
+    return {'profile_stage': _state['profile_stage'], 'profile_dir': _state['profile_dir']}
+
+def _stack(
+) -> list:
+    """ Open stages of the calling thread, as (name, animal_id)
+    """
+
+    local = _state['stack']
+    if not hasattr(local, 'stages'):
+        local.stages = []
+    return local.stages
+
+def _record(
+    name: str,
+    animal_id: str
+) -> dict:
+    """ Record of a stage and animal, created on first use. Call while holding the lock
+    """
+
+    key = (name, animal_id)
+    record = _state['records'].get(key)
+    if record is None:
+        record = {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': 0.0, 'counters': {}}
+        _state['records'][key] = record
+    return record
+
+@contextlib.contextmanager
+def stage(
+    name: str,
+    animal_id: str = None,
+    message: str = None
+):
+    """ Time a stage of the pipeline. Usable as a context manager or a decorator
+
+    Nested stages inherit the animal_id of the enclosing stage of the same thread, so
+    the stages run by preprocess_animal are reported per animal. Stages entered in
+    thread pools (e.g. validate_datafiles, watch_folder) nest within their own
+    thread; their wall time also counts toward the stage that started the pool.
+    When disabled, only the progress message is printed
+
+    Parameters
+    ----------
+    name (str): stage name, e.g. 'load_csv'
+    animal_id (str): Optional animal the stage is scoped to
+    message (str): Optional progress message. Printed as '<message>...' on entry and
+        '<message> done.' on exit
+    """
+
+    if message is not None:
+        print()
+        print(message+'...')
+
+    if not _state['enabled']:
+        yield
+        if message is not None:
+            print(message+' done.')
+        return
+
+    stack = _stack()
+    if animal_id is None and stack:
+        animal_id = stack[-1][1]
+    stack.append((name, animal_id))
+
+    # profile the chosen stage. Repeated calls accumulate into the same profile
+    profiler = None
+    if name == _state['profile_stage'] and _state['profiler'] is None:
+        profiler = _state['profiler'] = cProfile.Profile()
+        profiler.enable()
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        if profiler is not None:
+            profiler.disable()
+            _state['profiler'] = None
+            _dump_profile(name, profiler)
+        stack.pop()
+
+        peak = peak_rss_mb()
+        with _state['lock']:
+            record = _record(name, animal_id)
+            record['calls'] += 1
+            record['wall_s'] += wall
+            record['cpu_s'] += cpu
+            record['peak_rss_mb'] = max(record['peak_rss_mb'], peak)
+
+    if message is not None:
+        print(message+' done. (%.2f s)' % wall)
+
+def _dump_profile(
+    name: str,
+    profiler: cProfile.Profile
+):
+    """ Add a profiling pass to <profile_dir>/<stage>.<pid>.prof
+    """
+
+    import pstats
+
+    fp = os.path.join(_state['profile_dir'], name+'.'+str(os.getpid())+'.prof')
+    stats = pstats.Stats(profiler)
+    if os.path.exists(fp):
+        stats.add(fp)
+    stats.dump_stats(fp)
+
+def count(
+    counter: str,
+    value: float = 1,
+    animal_id: str = None
+):
+    """ Add value to a counter of the current stage, e.g. count('rows_parsed', n)
+
+    Parameters
+    ----------
+    counter (str): rows_parsed, events_found, frames_aligned, clips_written, bytes_read,
+        bytes_written, etc
+    value (float): amount added
+    animal_id (str): Optional animal. Defaults to the animal of the current stage
+    """
+
+    if not _state['enabled']:
+        return
+
+    stack = _stack()
+    name, current_animal = stack[-1] if stack else ('run', None)
+    with _state['lock']:
+        counters = _record(name, current_animal if animal_id is None else animal_id)['counters']
+        counters[counter] = counters.get(counter, 0) + value
+
+def snapshot(
+) -> dict:
+    """ Records of this process, in a picklable form. See merge
+    """
+
+    with _state['lock']:
+        records = [[name, animal_id, record] for (name, animal_id), record in _state['records'].items()]
+
+    return {
+        'records': records,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def merge(
+    snap: dict
+):
+    """ Add the records of another process (see snapshot) to this process
+    """
+
+    if snap is None or not _state['enabled']:
+        return
+
+    with _state['lock']:
+        for name, animal_id, other in snap['records']:
+            record = _record(name, animal_id)
+            record['calls'] += other['calls']
+            record['wall_s'] += other['wall_s']
+            record['cpu_s'] += other['cpu_s']
+            record['peak_rss_mb'] = max(record['peak_rss_mb'], other['peak_rss_mb'])
+            for counter, value in other['counters'].items():
+                record['counters'][counter] = record['counters'].get(counter, 0) + value
+    _state['worker_peak_rss_mb'] = max(_state['worker_peak_rss_mb'], snap['peak_rss_mb'])
+
+def call_with_snapshot(
+    worker_settings: dict,
+    func,
+    *args
+) -> tuple:
+    """ Run func(*args) in a worker process and return its records with the result
+
+    Parameters
+    ----------
+    worker_settings (dict): see settings. None runs func without recording
+    func (callable): function to run, must be picklable
+    args: arguments of func
+
+    Returns
+    ----------
+    result: return value of func
+    snap (dict): records of the call, see snapshot. None if recording was disabled
+    """
+
+    if worker_settings is None:
+        return func(*args), None
+
+    # workers are reused across calls, so every call starts from empty records
+    enable(**worker_settings)
+    try:
+        result = func(*args)
+        return result, snapshot()
+    finally:
+        disable()
+        reset()
+
+def build_report(
+) -> dict:
+    """ Structured report of the run
+
+    Returns
+    ----------
+    report (dict): containing:
+        created (str)
+        wall_s (float): time since enable
+        peak_rss_mb (float): peak memory of this process
+        worker_peak_rss_mb (float): largest peak memory of a worker process
+        stages (list): one dict per stage and animal with calls, wall_s, cpu_s,
+            peak_rss_mb and counters
+        totals (dict): KEY = stage, VALUE = calls, wall_s, cpu_s and counters summed
+            over animals
+    """
+
+    stages = []
+    totals = {}
+    for (name, animal_id), record in _state['records'].items():
+        stages.append({'stage': name, 'animal_id': animal_id, **record})
+        total = totals.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'counters': {}})
+        total['calls'] += record['calls']
+        total['wall_s'] += record['wall_s']
+        total['cpu_s'] += record['cpu_s']
+        for counter, value in record['counters'].items():
+            total['counters'][counter] = total['counters'].get(counter, 0) + value
+
+    started = _state['started']
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'wall_s': time.perf_counter() - started if started is not None else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+        'worker_peak_rss_mb': _state['worker_peak_rss_mb'],
+        'stages': stages,
+        'totals': totals
+    }
+
+def summary(
+    report: dict = None,
+    top: int = 5
+) -> str:
+    """ Human-readable summary of a report
+
+    Parameters
+    ----------
+    report (dict): Optional report, see build_report. Defaults to the current run
+    top (int): number of slowest stage and animal pairs listed
+
+    Returns
+    ----------
+    text (str)
+    """
+
+    if report is None:
+        report = build_report()
+
+    lines = ['Run took %.2f s. Peak memory %.1f MiB (workers %.1f MiB).'
+             % (report['wall_s'], report['peak_rss_mb'], report['worker_peak_rss_mb'])]
+    lines.append('%-32s %6s %10s %10s  %s' % ('stage', 'calls', 'wall_s', 'cpu_s', 'counters'))
+    for name, total in sorted(report['totals'].items(), key=lambda item: -item[1]['wall_s']):
+        counters = ', '.join(counter+'='+(format(value, ',.0f') if value == int(value) else format(value, ',.3f'))
+                             for counter, value in total['counters'].items())
+        lines.append('%-32s %6d %10.3f %10.3f  %s' % (name, total['calls'], total['wall_s'], total['cpu_s'], counters))
+
+    per_animal = [entry for entry in report['stages'] if entry['animal_id'] is not None and entry['calls']]
+    if per_animal:
+        lines.append('Slowest animals:')
+        for entry in sorted(per_animal, key=lambda entry: -entry['wall_s'])[:top]:
+            lines.append('    %-28s %-8s %10.3f s' % (entry['stage'], entry['animal_id'], entry['wall_s']))
+
+    return '\n'.join(lines)
+
+def save_report(
+    fp: str
+) -> dict:
+    """ Save the report of the current run as json and print its summary
+
+    Parameters
+    ----------
+    fp (str): filepath of the json report
+
+    Returns
+    ----------
+    report (dict): see build_report
+    """
+
+    report = build_report()
+    with open(fp, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    print()
+    print(summary(report))
+    print('Run report saved at:', fp)
+
+    return report
@@ -0,0 +1,446 @@
+################################################################################
+# Filename: motion_energy.py
+# Description: Computes per-frame motion energy (mean absolute grayscale difference
+#              between consecutive frames) straight from the source videos, and
+#              scores it for every acclimation and trial window
+# Outputs: <id>_motion_energy.npy, motion_energy.csv
+# Author: Audrey Yin, ay2376@nyu.edu
+# Created On: 2022-07-21 11:30
+# Last Modified Date:
+# Last Modified By:
+################################################################################
+
+# import modules
+import pandas as pd
+import numpy as np
+import regex as re
+import os
+import time
+import queue
+import threading
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+# relative imports when installed as the video_processing_tools package, flat ones when run from notebooks/
+if __package__:
+    from .instrumentation import stage, count
+    from .ts_preprocessing import load_dataset
+    from .extract_frames import get_datafiles, load_csv, analyze_trials
+else:
+    from instrumentation import stage, count
+    from ts_preprocessing import load_dataset
+    from extract_frames import get_datafiles, load_csv, analyze_trials
+
+# specify location of the datafiles
+dirFp = r'/Users/audreyyin/Documents/LeDoux/Sample Data'
+
+# frames are shrunk by this factor in both directions before differencing
+downsample = 4
+
+# Optional area of interest (x, y, width, height) in source pixels. None uses the whole frame
+aoi = None
+
+# frames decoded per chunk, and chunks held in memory per video (decoded or being analysed)
+chunkFrames = 256
+chunkBuffers = 3
+
+# number of videos processed at the same time
+maxJobs = 2
+
+# frames with motion energy below stillThreshold (grey levels) count as still
+stillThreshold = 1.0
+
+# only decode the trial windows, streamed from ffmpeg (see extract_frames.analyze_trials),
+# instead of computing the energy of whole videos
+trialsOnly = False
+
+def motion_energy_chunk(
+    frames: np.ndarray,
+    previous: np.ndarray,
+    out: np.ndarray,
+    work: np.ndarray = None
+) -> np.ndarray:
+    """ Motion energy of a chunk of grayscale frames: the mean absolute difference of
+    every frame with the frame before it
+
+    Parameters
+    ----------
+    frames (np.ndarray): uint8 array of shape (n, height, width)
+    previous (np.ndarray): uint8 frame before frames[0], shape (height, width). None
+        at the start of a video, where the first frame gets energy 0
+    out (np.ndarray): float32 array of length at least n receiving the energy
+    work (np.ndarray): Optional int16 scratch array of shape at least (n, height, width),
+        reused across chunks to avoid allocations
+
+    Returns
+    ----------
+    out (np.ndarray): out[:n]
+    """
+
+    n = len(frames)
+    if work is None:
+        work = np.empty(frames.shape, dtype=np.int16)
+    diff = work[:n]
+
+    # difference with the previous frame, in int16 so negative values are kept
+    if previous is None:
+        diff[0] = 0
+    else:
+        np.subtract(frames[0], previous, out=diff[0], dtype=np.int16)
+    np.subtract(frames[1:], frames[:-1], out=diff[1:], dtype=np.int16)
+    np.abs(diff, out=diff)
+
+    return np.mean(diff.reshape(n, -1), axis=1, dtype=np.float32, out=out[:n])
+
+def _get_buffer(
+    free: queue.Queue,
+    stop: threading.Event
+) -> np.ndarray:
+    """ Wait for a free buffer. None once stop is set
+    """
+
+    while not stop.is_set():
+        try:
+            return free.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+def _decode_chunks(
+    video_path: str,
+    free: queue.Queue,
+    full: queue.Queue,
+    factor: int,
+    box: tuple,
+    stop: threading.Event
+):
+    """ Producer thread: decode a video into grayscale, downsampled chunks. Buffers are
+    taken from free and handed to the consumer through full as (buffer, n). None
+    ends the stream, and an exception is passed on to the consumer. Returns early
+    once the consumer sets stop
+    """
+
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            raise IOError('OpenCV cannot open '+video_path)
+        frame = None
+        gray = None
+        buffer = _get_buffer(free, stop)
+        if buffer is None:
+            return
+        n = 0
+        while True:
+            ok, frame = cap.read(frame)
+            if not ok:
+                break
+            view = frame if box is None else frame[box[1]:box[1] + box[3], box[0]:box[0] + box[2]]
+            gray = cv2.cvtColor(view, cv2.COLOR_BGR2GRAY, dst=gray)
+            if factor > 1:
+                cv2.resize(gray, (buffer.shape[2], buffer.shape[1]), dst=buffer[n], interpolation=cv2.INTER_AREA)
+            else:
+                buffer[n] = gray
+            n += 1
+            if n == len(buffer):
+                full.put((buffer, n))
+                buffer = _get_buffer(free, stop)
+                if buffer is None:
+                    return
+                n = 0
+        if n:
+            full.put((buffer, n))
+        full.put(None)
+    except Exception as error:
+        full.put(error)
+    finally:
+        cap.release()
+
+def video_motion_energy(
+    video_path: str,
+    box: tuple = aoi,
+    factor: int = downsample,
+    chunk_frames: int = chunkFrames,
+    n_buffers: int = chunkBuffers
+) -> np.ndarray:
+    """ Decode a video once and compute the motion energy of every frame. Decoding
+    runs in a producer thread and overlaps with the differencing, which works on a
+    fixed set of preallocated chunk buffers
+
+    Parameters
+    ----------
+    video_path (str): Absolute path to the video
+    box (tuple): Optional area of interest (x, y, width, height) in source pixels
+    factor (int): downsampling factor in both directions
+    chunk_frames (int): frames per chunk
+    n_buffers (int): chunks held in memory at once. At least 2 so decoding and
+        differencing overlap
+
+    Returns
+    ----------
+    energy (np.ndarray): float32 motion energy of every decoded frame, in grey levels
+        (0-255). The first frame gets the energy of the second
+    """
+
+    cap = cv2.VideoCapture(video_path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    n_expected = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if box is not None:
+        x, y, w, h = box
+        width = max(min(w, width - x), 1)
+        height = max(min(h, height - y), 1)
+        box = (x, y, width, height)
+    shape = (chunk_frames, max(height // factor, 1), max(width // factor, 1))
+
+    # preallocated buffers, passed back and forth between the decoder and this thread
+    free = queue.Queue()
+    for _ in range(max(n_buffers, 2)):
+        free.put(np.empty(shape, dtype=np.uint8))
+    full = queue.Queue()
+    work = np.empty(shape, dtype=np.int16)
+    previous = np.empty(shape[1:], dtype=np.uint8)
+    has_previous = False
+
+    # sized from the container header, and grown if the video holds more frames
+    energy = np.empty(max(n_expected, chunk_frames), dtype=np.float32)
+    n_frames = 0
+
+    stop = threading.Event()
+    decoder = threading.Thread(target=_decode_chunks, args=(video_path, free, full, factor, box, stop),
+                               daemon=True)
+    decoder.start()
+    try:
+        while True:
+            item = full.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            buffer, n = item
+            if n_frames + n > len(energy):
+                energy = np.resize(energy, 2 * (n_frames + n))
+            motion_energy_chunk(buffer[:n], previous if has_previous else None, energy[n_frames:], work)
+            previous[:] = buffer[n - 1]
+            has_previous = True
+            n_frames += n
+            free.put(buffer)
+    finally:
+        # if this thread raised, the decoder would wait for a free buffer forever, holding
+        # the capture. Stop it and drop the chunks it already decoded
+        stop.set()
+        decoder.join()
+        while not full.empty():
+            full.get_nowait()
+
+    energy = energy[:n_frames].copy()
+    if n_frames > 1:
+        energy[0] = energy[1]
+
+    return energy
+
+class TrialMotionEnergy:
+    """ Motion energy of one trial, fed chunk by chunk from extract_frames.analyze_trials
+    (use the class as the analysis factory). Frames are downsampled like
+    video_motion_energy, and the first frame of the trial gets the energy of the second
+
+    Attributes
+    ----------
+    animal_id (str)
+    cs_id (str)
+    energy (np.ndarray): float32 energy of every frame of the trial
+    n_frames (int): frames received so far
+    """
+
+    __slots__ = ('animal_id', 'cs_id', 'energy', 'n_frames', 'previous', 'small', 'work')
+
+    def __init__(
+        self,
+        animal_id: str,
+        cs_id: str,
+        idx_start: int,
+        idx_end: int
+    ):
+
+        self.animal_id = animal_id
+        self.cs_id = cs_id
+        self.energy = np.zeros(idx_end - idx_start + 1, dtype=np.float32)
+        self.n_frames = 0
+        self.previous = None
+        self.small = None
+        self.work = None
+
+    def update(
+        self,
+        frames: np.ndarray,
+        frame_idx: int
+    ):
+        """ Add a chunk of gray (or bgr24) frames
+        """
+
+        n = min(len(frames), len(self.energy) - self.n_frames)
+        if n <= 0:
+            return
+        height, width = frames.shape[1:3]
+        shape = (len(frames), max(height // downsample, 1), max(width // downsample, 1))
+        if self.small is None or self.small.shape[0] < n:
+            self.small = np.empty(shape, dtype=np.uint8)
+            self.work = np.empty(shape, dtype=np.int16)
+
+        # shrink the chunk into the reused buffer
+        for i in range(n):
+            frame = frames[i] if frames.ndim == 3 else cv2.cvtColor(frames[i], cv2.COLOR_BGR2GRAY)
+            cv2.resize(frame, (shape[2], shape[1]), dst=self.small[i], interpolation=cv2.INTER_AREA)
+
+        motion_energy_chunk(self.small[:n], self.previous, self.energy[self.n_frames:], self.work)
+        self.previous = self.small[n - 1].copy()
+        self.n_frames += n
+
+    def result(
+        self
+    ) -> dict:
+        """ mean_energy, max_energy and percent_still (frames below stillThreshold)
+        """
+
+        energy = self.energy[:self.n_frames]
+        if self.n_frames > 1:
+            energy[0] = energy[1]
+        if not self.n_frames:
+            return {'mean_energy': np.nan, 'max_energy': np.nan, 'percent_still': np.nan}
+
+        return {
+            'mean_energy': float(energy.mean()),
+            'max_energy': float(energy.max()),
+            'percent_still': float(100 * (energy < stillThreshold).mean())
+        }
+
+def align_to_frames(
+    energy: np.ndarray,
+    n_frames: int
+) -> np.ndarray:
+    """ Pad (with nan) or cut the motion energy of a video to the frames logged by
+    bonsai, so energy[i] belongs to bonsai frame index i
+    """
+
+    aligned = np.full(n_frames, np.nan, dtype=np.float32)
+    n = min(n_frames, len(energy))
+    aligned[:n] = energy[:n]
+
+    return aligned
+
+@stage('compute_motion_energy', message='Computing motion energy')
+def compute_motion_energy(
+    dir_fp: str,
+    video_paths: list,
+    df_framerate: pd.DataFrame = None,
+    box: tuple = aoi,
+    factor: int = downsample,
+    max_jobs: int = maxJobs
+) -> dict:
+    """ Compute the motion energy of every video and save it as <id>_motion_energy.npy
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    video_paths (list): List with all absolute paths for video datafiles
+    df_framerate (pd.DataFrame): Optional info on video frame rate. Its n_frames
+        column aligns the energy to bonsai frame indices, see align_to_frames
+    box (tuple): Optional area of interest (x, y, width, height) in source pixels
+    factor (int): downsampling factor in both directions
+    max_jobs (int): number of videos processed at the same time
+
+    Returns
+    ----------
+    energy_dict (dict): KEY = animal_id, VALUE = float32 energy of every frame
+    """
+
+    n_frames_dict = {}
+    if df_framerate is not None and 'n_frames' in df_framerate.columns:
+        n_frames_dict = dict(zip(df_framerate['animal_id'].astype(str), df_framerate['n_frames']))
+
+    def run(filename):
+        start = time.perf_counter()
+        energy = video_motion_energy(filename, box, factor)
+        return energy, time.perf_counter() - start
+
+    keys = [re.search(r'_(\d{6})_', filename).group(1) for filename in video_paths]
+
+    # OpenCV releases the GIL while decoding and numpy while differencing, so threads are enough
+    energy_dict = {}
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        for key, filename, (energy, seconds) in zip(keys, video_paths, executor.map(run, video_paths)):
+            cap = cv2.VideoCapture(filename)
+            fps = cap.get(cv2.CAP_PROP_FPS) or np.nan
+            cap.release()
+            print(key+':', len(energy), 'frames at', round(len(energy) / seconds), 'fps',
+                  '('+str(round(len(energy) / seconds / fps, 1))+'x real time)')
+            count('frames', len(energy), animal_id=key)
+
+            if key in n_frames_dict:
+                if n_frames_dict[key] != len(energy):
+                    print('WARNING >', key, 'video has', len(energy), 'frames, bonsai logged',
+                          str(n_frames_dict[key])+'. Energy is aligned to bonsai frames.')
+                energy = align_to_frames(energy, int(n_frames_dict[key]))
+
+            energy_fp = os.path.join(dir_fp, key+'_motion_energy.npy')
+            np.save(energy_fp, energy)
+            count('bytes_written', os.path.getsize(energy_fp), animal_id=key)
+            energy_dict[key] = energy
+
+    return energy_dict
+
+def score_motion_energy(
+    df_cs: pd.DataFrame,
+    energy_dict: dict
+) -> pd.DataFrame:
+    """ Mean and peak motion energy inside every acclimation and trial window
+
+    Parameters
+    ----------
+    df_cs (pd.DataFrame): Info of animal id, trial id, timestamps, frame indices
+    energy_dict (dict): KEY = animal_id, VALUE = energy of every frame
+
+    Returns
+    ----------
+    df_energy (pd.DataFrame): Dataframe containing columns:
+        animal_id (str)
+        cs_id (str)
+        idx_start (int)
+        idx_end (int)
+        mean_energy (float): mean energy of the frames between idx_start and idx_end (inclusive)
+        max_energy (float)
+    """
+
+    df_list = []
+    for key, energy in energy_dict.items():
+        rows = df_cs.loc[(df_cs['animal_id'] == key) & (df_cs['idx_start'] >= 0),
+                         ['animal_id', 'cs_id', 'idx_start', 'idx_end']].copy()
+        with np.errstate(invalid='ignore'):
+            windows = [energy[start:end + 1] for start, end in zip(rows['idx_start'], rows['idx_end'])]
+            rows['mean_energy'] = [np.nanmean(window) if np.isfinite(window).any() else np.nan for window in windows]
+            rows['max_energy'] = [np.nanmax(window) if np.isfinite(window).any() else np.nan for window in windows]
+        df_list.append(rows)
+
+    df_energy = pd.concat(df_list, ignore_index=True) if df_list else pd.DataFrame(
+        columns=['animal_id', 'cs_id', 'idx_start', 'idx_end', 'mean_energy', 'max_energy'])
+
+    return df_energy
+
+
+if __name__ == '__main__':
+    # Grab videos and trial windows
+    videoPathList = get_datafiles(dirFp)
+    dfMaster, _ = load_csv(dirFp)
+    dfFrameRate = load_dataset(dirFp, 'frame_rate', ['mean_framerate', 'n_frames'])
+
+    # Compute and score motion energy
+    if trialsOnly:
+        dfEnergy = analyze_trials(dirFp, videoPathList, dfMaster, [TrialMotionEnergy])
+    else:
+        energyDict = compute_motion_energy(dirFp, videoPathList, dfFrameRate)
+        dfEnergy = score_motion_energy(dfMaster, energyDict)
+
+    # Save data
+    energy = os.path.join(dirFp, 'motion_energy.csv')
+    dfEnergy.to_csv(energy)
+    print('Motion energy info saved at:', energy)
@@ -0,0 +1,551 @@
+################################################################################
+# Filename: sharding.py
+# Description: Runs preprocessing or slicing on several machines sharing a
+#              directory (e.g. over NFS). Workers claim one animal at a time with
+#              atomic lock files, write per-animal partial outputs, and a merge step
+#              assembles cs_timestamps, frame_rate and slice_report
+# Outputs: .shards/<task>/ while running, then the outputs of ts_preprocessing.py
+#          or extract_frames.py
+# Author: Audrey Yin, ay2376@nyu.edu
+# Created On: 2022-07-20 10:05
+# Last Modified Date:
+# Last Modified By:
+################################################################################
+
+# import modules
+import pandas as pd
+import regex as re
+import os
+import json
+import time
+import shutil
+import socket
+import threading
+import uuid
+import multiprocessing
+
+# relative imports when installed as the video_processing_tools package, flat ones when run from notebooks/
+if __package__:
+    from .ts_preprocessing import (get_datafiles, create_path_dict, basenameExtensions, check_datafile_complete,
+                                   select_changed_animals, preprocessing_params, preprocess_animal, save_data,
+                                   load_manifest, save_manifest)
+    from .instrumentation import stage
+    from . import extract_frames
+else:
+    from ts_preprocessing import (get_datafiles, create_path_dict, basenameExtensions, check_datafile_complete,
+                                  select_changed_animals, preprocessing_params, preprocess_animal, save_data,
+                                  load_manifest, save_manifest)
+    from instrumentation import stage
+    import extract_frames
+
+# specify location of the datafiles
+dirFp = r'/Users/audreyyin/Documents/LeDoux/Sample Data'
+
+# 'preprocess' or 'slice'. Slicing needs the merged preprocessing outputs
+task = 'preprocess'
+
+# 'init' queues the work units, 'worker' processes units until none are left, 'merge'
+# assembles the outputs once every unit is done. 'local' does all three with
+# localWorkers processes on this machine
+role = 'local'
+localWorkers = 4
+
+# name of the queue directory created inside the datafile directory
+shardDirname = '.shards'
+
+# claims whose lock file was not touched for leaseTimeout seconds belong to a crashed
+# worker and are reclaimed. Live workers touch their lock every heartbeatInterval seconds
+leaseTimeout = 600.0
+heartbeatInterval = 60.0
+
+# seconds a worker waits before looking again for units claimed by other workers
+pollInterval = 5.0
+
+def _queue_dir(
+    dir_fp: str,
+    task: str
+) -> str:
+
+    return os.path.join(dir_fp, shardDirname, task)
+
+def worker_name(
+) -> str:
+    """ Name of this worker, unique across machines: <hostname>-<pid>
+    """
+
+    return socket.gethostname()+'-'+str(os.getpid())
+
+def _write_json(
+    fp: str,
+    obj
+):
+    """ Replace a json file atomically
+    """
+
+    tmp = fp+'.'+worker_name()+'.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp, fp)
+
+def init_queue(
+    dir_fp: str,
+    task: str,
+    units: dict,
+    extra: dict = None
+) -> dict:
+    """ Create the work queue of a task. If a queue already exists it is kept, so
+    several machines can call init_queue without clobbering each other
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    task (str): 'preprocess' or 'slice'
+    units (dict): KEY = animal_id, VALUE = json-serializable arguments of the unit
+    extra (dict): Optional json-serializable info used by merge_shards
+
+    Returns
+    ----------
+    queue (dict): the queue in use, containing units and extra
+    """
+
+    queue_dir = _queue_dir(dir_fp, task)
+    for sub in ('claims', 'done', 'parts'):
+        os.makedirs(os.path.join(queue_dir, sub), exist_ok=True)
+
+    # os.link fails if queue.json exists, so exactly one queue is created
+    fp = os.path.join(queue_dir, 'queue.json')
+    tmp = fp+'.'+worker_name()+'.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'created': time.time(), 'units': units, 'extra': extra or {}}, f, indent=1)
+    try:
+        os.link(tmp, fp)
+        print('Queued', len(units), 'units at', queue_dir)
+    except FileExistsError:
+        print('Using the existing queue at', queue_dir)
+    finally:
+        os.remove(tmp)
+
+    with open(fp) as f:
+        return json.load(f)
+
+def claim_unit(
+    queue_dir: str,
+    unit: str,
+    worker: str,
+    lease_timeout: float = leaseTimeout
+) -> str:
+    """ Claim a unit by creating its lock file with O_CREAT | O_EXCL, which succeeds
+    for exactly one worker. A lock older than lease_timeout is moved aside and the
+    claim is retried. The lock holds a random token identifying this claim
+
+    Parameters
+    ----------
+    queue_dir (str): see init_queue
+    unit (str): animal_id
+    worker (str): see worker_name
+    lease_timeout (float): seconds after which an untouched claim expires
+
+    Returns
+    ----------
+    token (str): token of the claim, see release_unit. None if the unit was not claimed
+    """
+
+    lock = os.path.join(queue_dir, 'claims', unit+'.lock')
+    for _ in range(2):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            pass
+        else:
+            token = uuid.uuid4().hex
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'worker': worker, 'token': token, 'claimed': time.time()}, f)
+            return token
+
+        # reclaim an expired lease. Renaming moves the lock aside for exactly one worker
+        try:
+            if time.time() - os.stat(lock).st_mtime < lease_timeout:
+                return None
+            stale = lock+'.'+worker+'.stale'
+            os.rename(lock, stale)
+        except FileNotFoundError:
+            return None
+
+        # another worker may have reclaimed the lock between the stat and the rename
+        if time.time() - os.stat(stale).st_mtime < lease_timeout:
+            try:
+                os.link(stale, lock)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return None
+        os.remove(stale)
+        print('Reclaiming expired claim on', unit)
+
+    return None
+
+def release_unit(
+    queue_dir: str,
+    unit: str,
+    token: str
+) -> bool:
+    """ Remove the lock of a unit, only if it still holds the token of this claim. An
+    expired claim may have been reclaimed by another worker, whose lock is kept
+
+    Parameters
+    ----------
+    queue_dir (str): see init_queue
+    unit (str): animal_id
+    token (str): see claim_unit
+
+    Returns
+    ----------
+    released (bool): False if the lock belongs to another claim or is gone
+    """
+
+    lock = os.path.join(queue_dir, 'claims', unit+'.lock')
+    try:
+        with open(lock) as f:
+            owner = json.load(f).get('token')
+    except (FileNotFoundError, ValueError):
+        return False
+
+    if owner != token:
+        print('WARNING > Claim on', unit, 'was taken over by another worker. Its lock is kept.')
+        return False
+    os.remove(lock)
+    return True
+
+def _heartbeat(
+    lock: str,
+    token: str,
+    interval: float,
+    stop: threading.Event
+):
+    """ Touch a lock file every interval seconds until stop is set, or until the lock
+    no longer holds token
+    """
+
+    while not stop.wait(interval):
+        try:
+            with open(lock) as f:
+                if json.load(f).get('token') != token:
+                    return
+            os.utime(lock)
+        except (FileNotFoundError, ValueError):
+            return
+
+def _save_part(
+    df: pd.DataFrame,
+    fp: str
+):
+    """ Write a partial output atomically
+    """
+
+    tmp = fp+'.'+worker_name()+'.tmp'
+    df.to_pickle(tmp)
+    os.replace(tmp, fp)
+
+def _preprocess_unit(
+    dir_fp: str,
+    unit: str,
+    args: dict,
+    part_dir: str
+):
+    """ Preprocess one animal and write its partial cs_timestamps and frame_rate
+    """
+
+    df_cs, df_framerate = preprocess_animal(unit, args['files'])
+    _save_part(df_cs, os.path.join(part_dir, unit+'.cs_timestamps.pkl'))
+    _save_part(df_framerate, os.path.join(part_dir, unit+'.frame_rate.pkl'))
+
+def _slice_unit(
+    dir_fp: str,
+    unit: str,
+    args: dict,
+    part_dir: str
+):
+    """ Slice the video of one animal and write its slice report and manifest records.
+    The shared manifest is only read here, and updated by merge_shards
+    """
+
+    manifest = load_manifest(dir_fp)
+    df_cs, df_framerate = extract_frames.load_csv(dir_fp, [unit])
+    df_report = extract_frames.slice_videos(dir_fp, [args['video']], df_cs, df_framerate, args['mode'],
+                                            manifest=manifest)
+    _save_part(df_report, os.path.join(part_dir, unit+'.slice_report.pkl'))
+
+    # records of this animal's source video and clips
+    video_rel = os.path.relpath(args['video'], dir_fp)
+    clips_rel = unit+'_videos'+os.sep
+    _write_json(os.path.join(part_dir, unit+'.manifest.json'), {
+        'files': {rel: record for rel, record in manifest['files'].items() if rel == video_rel},
+        'clips': {rel: record for rel, record in manifest['clips'].items() if rel.startswith(clips_rel)}
+    })
+
+def process_units(
+    dir_fp: str,
+    task: str,
+    worker: str = None,
+    wait: bool = True,
+    lease_timeout: float = leaseTimeout,
+    heartbeat_interval: float = heartbeatInterval,
+    poll_interval: float = pollInterval
+) -> int:
+    """ Claim and process units of the queue until none are left
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    task (str): 'preprocess' or 'slice'
+    worker (str): Optional worker name, see worker_name
+    wait (bool): keep polling while other workers hold claims, so units of crashed
+        workers are reclaimed once their lease expires. Otherwise return as soon as
+        nothing can be claimed
+    lease_timeout (float): seconds after which an untouched claim expires
+    heartbeat_interval (float): seconds between touches of the claimed lock
+    poll_interval (float): seconds between passes over the queue while waiting
+
+    Returns
+    ----------
+    n_units (int): units processed by this worker, including failed units
+    """
+
+    queue_dir = _queue_dir(dir_fp, task)
+    with open(os.path.join(queue_dir, 'queue.json')) as f:
+        units = json.load(f)['units']
+    worker = worker or worker_name()
+    run_unit = {'preprocess': _preprocess_unit, 'slice': _slice_unit}[task]
+    done_dir = os.path.join(queue_dir, 'done')
+
+    n_units = 0
+    n_failed = 0
+    while True:
+        pending = [unit for unit in units if not os.path.exists(os.path.join(done_dir, unit+'.json'))]
+        if not pending:
+            break
+
+        claimed = False
+        for unit in pending:
+            token = claim_unit(queue_dir, unit, worker, lease_timeout)
+            if token is None:
+                continue
+            lock = os.path.join(queue_dir, 'claims', unit+'.lock')
+            done = os.path.join(done_dir, unit+'.json')
+
+            # the unit may have been finished between the listing and the claim
+            if not os.path.exists(done):
+                stop = threading.Event()
+                heartbeat = threading.Thread(target=_heartbeat, args=(lock, token, heartbeat_interval, stop), daemon=True)
+                heartbeat.start()
+                start = time.time()
+                record = {'worker': worker, 'started': start, 'status': 'ok'}
+                try:
+                    with stage('shard_unit', animal_id=unit):
+                        run_unit(dir_fp, unit, units[unit], os.path.join(queue_dir, 'parts'))
+                except Exception as error:
+                    # failed units are done. merge_shards leaves them out, so the next run queues them again
+                    record.update({'status': 'failed', 'error': repr(error)})
+                    n_failed += 1
+                    print('WARNING >', unit, 'failed:', repr(error))
+                finally:
+                    stop.set()
+                    heartbeat.join()
+                _write_json(done, {**record, 'finished': time.time()})
+                n_units += 1
+                claimed = True
+            release_unit(queue_dir, unit, token)
+
+        if not claimed:
+            if not wait:
+                break
+            time.sleep(poll_interval)
+
+    print('Worker', worker, 'processed', n_units, 'units,', n_failed, 'failed.')
+
+    return n_units
+
+def queue_preprocessing(
+    dir_fp: str,
+    fp_dict: dict,
+    incremental: bool = True
+) -> dict:
+    """ Queue one unit per animal to preprocess. Only new or changed animals that
+    pass validation are queued, see select_changed_animals and check_datafile_complete
+
+    Returns
+    ----------
+    queue (dict): see init_queue
+    """
+
+    manifest = load_manifest(dir_fp)
+    changed_dict = fp_dict
+    if incremental:
+        changed_dict = select_changed_animals(dir_fp, fp_dict, manifest, preprocessing_params())
+    valid_dict = check_datafile_complete(changed_dict)
+
+    # manifest records are only saved by merge_shards, once the animals are done. Animals
+    # that failed validation keep their previous records and are retried on the next run
+    failed = set(changed_dict) - set(valid_dict)
+    rel_set = {os.path.relpath(fp, dir_fp) for key, fp_list in fp_dict.items() if key not in failed
+               for fp in fp_list if fp}
+    extra = {
+        'incremental': incremental,
+        'manifest_files': {rel: record for rel, record in manifest['files'].items() if rel in rel_set},
+        'manifest_animals': {key: manifest['animals'][key] for key in valid_dict if key in manifest['animals']}
+    }
+
+    return init_queue(dir_fp, 'preprocess', {key: {'files': fp_list} for key, fp_list in valid_dict.items()},
+                      extra)
+
+def queue_slicing(
+    dir_fp: str,
+    video_paths: list,
+    mode: str = extract_frames.sliceMode
+) -> dict:
+    """ Queue one unit per video to slice
+
+    Returns
+    ----------
+    queue (dict): see init_queue
+    """
+
+    units = {}
+    for filename in video_paths:
+        animal_id = re.search(r'_(\d{6})_', os.path.basename(filename))
+        if animal_id:
+            units[animal_id.group(1)] = {'video': filename, 'mode': mode}
+
+    return init_queue(dir_fp, 'slice', units)
+
+@stage('merge_shards', message='Merging shards')
+def merge_shards(
+    dir_fp: str,
+    task: str
+) -> bool:
+    """ Assemble the partial outputs of every unit once all units are done, update
+    the manifest and remove the queue
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    task (str): 'preprocess' or 'slice'
+
+    Returns
+    ----------
+    merged (bool): False if some units are not done yet, or if another worker merges
+        the queue. Failed units are left out of the outputs and the manifest, so they
+        are queued again by the next run
+    """
+
+    queue_dir = _queue_dir(dir_fp, task)
+    try:
+        with open(os.path.join(queue_dir, 'queue.json')) as f:
+            units = list(json.load(f)['units'])
+    except FileNotFoundError:
+        print('No', task, 'queue at', queue_dir+'. Nothing merged.')
+        return False
+
+    pending = [unit for unit in units if not os.path.exists(os.path.join(queue_dir, 'done', unit+'.json'))]
+    if pending:
+        print(len(pending), 'of', len(units), 'units are not done yet. Nothing merged.')
+        return False
+
+    # move the queue aside before reading it. The rename succeeds for exactly one worker
+    merging = queue_dir+'.'+worker_name()+'.merging'
+    try:
+        os.rename(queue_dir, merging)
+    except FileNotFoundError:
+        print('Another worker is merging the', task, 'queue. Nothing merged.')
+        return False
+    queue_dir = merging
+    with open(os.path.join(queue_dir, 'queue.json')) as f:
+        queue = json.load(f)
+    part_dir = os.path.join(queue_dir, 'parts')
+
+    failed = []
+    for unit in units:
+        with open(os.path.join(queue_dir, 'done', unit+'.json')) as f:
+            record = json.load(f)
+        if record.get('status', 'ok') != 'ok':
+            failed.append(unit)
+            print('WARNING >', unit, 'failed on', record['worker']+':', record.get('error', ''))
+    units = [unit for unit in units if unit not in failed]
+
+    manifest = load_manifest(dir_fp)
+    if task == 'preprocess':
+        if units:
+            cs_list = [pd.read_pickle(os.path.join(part_dir, unit+'.cs_timestamps.pkl')) for unit in units]
+            framerate_list = [pd.read_pickle(os.path.join(part_dir, unit+'.frame_rate.pkl')) for unit in units]
+            # rows of every animal in the directory now are kept, including animals saved
+            # by other runs since the queue was created
+            keep_animals = None
+            if queue['extra']['incremental']:
+                keep_animals = list(create_path_dict(get_datafiles(dir_fp, basenameExtensions)))
+            save_data(dir_fp, cs_list, framerate_list, keep_animals)
+
+        # keep the previous records of failed animals, so their changes are detected again
+        failed_rel = {os.path.relpath(fp, dir_fp) for unit in failed for fp in queue['units'][unit]['files'] if fp}
+        manifest['files'].update({rel: record for rel, record in queue['extra']['manifest_files'].items()
+                                  if rel not in failed_rel})
+        manifest['animals'].update({key: record for key, record in queue['extra']['manifest_animals'].items()
+                                    if key not in failed})
+    else:
+        report_list = [pd.read_pickle(os.path.join(part_dir, unit+'.slice_report.pkl')) for unit in units]
+        for unit in units:
+            with open(os.path.join(part_dir, unit+'.manifest.json')) as f:
+                records = json.load(f)
+            manifest['files'].update(records['files'])
+            manifest['clips'].update(records['clips'])
+        if report_list:
+            pd.concat(report_list, ignore_index=True).to_csv(os.path.join(dir_fp, 'slice_report.csv'))
+    save_manifest(dir_fp, manifest)
+
+    shutil.rmtree(queue_dir)
+
+    return True
+
+def run_local(
+    dir_fp: str,
+    task: str,
+    n_workers: int = localWorkers,
+    **kwargs
+) -> bool:
+    """ Run n_workers worker processes on this machine against an existing queue,
+    then merge. Same code path as several machines, useful for testing
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    task (str): 'preprocess' or 'slice'
+    n_workers (int): number of worker processes
+    kwargs: passed to process_units
+
+    Returns
+    ----------
+    merged (bool): see merge_shards
+    """
+
+    workers = [multiprocessing.Process(target=process_units, args=(dir_fp, task), kwargs=kwargs)
+               for _ in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return merge_shards(dir_fp, task)
+
+
+if __name__ == '__main__':
+    if role in ('init', 'local'):
+        if task == 'preprocess':
+            queue_preprocessing(dirFp, create_path_dict(get_datafiles(dirFp, basenameExtensions)))
+        else:
+            queue_slicing(dirFp, extract_frames.get_datafiles(dirFp))
+
+    if role == 'worker':
+        process_units(dirFp, task)
+    elif role == 'merge':
+        merge_shards(dirFp, task)
+    elif role == 'local':
+        run_local(dirFp, task, localWorkers)
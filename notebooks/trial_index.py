@@ -0,0 +1,329 @@
+################################################################################
+# Filename: trial_index.py
+# Description: Indexed SQLite database of sessions, trials, frame rates and sliced
+#              videos across experiments, kept up to date by save_data and
+#              slice_videos, with point queries for trials and clips
+# Outputs: trial_index.sqlite (or any db_path)
+# Author: Audrey Yin, ay2376@nyu.edu
+# Created On: 2022-07-25 14:40
+# Last Modified Date:
+# Last Modified By:
+################################################################################
+
+# import modules
+import pandas as pd
+import os
+import sqlite3
+
+# seconds a writer waits for another process (e.g. a shard or the watcher) to release the database
+busyTimeout = 60.0
+
+# sqlite type of every dtype in ts_preprocessing.datasetDtypes. Datetimes are ISO 8601 text
+sqliteTypes = {
+    'str': 'TEXT',
+    'datetime': 'TEXT',
+    'int64': 'INTEGER',
+    'float64': 'REAL'
+}
+
+def _schema(
+) -> list:
+    """ CREATE statements of every table and index. Trial and frame rate columns follow
+    ts_preprocessing.datasetDtypes
+    """
+
+    if __package__:
+        from .ts_preprocessing import datasetDtypes
+    else:
+        from ts_preprocessing import datasetDtypes
+
+    def columns(name):
+        return ''.join(', '+column+' '+sqliteTypes[dtype] for column, dtype in datasetDtypes[name].items()
+                       if column != 'cs_id')
+
+    return [
+        'CREATE TABLE IF NOT EXISTS sessions (dir TEXT NOT NULL, animal_id TEXT NOT NULL, experiment TEXT, '
+        'timepoint TEXT, session TEXT, updated TEXT DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (dir, animal_id))',
+        'CREATE TABLE IF NOT EXISTS trials (dir TEXT NOT NULL, animal_id TEXT NOT NULL, cs_id TEXT NOT NULL'
+        + columns('cs_timestamps') + ', PRIMARY KEY (dir, animal_id, cs_id))',
+        'CREATE TABLE IF NOT EXISTS framerate (dir TEXT NOT NULL, animal_id TEXT NOT NULL'
+        + columns('frame_rate') + ', PRIMARY KEY (dir, animal_id))',
+        'CREATE TABLE IF NOT EXISTS clips (path TEXT PRIMARY KEY, dir TEXT NOT NULL, animal_id TEXT NOT NULL, '
+        'cs_id TEXT NOT NULL, mode TEXT, size INTEGER, source TEXT)',
+        'CREATE INDEX IF NOT EXISTS sessions_animal ON sessions (animal_id)',
+        'CREATE INDEX IF NOT EXISTS trials_animal_cs ON trials (animal_id, cs_id)',
+        'CREATE INDEX IF NOT EXISTS trials_cs ON trials (cs_id)',
+        'CREATE INDEX IF NOT EXISTS framerate_animal ON framerate (animal_id)',
+        'CREATE INDEX IF NOT EXISTS clips_animal_cs ON clips (animal_id, cs_id)',
+        'CREATE INDEX IF NOT EXISTS clips_dir ON clips (dir, animal_id)'
+    ]
+
+def connect(
+    db_path: str
+) -> sqlite3.Connection:
+    """ Open the trial index, creating its tables if needed. The database is in WAL
+    mode, so queries do not block the pipeline writing to it
+
+    Parameters
+    ----------
+    db_path (str): filepath of the database
+
+    Returns
+    ----------
+    conn (sqlite3.Connection)
+    """
+
+    conn = sqlite3.connect(db_path, timeout=busyTimeout)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    with conn:
+        for statement in _schema():
+            conn.execute(statement)
+
+    return conn
+
+def _session_key(
+    dir_fp: str
+) -> tuple:
+    """ dir, experiment, timepoint and session of a session directory, named like
+    ts_preprocessing.discover_sessions
+    """
+
+    dir_fp = os.path.abspath(dir_fp)
+    return (dir_fp,) + tuple((['', '', ''] + dir_fp.split(os.sep))[-3:])
+
+def _to_rows(
+    df: pd.DataFrame,
+    columns: list
+) -> list:
+    """ Rows of df as tuples of sqlite values. Datetimes become ISO 8601 text, NaN and NaT become NULL
+    """
+
+    values = []
+    for column in columns:
+        series = df[column]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            series = series.map(lambda timestamp: timestamp.isoformat() if pd.notna(timestamp) else None)
+        elif series.dtype == object:
+            series = series.map(lambda value: value.isoformat() if hasattr(value, 'isoformat') else value)
+        series = series.astype(object).where(series.notna(), None)
+        values.append(series.tolist())
+
+    return list(zip(*values))
+
+def upsert_outputs(
+    db_path: str,
+    dir_fp: str,
+    df_cs: pd.DataFrame,
+    df_framerate: pd.DataFrame
+):
+    """ Record the preprocessing outputs of a session directory. Trials of the animals in
+    df_cs replace their previous trials. Called by ts_preprocessing.save_data
+
+    Parameters
+    ----------
+    db_path (str): filepath of the database
+    dir_fp (str): Absolute path to the directory containing datafiles
+    df_cs (pd.DataFrame): Info of animal id, trial id, timestamps, frame indices
+    df_framerate (pd.DataFrame): Info on video frame rate
+    """
+
+    session = _session_key(dir_fp)
+    animal_ids = sorted(set(df_cs['animal_id'].astype(str)) | set(df_framerate['animal_id'].astype(str)))
+
+    cs_columns = [column for column in df_cs.columns if column != 'animal_id']
+    framerate_columns = [column for column in df_framerate.columns if column != 'animal_id']
+    df_cs = df_cs.assign(animal_id=df_cs['animal_id'].astype(str))
+    df_framerate = df_framerate.assign(animal_id=df_framerate['animal_id'].astype(str))
+
+    conn = connect(db_path)
+    try:
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO sessions (dir, animal_id, experiment, timepoint, session) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             [(session[0], key) + session[1:] for key in animal_ids])
+            conn.executemany('DELETE FROM trials WHERE dir = ? AND animal_id = ?',
+                             [(session[0], key) for key in animal_ids])
+            conn.executemany('INSERT OR REPLACE INTO trials (dir, animal_id, '+', '.join(cs_columns)+') VALUES ('
+                             + ', '.join('?' * (len(cs_columns) + 2))+')',
+                             [(session[0],) + row for row in _to_rows(df_cs, ['animal_id'] + cs_columns)])
+            conn.executemany('INSERT OR REPLACE INTO framerate (dir, animal_id, '+', '.join(framerate_columns)
+                             + ') VALUES ('+', '.join('?' * (len(framerate_columns) + 2))+')',
+                             [(session[0],) + row for row in _to_rows(df_framerate, ['animal_id'] + framerate_columns)])
+    finally:
+        conn.close()
+
+def upsert_clips(
+    db_path: str,
+    dir_fp: str,
+    jobs: list,
+    df_report: pd.DataFrame,
+    mode: str
+):
+    """ Record the sliced videos of successful jobs. Called by extract_frames.slice_videos
+
+    Parameters
+    ----------
+    db_path (str): filepath of the database
+    dir_fp (str): Absolute path to the directory containing datafiles
+    jobs (list): see extract_frames.build_slice_jobs
+    df_report (pd.DataFrame): see extract_frames.run_slice_jobs, in the same order as jobs
+    mode (str): slicing mode of the jobs
+    """
+
+    rows = []
+    for job, returncode in zip(jobs, df_report['returncode']):
+        if returncode != 0:
+            continue
+        for cs_id, file_out, record in zip(job['cs_id'].split(';'), job['outputs'], job['records']):
+            if os.path.exists(file_out):
+                rows.append((os.path.abspath(file_out), os.path.abspath(dir_fp), job['animal_id'], cs_id, mode,
+                             os.path.getsize(file_out), record['source']))
+
+    conn = connect(db_path)
+    try:
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO clips (path, dir, animal_id, cs_id, mode, size, source) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    finally:
+        conn.close()
+
+def _query(
+    db_path: str,
+    table: str,
+    filters: dict
+) -> pd.DataFrame:
+    """ Select the rows of a table matching every filter. Filter values are lists
+    (matched with IN) or single values. None filters are ignored
+    """
+
+    where = []
+    params = []
+    for column, value in filters.items():
+        if value is None:
+            continue
+        if not isinstance(value, (list, tuple, set, pd.Index, pd.Series)):
+            value = [value]
+        alias = 't.' if column in ('dir', 'animal_id', 'cs_id') else 's.'
+        where.append(alias+column+' IN ('+', '.join('?' * len(value))+')')
+        params.extend(str(item) for item in value)
+
+    sql = 'SELECT s.experiment, s.timepoint, s.session, t.* FROM '+table+' t'
+    sql += ' LEFT JOIN sessions s ON s.dir = t.dir AND s.animal_id = t.animal_id'
+    if where:
+        sql += ' WHERE '+' AND '.join(where)
+
+    conn = connect(db_path)
+    try:
+        return pd.read_sql_query(sql, conn, params=params)
+    finally:
+        conn.close()
+
+def query_trials(
+    db_path: str,
+    animal_ids: list = None,
+    cs_ids: list = None,
+    experiment: str = None,
+    timepoint: str = None,
+    session: str = None,
+    dir_fp: str = None
+) -> pd.DataFrame:
+    """ Trials matching every given filter, across every indexed session directory
+
+    Parameters
+    ----------
+    db_path (str): filepath of the database
+    animal_ids (list): Optional animal_ids, or a single animal_id
+    cs_ids (list): Optional cs_ids (e.g. ['TRIAL 05']), or a single cs_id
+    experiment, timepoint, session (str): Optional names of the session directory,
+        e.g. EXP003, T01, SAC1
+    dir_fp (str): Optional session directory
+
+    Returns
+    ----------
+    df_trials (pd.DataFrame): experiment, timepoint, session, dir, animal_id and the
+        columns of cs_timestamps. Timestamps are ISO 8601 strings
+    """
+
+    return _query(db_path, 'trials', {
+        'animal_id': animal_ids, 'cs_id': cs_ids, 'experiment': experiment, 'timepoint': timepoint,
+        'session': session, 'dir': os.path.abspath(dir_fp) if dir_fp else None
+    })
+
+def query_clips(
+    db_path: str,
+    animal_ids: list = None,
+    cs_ids: list = None,
+    experiment: str = None,
+    timepoint: str = None,
+    session: str = None,
+    dir_fp: str = None
+) -> pd.DataFrame:
+    """ Sliced videos matching every given filter, e.g. every TRIAL 05 clip of some
+    animals. See query_trials for the filters
+
+    Returns
+    ----------
+    df_clips (pd.DataFrame): experiment, timepoint, session, path, dir, animal_id,
+        cs_id, mode, size and source (hash of the source video)
+    """
+
+    return _query(db_path, 'clips', {
+        'animal_id': animal_ids, 'cs_id': cs_ids, 'experiment': experiment, 'timepoint': timepoint,
+        'session': session, 'dir': os.path.abspath(dir_fp) if dir_fp else None
+    })
+
+def query_framerate(
+    db_path: str,
+    animal_ids: list = None,
+    experiment: str = None,
+    timepoint: str = None,
+    session: str = None,
+    dir_fp: str = None
+) -> pd.DataFrame:
+    """ Frame rate stats matching every given filter. See query_trials for the filters
+    """
+
+    return _query(db_path, 'framerate', {
+        'animal_id': animal_ids, 'experiment': experiment, 'timepoint': timepoint,
+        'session': session, 'dir': os.path.abspath(dir_fp) if dir_fp else None
+    })
+
+def get_trial(
+    db_path: str,
+    animal_id: str,
+    cs_id: str,
+    dir_fp: str = None
+) -> dict:
+    """ One trial of an animal, from the primary key index
+
+    Parameters
+    ----------
+    db_path (str): filepath of the database
+    animal_id (str)
+    cs_id (str): e.g. 'TRIAL 05'
+    dir_fp (str): Optional session directory, for animals recorded in several sessions.
+        Defaults to the most recently updated session
+
+    Returns
+    ----------
+    trial (dict): see query_trials. None if the trial is not indexed
+    """
+
+    sql = ('SELECT s.experiment, s.timepoint, s.session, t.* FROM trials t '
+           'LEFT JOIN sessions s ON s.dir = t.dir AND s.animal_id = t.animal_id '
+           'WHERE t.animal_id = ? AND t.cs_id = ?')
+    params = [str(animal_id), cs_id]
+    if dir_fp:
+        sql += ' AND t.dir = ?'
+        params.append(os.path.abspath(dir_fp))
+    sql += ' ORDER BY s.updated DESC LIMIT 1'
+
+    conn = connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        row = conn.execute(sql, params).fetchone()
+    finally:
+        conn.close()
+
+    return dict(row) if row is not None else None
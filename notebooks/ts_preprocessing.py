@@ -14,12 +14,88 @@ import pandas as pd
 import numpy as np
 import regex as re
 import os # can also us os.system to call for ffmpeg
-import sys
-import csv
+import json
+import hashlib
+import shutil
+import datetime
+import io
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# relative imports when installed as the video_processing_tools package, flat ones when run from notebooks/
+if __package__:
+    from .instrumentation import stage, count, settings, merge, call_with_snapshot, enable, save_report
+    from .video_index import load_video_index
+else:
+    from instrumentation import stage, count, settings, merge, call_with_snapshot, enable, save_report
+    from video_index import load_video_index
 
 # specify location of the datafiles
 dirFp = r'/Users/audreyyin/Documents/LeDoux/Sample Data'
 
+# preprocess every session directory below dirFp (e.g. EXP003/T01/SAC1), not only dirFp
+recursive = False
+
+# number of animals preprocessed in parallel. None uses every core, 1 runs serially
+maxWorkers = None
+
+# only reprocess animals whose datafiles changed since the last run (see manifest.json)
+incremental = True
+
+# what check_datafile_complete does with incomplete animals: 'skip', 'fail' or 'include-partial'
+completenessPolicy = 'skip'
+
+# bytes read from the end of each arduino csv when checking for SESSION > END
+tailBytes = 4096
+
+# record stage timings, counters and peak memory, saved to run_report.json in dirFp
+instrument = False
+
+# Optional stage run under cProfile while instrumenting, e.g. 'align_cs_frames'
+profileStage = None
+
+# name of the manifest recording datafile fingerprints and the parameters of the last run
+manifestBasename = 'manifest.json'
+
+# 'csv' saves cs_timestamps.csv and frame_rate.csv. 'parquet' saves typed parquet datasets
+# partitioned by animal_id (cs_timestamps.parquet, frame_rate.parquet). Requires pyarrow
+outputFormat = 'csv'
+
+# Optional SQLite trial index updated by save_data, e.g. os.path.join(dirFp, 'trial_index.sqlite').
+# One database can index every experiment, see trial_index.py
+dbFp = None
+
+# dtypes of the saved outputs, restored by load_dataset
+datasetDtypes = {
+    'cs_timestamps': {
+        'cs_id': 'str',
+        'ts_start': 'datetime',
+        'ts_end': 'datetime',
+        'vid_start': 'datetime',
+        'vid_end': 'datetime',
+        'idx_start': 'int64',
+        'idx_end': 'int64',
+        'err_start_ms': 'float64',
+        'err_end_ms': 'float64'
+    },
+    'frame_rate': {
+        'mean_framerate': 'float64',
+        'std_framerate': 'float64',
+        'n_frames': 'int64',
+        'median_interval_ms': 'float64',
+        'jitter_p50_ms': 'float64',
+        'jitter_p95_ms': 'float64',
+        'jitter_p99_ms': 'float64',
+        'dropped_frames': 'int64',
+        'n_gaps': 'int64',
+        'max_gap_ms': 'float64',
+        'gap_frames': 'str',
+        'video_frames': 'int64',
+        'video_fps': 'float64',
+        'frame_mismatch': 'int64'
+    }
+}
+
 # specify basename basename_extentions
 basenameExtensions = {
     'video': '.avi',
@@ -27,6 +103,32 @@ basenameExtensions = {
     'bonsai_ts': 'vid_ts_raw.csv'
 }
 
+# arduino serial outputs kept by parse_arduino_log, stored as small-int event codes
+ardEventCodes = {
+    'ACCLIMATION': 1,
+    'TRIAL_START': 2,
+    'CS_ON': 3,
+    'CS_OFF': 4,
+    'SESSION_END': 5
+}
+
+# label of every event code (ardEventLabels[code]), shared by all sessions
+ardEventLabels = tuple({code: label for label, code in ardEventCodes.items()}.get(code, '')
+                       for code in range(max(ardEventCodes.values()) + 1))
+
+# keep parsed raw logs as binary files next to the source (<csv>.cache.npy, <csv>.cache.json)
+parseCache = True
+
+# bump when the parsers change, so existing parse caches are rebuilt
+parseCacheVersion = 1
+
+# one regex that classifies every arduino line in a single scan
+ardEventPattern = (r'(?P<ACCLIMATION>ACCLIMATION)'
+                   r'|(?P<TRIAL_START>TRIAL NUMBER (?P<trial>\d+) > START)'
+                   r'|(?P<CS_ON>CS > ON)'
+                   r'|(?P<CS_OFF>CS > OFF)'
+                   r'|(?P<SESSION_END>SESSION > END)')
+
 def get_datafiles(
     dir_fp: str,
     basename_extensions: dict,
@@ -82,217 +184,751 @@ def create_path_dict (
             vid_fp = filepath for avi
     """
 
-    # Make sure data format is correct and that the filepath exists
-    for file in abspath_list:
-        basename_tuple = ('_vid_ts_raw.csv', '_ard_ts_raw.csv', '.avi')
-        print("Verifying filepath for", file, "...")
-        assert file.endswith(basename_tuple), "File has an incorrect extension. Expected .csv or .avi"
-        assert os.path.exists(file), "Filepath does not exist. Verify the absolute filepath"
+    # Make sure data format is correct. Report every bad filepath at once
+    basename_tuple = ('_vid_ts_raw.csv', '_ard_ts_raw.csv', '.avi')
+    bad_list = [file for file in abspath_list if not file.endswith(basename_tuple)]
+    assert not bad_list, "Files have an incorrect extension. Expected .csv or .avi: " + ', '.join(bad_list)
 
     print("All filepaths are valid.")
 
     # Instantiate a dictionary
     fp_dict = {}
 
-    # Fill dictionary with "animal_id:list of filepaths" pairs
+    # Fill dictionary with "animal_id:list of filepaths" pairs in a single pass
     for file in abspath_list:
         # Extract animal ids from filepath name
         animal_id = re.search(r'_(\d{6})_', file)
+        if animal_id is None:
+            continue
 
-        # Match animal id with corresponding csv and avi files
-        bon_csv = [file for file in abspath_list
-                   if file.endswith('_vid_ts_raw.csv') and animal_id.group() in file]
-        ard_csv = [file for file in abspath_list
-                   if file.endswith('_ard_ts_raw.csv') and animal_id.group() in file]
-        vid_fp = [file for file in abspath_list
-                  if file.endswith('.avi') and animal_id.group() in file]
-
-        fp_dict[animal_id.group().replace('_', "")] = [''.join(bon_csv), ''.join(ard_csv), ''.join(vid_fp)]
+        # Place file in the bon_csv, ard_csv or vid_fp slot of its animal
+        slot = [file.endswith(suffix) for suffix in basename_tuple].index(True)
+        fp_dict.setdefault(animal_id.group(1), ['', '', ''])[slot] = file
 
     return fp_dict
 
-def check_datafile_complete(
-    fp_dict: dict
+@stage('discover_sessions')
+def discover_sessions(
+    root_fp: str,
+    basename_extensions: dict = basenameExtensions
+) -> tuple:
+    """ Walk an experiment tree (e.g. EXP003/T01/SAC1) once with os.scandir and index
+    every animal's bonsai, arduino and video datafiles
+
+    Parameters
+    ----------
+    root_fp (str): Absolute path to the root of the tree. Can be a single session directory
+    basename_extensions (dict): basename identifies as keys and extensions as values
+        MUST CONTAIN the keys: video, arduino_ts, bonsai_ts
+
+    Returns
+    ----------
+    session_dict (dict): Complete datafile triples
+        KEY = (experiment, timepoint, session, animal_id). experiment, timepoint and
+            session are the last three directory names above the datafiles
+        VALUE = list of bon_csv, ard_csv, vid_fp
+    incomplete_dict (dict): Same keys, for animals missing at least one datafile
+        VALUE = list of bon_csv, ard_csv, vid_fp, with '' for missing files
+    """
+
+    # Make sure path is valid
+    assert os.path.isdir(root_fp), "The path provided does not point to a directory."
+
+    # datafile slot of every extension, in fp_dict order
+    extension_tuple = (basename_extensions.get('bonsai_ts'), basename_extensions.get('arduino_ts'),
+                       basename_extensions.get('video'))
+
+    index = {}
+    duplicate_list = []
+    stack = [os.path.abspath(root_fp)]
+    while stack:
+        dirname = stack.pop()
+        session = tuple((['', '', ''] + dirname.split(os.sep))[-3:])
+        with os.scandir(dirname) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # skip outputs of the pipeline
+                    if not entry.name.endswith(('_videos', '.parquet', 'frame_cache')):
+                        stack.append(entry.path)
+                    continue
+                if not entry.name.endswith(extension_tuple):
+                    continue
+                animal_id = re.search(r'_(\d{6})_', entry.name)
+                if animal_id is None:
+                    continue
+
+                slot = [entry.name.endswith(extension) for extension in extension_tuple].index(True)
+                fp_list = index.setdefault(session + (animal_id.group(1),), ['', '', ''])
+                if fp_list[slot]:
+                    duplicate_list.append(entry.path)
+                else:
+                    fp_list[slot] = entry.path
+
+    # split complete and incomplete triples in one pass
+    session_dict = {}
+    incomplete_dict = {}
+    for key, fp_list in index.items():
+        if all(fp_list):
+            session_dict[key] = fp_list
+        else:
+            incomplete_dict[key] = fp_list
+
+    # report problems in bulk
+    print('Found', len(session_dict), 'complete animals in', len({key[:3] for key in session_dict}), 'sessions.')
+    if incomplete_dict:
+        print('WARNING >', len(incomplete_dict), 'animals are missing a datafile:')
+        for key, fp_list in sorted(incomplete_dict.items()):
+            missing = [name for name, fp in zip(('bonsai_ts', 'arduino_ts', 'video'), fp_list) if not fp]
+            print('   ', '/'.join(key[:3]), key[3], 'missing', ', '.join(missing))
+    if duplicate_list:
+        print('WARNING >', len(duplicate_list), 'duplicate datafiles were ignored:')
+        for fp in duplicate_list:
+            print('   ', fp)
+
+    return session_dict, incomplete_dict
+
+def group_sessions(
+    session_dict: dict
+) -> dict:
+    """ Group discovered animals by the directory holding their datafiles
+
+    Parameters
+    ----------
+    session_dict (dict): see discover_sessions
+
+    Returns
+    ----------
+    dir_dict (dict): KEY = session directory, VALUE = fp_dict of the session
+    """
+
+    dir_dict = {}
+    for key, fp_list in session_dict.items():
+        dir_dict.setdefault(os.path.dirname(fp_list[0]), {})[key[3]] = fp_list
+
+    return dir_dict
+
+def _timestamps_to_ns(
+    timestamps
+) -> np.ndarray:
+    """ Convert timestamps (naive or tz-aware) to int64 nanoseconds since epoch
+
+    Parameters
+    ----------
+    timestamps (array-like): DatetimeIndex, Series or list of datetime objects
+
+    Returns
+    ----------
+    ts_ns (np.ndarray): int64 nanoseconds. tz-aware timestamps are converted to UTC
+    """
+
+    timestamps = pd.DatetimeIndex(timestamps)
+    if timestamps.tz is not None:
+        timestamps = timestamps.tz_convert(None)
+    return timestamps.values.astype('datetime64[ns]').view('int64')
+
+def parse_timestamps(
+    values
+) -> pd.DatetimeIndex:
+    """ Parse ISO 8601 timestamp strings (as written by bonsai and the arduino logger)
+    with an explicit format instead of per-element format inference
+
+    Parameters
+    ----------
+    values (array-like): timestamp strings
+
+    Returns
+    ----------
+    timestamps (pd.DatetimeIndex): tz-aware if the strings have a utc offset. Strings with
+        mixed offsets (e.g. across a daylight saving change) are converted to utc
+    """
+
+    if int(pd.__version__.split('.')[0]) >= 2:
+        kwargs = {'format': 'ISO8601'}
+    else:
+        kwargs = {'infer_datetime_format': True}
+
+    try:
+        timestamps = pd.DatetimeIndex(pd.to_datetime(pd.Index(values, dtype=object), **kwargs))
+    except (ValueError, TypeError):
+        timestamps = pd.DatetimeIndex(pd.to_datetime(pd.Index(values, dtype=object), utc=True, **kwargs))
+
+    return timestamps
+
+def _tz_to_json(
+    tz
 ):
-    """Check to see if datafiles are complete and usable. Includes:
-        - Removing any empty strings in fp_dict
+    """ JSON representation of a timezone: a fixed utc offset in seconds or a tz name
+    """
+
+    if tz is None:
+        return None
+    offset = tz.utcoffset(None)
+    if offset is not None:
+        return offset.total_seconds()
+    return str(tz)
+
+def _tz_from_json(
+    tz
+):
+    """ Inverse of _tz_to_json
+    """
+
+    if isinstance(tz, (int, float)):
+        return datetime.timezone(datetime.timedelta(seconds=tz))
+    return tz
+
+def _parser_key(
+    events: bool = False
+) -> dict:
+    """ Parser settings stored with a parse cache. Arduino caches also depend on the
+    event pattern and codes
+    """
+
+    key = {'version': parseCacheVersion}
+    if events:
+        key.update({'ardEventPattern': ardEventPattern, 'ardEventCodes': ardEventCodes})
+    return key
+
+def _read_parse_cache(
+    src: str,
+    parser: dict
+) -> tuple:
+    """ Memory-map the parse cache of a raw log, if it is current: the source did not
+    change and it was parsed with the same parser settings
+
+    Parameters
+    ----------
+    src (str): filepath of the raw log
+    parser (dict): see _parser_key
+
+    Returns
+    ----------
+    array (np.ndarray): cached array (read-only memory map), or None if there is no
+        current cache
+    tz: timezone of the cached timestamps
+    """
+
+    meta_fp = src+'.cache.json'
+    if not os.path.exists(meta_fp):
+        return None, None
+
+    with open(meta_fp) as f:
+        meta = json.load(f)
+    stat = os.stat(src)
+    if (meta['source_size'] != stat.st_size or meta['source_mtime_ns'] != stat.st_mtime_ns
+            or meta.get('parser') != parser):
+        return None, None
+
+    return np.load(src+'.cache.npy', mmap_mode='r'), _tz_from_json(meta['tz'])
+
+def _write_parse_cache(
+    src: str,
+    array: np.ndarray,
+    tz,
+    parser: dict
+):
+    """ Save the parse cache of a raw log. Skipped if the directory is not writable
+    """
+
+    stat = os.stat(src)
+    try:
+        tmp = src+'.cache.'+str(os.getpid())+'.npy'
+        np.save(tmp, array)
+        os.replace(tmp, src+'.cache.npy')
+        with open(src+'.cache.json', 'w') as f:
+            json.dump({'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns,
+                       'tz': _tz_to_json(tz), 'parser': parser}, f)
+    except OSError:
+        pass
+
+def _ns_to_timestamps(
+    ts_ns: np.ndarray,
+    tz
+) -> pd.DatetimeIndex:
+    """ Inverse of _timestamps_to_ns
+    """
+
+    timestamps = pd.DatetimeIndex(np.asarray(ts_ns).view('datetime64[ns]'))
+    if tz is not None:
+        timestamps = timestamps.tz_localize('UTC').tz_convert(tz)
+    return timestamps
+
+@stage('load_bonsai_timestamps')
+def load_bonsai_timestamps(
+    bon_csv: str,
+    use_cache: bool = parseCache
+) -> tuple:
+    """ Load the timestamp of every video frame from a bonsai csv
+
+    Parameters
+    ----------
+    bon_csv (str): filepath for bonsai csv
+    use_cache (bool): read and write the int64 ns parse cache next to bon_csv
+
+    Returns
+    ----------
+    frame_ts (np.ndarray): int64 ns timestamp of every frame, in logged order. A
+        read-only memory map of the parse cache if it was current
+    tz: timezone of the timestamps, None if they are naive
+    """
+
+    if use_cache:
+        frame_ts, tz = _read_parse_cache(bon_csv, _parser_key())
+        if frame_ts is not None:
+            count('cache_hits')
+            count('bytes_read', frame_ts.nbytes)
+            return frame_ts, tz
+
+    values = pd.read_csv(bon_csv, names=['timestamp'], dtype=str, engine='c')['timestamp']
+    timestamps = parse_timestamps(values)
+    frame_ts = _timestamps_to_ns(timestamps)
+    count('rows_parsed', len(values))
+    count('bytes_read', os.path.getsize(bon_csv))
+
+    if use_cache:
+        _write_parse_cache(bon_csv, frame_ts, timestamps.tz, _parser_key())
+
+    return frame_ts, timestamps.tz
+
+@stage('load_arduino_events')
+def load_arduino_events(
+    ard_csv: str,
+    use_cache: bool = parseCache
+) -> tuple:
+    """ Load the session events of an arduino csv. See parse_arduino_log
+
+    Parameters
+    ----------
+    ard_csv (str): filepath for ard_csv
+    use_cache (bool): read and write the parse cache next to ard_csv, a structured
+        array of (line, event, trial, timestamp as int64 ns)
+
+    Returns
+    ----------
+    events (np.ndarray): structured array with fields line (int64), event (int8),
+        trial (int16) and timestamp (int64 ns), one row per event
+    tz: timezone of the timestamps, None if they are naive
+    """
+
+    if use_cache:
+        events, tz = _read_parse_cache(ard_csv, _parser_key(events=True))
+        if events is not None:
+            count('cache_hits')
+            count('bytes_read', events.nbytes)
+            count('events_found', len(events))
+            return np.array(events), tz
+
+    df_events = parse_arduino_log(ard_csv)
+    count('bytes_read', os.path.getsize(ard_csv))
+    count('events_found', len(df_events))
+
+    events = np.empty(len(df_events), dtype=[('line', '<i8'), ('event', 'i1'),
+                                             ('trial', '<i2'), ('timestamp', '<i8')])
+    events['line'] = df_events['line']
+    events['event'] = df_events['event']
+    events['trial'] = df_events['trial']
+    events['timestamp'] = _timestamps_to_ns(df_events['timestamp'])
+    tz = pd.DatetimeIndex(df_events['timestamp']).tz
+
+    if use_cache:
+        _write_parse_cache(ard_csv, events, tz, _parser_key(events=True))
+
+    return events, tz
+
+def parse_arduino_log(
+    ard_csv: str,
+    chunksize: int = 100000
+) -> pd.DataFrame:
+    """ Stream an arduino csv in chunks and extract typed session events in one pass
+
+    Each chunk is classified with a single regex scan (ardEventPattern). Only the
+    matched lines go through the event state machine, which carries the current
+    trial across chunks:
+        - TRIAL NUMBER n > START sets the current trial
+        - CS > ON is assigned to the current trial only if the trial started at
+          most two lines earlier. Otherwise the trial is unknown (-1)
+        - CS > OFF is assigned to the trial of the last CS > ON
+
+    Parameters
+    ----------
+    ard_csv (str): filepath for ard_csv
+    chunksize (int): number of lines read per chunk
+
+    Returns
+    ----------
+    df_events (pandas.DataFrame): One row per event, containing columns:
+        line (int64): line number in ard_csv
+        event (int8): event code, see ardEventCodes
+        trial (int16): trial number, -1 if the event is not part of a trial
+        timestamp (DateTime): timestamp of the arduino serial output
+    """
+
+    # instantiate empty lists. Appending list data is cheaper and requires less memory than appending dataframes
+    line = []
+    event = []
+    trial = []
+    timestamp = []
+
+    # state carried across chunks
+    current_trial = -1
+    current_trial_line = -3
+    cs_trial = -1
+
+    reader = pd.read_csv(ard_csv, names=['ard_output', 'timestamp'], dtype=str,
+                         chunksize=chunksize)
+    for chunk in reader:
+        count('rows_parsed', len(chunk))
+        # classify every line of the chunk at once and keep only the matches
+        match = chunk['ard_output'].str.extract(ardEventPattern)
+        match = match[match.notna().any(axis=1)]
+
+        for row in match.itertuples():
+            if isinstance(row.TRIAL_START, str):
+                code = ardEventCodes['TRIAL_START']
+                current_trial = int(row.trial)
+                current_trial_line = row.Index
+                event_trial = current_trial
+            elif isinstance(row.CS_ON, str):
+                code = ardEventCodes['CS_ON']
+                # only record cs_id if CS was on. This prevents recording failed trials where no motion was detected
+                cs_trial = current_trial if row.Index - current_trial_line <= 2 else -1
+                event_trial = cs_trial
+            elif isinstance(row.CS_OFF, str):
+                code = ardEventCodes['CS_OFF']
+                event_trial = cs_trial
+            elif isinstance(row.ACCLIMATION, str):
+                code = ardEventCodes['ACCLIMATION']
+                event_trial = -1
+            else:
+                code = ardEventCodes['SESSION_END']
+                event_trial = -1
+
+            line.append(row.Index)
+            event.append(code)
+            trial.append(event_trial)
+            timestamp.append(chunk.at[row.Index, 'timestamp'])
+
+    # only the event lines are converted to datetime objects
+    df_events = pd.DataFrame({
+        'line': np.array(line, dtype=np.int64),
+        'event': np.array(event, dtype=np.int8),
+        'trial': np.array(trial, dtype=np.int16),
+        'timestamp': parse_timestamps(timestamp)
+    })
+
+    return df_events
+
+def _validate_animal(
+    animal_id: str,
+    fp_list: list,
+    tail_bytes: int = tailBytes
+) -> dict:
+    """ Validate the datafiles of one animal. The arduino csv is complete if its tail
+    contains SESSION > END. Only the last tail_bytes are read, with a seek from the end
+
+    Returns
+    ----------
+    record (dict): row of the validation report, see validate_datafiles
+    """
+
+    present = [fp for fp in fp_list if fp]
+    record = {'animal_id': animal_id, 'status': 'ok', 'n_files': len(present),
+              'ard_bytes': -1, 'detail': ''}
+
+    # Ensure that each animal_id has three datafiles
+    if len(present) != 3 or len(fp_list) != 3:
+        record['status'] = 'missing_datafile'
+        record['detail'] = ' '.join(present)
+        return record
+
+    # Ensure that the arduino csv ends the session
+    ard_csv = fp_list[1]
+    try:
+        with open(ard_csv, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(size - tail_bytes, 0))
+            tail = f.read().decode(errors='replace')
+    except OSError as error:
+        record['status'] = 'unreadable'
+        record['detail'] = str(error)
+        return record
+
+    record['ard_bytes'] = size
+    if size == 0:
+        record['status'] = 'empty'
+    elif re.search(r'SESSION > END', tail) is None:
+        record['status'] = 'incomplete_log'
+        record['detail'] = 'no SESSION > END in the last '+str(min(size, tail_bytes))+' bytes'
+
+    return record
+
+@stage('validate_datafiles')
+def validate_datafiles(
+    fp_dict: dict,
+    max_workers: int = None,
+    tail_bytes: int = tailBytes
+) -> pd.DataFrame:
+    """ Validate the datafiles of every animal in parallel threads, without reading
+    whole files (see _validate_animal)
+
+    Parameters
+    ----------
+    fp_dict (dict): Dictionary with all filepaths necessary for preprocessing csvs
+    max_workers (int): Number of threads. None lets ThreadPoolExecutor decide
+    tail_bytes (int): bytes read from the end of each arduino csv
+
+    Returns
+    ----------
+    df_validation (pd.DataFrame): One row per animal, in the order of fp_dict, containing columns:
+        animal_id (str)
+        status (str): ok, missing_datafile, incomplete_log, empty or unreadable
+        n_files (int): datafiles found
+        ard_bytes (int): size of the arduino csv, -1 if it was not read
+        detail (str): datafiles found, or the reason the arduino csv failed
+    """
+
+    # each check is a few small reads, so threads keep the disk busy
+    keys = list(fp_dict)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        records = list(executor.map(lambda key: _validate_animal(key, fp_dict[key], tail_bytes), keys))
+    df_validation = pd.DataFrame(records, columns=['animal_id', 'status', 'n_files', 'ard_bytes', 'detail'])
+    count('bytes_read', sum(min(size, tail_bytes) for size in df_validation['ard_bytes'] if size > 0))
+
+    return df_validation
+
+@stage('check_datafile_complete', message='Checking if data is complete')
+def check_datafile_complete(
+    fp_dict: dict,
+    policy: str = completenessPolicy,
+    max_workers: int = None,
+    tail_bytes: int = tailBytes,
+    df_validation: pd.DataFrame = None
+) -> dict:
+    """Check to see if datafiles are complete and usable, without reading whole files:
         - Checking to see if each animal_id key has three datafiles (2 .csv, 1 .avi)
-        - Checking to see if ard_csv is complete
+        - Checking to see if ard_csv is complete, from its tail (see _validate_animal)
+    Failures are handled by policy rather than a prompt, so unattended runs never block
 
     Parameters
     ----------
     fp_dict (dict): Dictionary with all filepaths necessary for preprocessing csvs
         KEY = animal_id
         VALUE = list of bonsai, arduino, and video data filepaths
+    policy (str): What to do with animals that fail validation:
+        'skip': leave them out of the returned fp_dict
+        'fail': raise a ValueError listing them
+        'include-partial': keep animals whose arduino csv has no SESSION > END. Animals
+            missing a datafile are still left out
+    max_workers (int): Number of threads. See validate_datafiles
+    tail_bytes (int): bytes read from the end of each arduino csv
+    df_validation (pd.DataFrame): Optional report of validate_datafiles for fp_dict, to
+        keep it (e.g. for validation_report.csv). An included (bool) column is added.
+        Validated here if not given
 
     Returns
     ----------
-    prints string with error message, if existing
+    fp_dict (dict): animals that passed validation (or are included by policy)
     """
 
-    # Print message to user
-    print();
-    print("Checking if data is complete...")
+    assert policy in ('skip', 'fail', 'include-partial'), "policy must be 'skip', 'fail' or 'include-partial'"
 
-    # Remove any empty strings within the dictionary
-    for key in fp_dict:
-        while "" in fp_dict[key]:
-            fp_dict[key].remove("")
+    if df_validation is None:
+        df_validation = validate_datafiles(fp_dict, max_workers, tail_bytes)
+    keys = list(df_validation['animal_id'])
 
-    for key in fp_dict:
-        try:
-            # Ensure that each animal_id has three datafiles
-            check_datafiles = len(fp_dict[key])
-            assert(check_datafiles == 3)
-
-            # Ensure that all of arduino csv is complete
-            log_data = pd.read_csv(fp_dict[key][1], names=['log', 'timestamp'])
-            session_end_pat = 'SESSION > END'
-            if session_end_pat in log_data.values:
-                pass
-            else:
-                raise ValueError()
-        except AssertionError:
-            print(key, "is missing a datafile.")
-            pprint.pprint(fp_dict[key])
-            raise
-        except ValueError:
-            print("WARNING > FILE ERROR. Please verify content of arduino files for", key)
-            ignore = input('Would you like to continue? [y/n]: ')
-            check = 0
-            while check == 0:
-                if ignore == 'y':
-                    check = 1
-                    continue
-                elif ignore == 'n':
-                    check = 1
-                    raise
-                else:
-                    ignore = input('Invalid input. Would you like to continue? [y/n]: ')
-    print("All data complete.")
+    keep = df_validation['status'] == 'ok'
+    if policy == 'include-partial':
+        keep |= df_validation['status'] == 'incomplete_log'
+    df_validation['included'] = keep
+
+    failed = df_validation[df_validation['status'] != 'ok']
+    for row in failed.itertuples():
+        action = '' if policy == 'fail' else ' Included.' if row.included else ' Skipped.'
+        print('WARNING >', row.animal_id, row.status+(': '+row.detail if row.detail else '')+'.'+action)
+    if policy == 'fail' and len(failed):
+        raise ValueError(str(len(failed))+' animals failed validation: '+', '.join(failed['animal_id']))
 
+    print(keep.sum(), 'of', len(df_validation), 'animals are complete or included.')
+
+    return {key: fp_dict[key] for key, included in zip(keys, keep) if included}
+
+class Session:
+    """ Timestamps of one animal's session, held as flat arrays instead of dataframes.
+    Timestamps are int64 nanoseconds (UTC if the logs have a utc offset) and arduino
+    events are parallel arrays, with event codes named by the shared label table
+
+    Attributes
+    ----------
+    animal_id (str)
+    frame_ts (np.ndarray): int64 ns timestamp of every video frame, in logged order.
+        Frame index is the position in frame_ts
+    event_ts (np.ndarray): int64 ns timestamp of every arduino event
+    event_code (np.ndarray): int8 event code, see ardEventCodes
+    event_trial (np.ndarray): int16 trial number, -1 if the event is not part of a trial
+    labels (tuple): label of every event code, see ardEventLabels
+    tz: timezone of the logged timestamps, used to convert them back to datetimes
+    """
+
+    __slots__ = ('animal_id', 'frame_ts', 'event_ts', 'event_code', 'event_trial', 'labels', 'tz')
+
+    def __init__(
+        self,
+        animal_id: str,
+        frame_ts: np.ndarray,
+        event_ts: np.ndarray,
+        event_code: np.ndarray,
+        event_trial: np.ndarray,
+        tz=None
+    ):
+
+        self.animal_id = animal_id
+        self.frame_ts = frame_ts
+        self.event_ts = np.ascontiguousarray(event_ts, dtype=np.int64)
+        self.event_code = np.ascontiguousarray(event_code, dtype=np.int8)
+        self.event_trial = np.ascontiguousarray(event_trial, dtype=np.int16)
+        self.labels = ardEventLabels
+        self.tz = tz
+
+    def __repr__(
+        self
+    ) -> str:
+
+        return ('Session('+self.animal_id+', '+str(len(self.frame_ts))+' frames, '
+                + str(len(self.event_ts))+' events)')
+
+    @property
+    def nbytes(
+        self
+    ) -> int:
+        """ Bytes held by the arrays of the session
+        """
+
+        return self.frame_ts.nbytes + self.event_ts.nbytes + self.event_code.nbytes + self.event_trial.nbytes
+
+    def event_mask(
+        self,
+        label: str
+    ) -> np.ndarray:
+        """ Boolean mask of the events with a label, e.g. 'CS_ON'
+        """
+
+        return self.event_code == self.labels.index(label)
+
+    def to_datetime(
+        self,
+        ts_ns: np.ndarray
+    ) -> pd.DatetimeIndex:
+        """ Convert int64 ns timestamps of the session to datetimes in its timezone
+        """
+
+        return _ns_to_timestamps(ts_ns, self.tz)
+
+@stage('load_csv')
 def load_csv(
-    fp_dict: dict
+    fp_dict: dict,
+    event_dict: dict = None
 ) -> dict:
-    """ Load csv files into dataframes and preprocess timestamps
+    """ Load the bonsai and arduino csvs of every animal as Sessions
 
     Parameters
     ----------
     fp_dict (dict): Dictionary with all filepaths necessary for preprocessing csvs
         KEY = animal_id
         VALUE = list of bonsai, arduino, and video data filpaths
+    event_dict (dict): Optional arduino events already parsed, KEY = animal_id,
+        VALUE = (events, tz), see load_arduino_events. Arduino csvs missing from
+        event_dict are parsed here
 
     Returns
     ----------
-    data_dict (dict): Dictionary with all csv data saved as a dataframe
-        KEY = animal_id
-        VALUE = list of df_bon and df_ard
-            df_bon (pandas.DataFrame): timestamps of each video frame
-            df_ard (pandas.DataFrame): timestamps of each arduino serial output
+    session_dict (dict): KEY = animal_id, VALUE = Session
     """
 
     # instantiate a dictionary
-    data_dict = {}
+    session_dict = {}
+    if event_dict is None:
+        event_dict = {}
 
-    # create and fill data_dict with dataframes from csv
     for key in fp_dict:
-        # create arduino df from csv. Make timestamps datetime objects and set timestamps to index
-        df_ard = pd.read_csv(fp_dict[key][1], names=['ard_output', 'timestamp'], date_parser='timestamp')
-        df_ard.timestamp = pd.to_datetime(df_ard.timestamp)
+        # parse arduino events, unless they were already parsed
+        events, ard_tz = event_dict.get(key) or load_arduino_events(fp_dict[key][1])
 
-        # create bonsai df from csv. Make timestamps datetime objects and set timestamps to index
-        df_bon = pd.read_csv(fp_dict[key][0], names=['timestamp'], date_parser='timestamp')
-        df_bon.timestamp = pd.to_datetime(df_bon.timestamp)
-        df_bon = df_bon.reset_index().set_index('timestamp', drop=True)
+        # bonsai timestamps from the csv (or its parse cache). Frame index is the position
+        frame_ts, tz = load_bonsai_timestamps(fp_dict[key][0])
 
-        data_dict[key] = [df_bon, df_ard]
+        session_dict[key] = Session(key, frame_ts, events['timestamp'], events['event'], events['trial'],
+                                    tz if tz is not None else ard_tz)
 
-    return data_dict
+    return session_dict
 
+@stage('extract_cs_timestamps', message='Merging arduino and bonsai timestamps')
 def extract_cs_timestamps(
-    data_dict: dict
+    session_dict: dict
 ) -> pd.DataFrame:
     """ Extracts and saves the timestamps when a CS occurs
 
     Parameters
     ----------
-    data_dict (dict): Dictionary of dataframes from bonsai and arduino csvs
-        KEY = animal_id
-        VALUE = list of df_bon and df_ard
+    session_dict (dict): KEY = animal_id, VALUE = Session, see load_csv
 
     Returns
     ----------
     df_cs (pandas.DataFrame): Dataframe containing columns:
         animal_id (str)
-        cs_id (str): Trial 1, Trial 2, etc
+        cs_id (str): TRIAL 01, TRIAL 02, etc
         ts_start (DateTime): timestamp when a trial begins
         ts_end (DateTime): timestamp when trial ends
     """
 
-    # print message to user
-    print()
-    print('Merging arduino and bonsai timestamps...')
-
-    # instantiate empty lists. Appending list data is cheaper and requires less memory than appending dataframes
-    animal_id = []
-    cs_id = []
-    ts_start = []
-    ts_end = []
+    # instantiate empty list of per-animal dataframes
+    df_list = []
 
     # for each animal id, extract out id, timestamps, and trial id
-    for key in data_dict:
-        # pull df_ard out of dictionary
-        df_ard = data_dict[key][1]
-
-        # find animal_id
-        animal_id.append(key)
-
-        # find timestamps when CS > ON using regex
-        cond = df_ard['ard_output'].str.contains('(CS > ON)')
-        df_ts_start = df_ard[cond].drop(['ard_output'], axis=1)
-        ts_start.append(df_ts_start['timestamp'].tolist())
-
-        # find cs_id if CS was on. This prevents recording failed trials where no motion was detected
-        extend_index = []
-        index_ts_start = df_ts_start.index.tolist()
-        for index in index_ts_start:
-            above_one = index - 1
-            above_two = index - 2
-            extend_index.extend([above_one, above_two])
-        index_ts_start.extend(extend_index)
-        # create dataframe with trials only when CS occured. Find cs_id using regex
-        df_search = df_ard.loc[index_ts_start].sort_index()
-        cond = df_search['ard_output'].str.contains('(TRIAL NUMBER)')
-        df_cs_id = df_search[cond]
-        df_cs_id['ard_output'] = df_cs_id['ard_output'].map(lambda x: x.lstrip('TRIAL NUMBER ').rstrip(' > START'))
-        df_cs_id['ard_output'] = df_cs_id['ard_output'].map(lambda x: 'TRIAL '+x if (len(x)==2) else 'TRIAL 0'+x)
-        cs_id.append(df_cs_id['ard_output'].tolist())
-
-        # find timestamps when CS > OFF using regex
-        cond = df_ard['ard_output'].str.contains('(CS > OFF)')
-        df_ts_end = df_ard[cond].reset_index().drop(['ard_output'], axis=1)
-        ts_end.append(df_ts_end['timestamp'].tolist())
-
-    # create final dataframe from lists
-    df_cs = pd.DataFrame(zip(animal_id, cs_id, ts_start, ts_end), columns=['animal_id', 'cs_id', 'ts_start', 'ts_end'])
-    df_cs = df_cs.set_index(['animal_id']).apply(pd.Series.explode).reset_index()
+    for key, session in session_dict.items():
+        in_trial = session.event_trial >= 0
+
+        # CS > ON events that belong to a trial start the cs. The first CS > OFF of the same trial ends it
+        on = np.flatnonzero(session.event_mask('CS_ON') & in_trial)
+        off = np.flatnonzero(session.event_mask('CS_OFF') & in_trial)
+        off_trial, first = np.unique(session.event_trial[off], return_index=True)
+        off = off[first]
+
+        # match every cs to its CS > OFF. Unmatched cs end at NaT
+        trial = session.event_trial[on]
+        pos = np.clip(np.searchsorted(off_trial, trial), 0, max(len(off_trial) - 1, 0))
+        matched = off_trial[pos] == trial if len(off_trial) else np.zeros(len(on), dtype=bool)
+        ts_end = np.full(len(on), np.iinfo(np.int64).min, dtype=np.int64)
+        ts_end[matched] = session.event_ts[off[pos[matched]]]
+
+        df_list.append(pd.DataFrame({
+            'animal_id': key,
+            'cs_id': ['TRIAL '+str(number).zfill(2) for number in trial],
+            'ts_start': session.to_datetime(session.event_ts[on]),
+            'ts_end': session.to_datetime(ts_end)
+        }))
+
+    # no animals, e.g. every animal was left out by check_datafile_complete
+    if not df_list:
+        return pd.DataFrame(columns=['animal_id', 'cs_id', 'ts_start', 'ts_end'])
+
+    # create final dataframe from list
+    df_cs = pd.concat(df_list, ignore_index=True)
 
     return df_cs
 
+@stage('extract_acclimation_timestamps')
 def extract_acclimation_timestamps(
-    data_dict: dict,
+    session_dict: dict,
     df_cs: pd.DataFrame
 ) -> pd.DataFrame:
     """ Extracts and saves the timestamps during acclimation period. Adds to existing master dataframe (dfMaster)
 
     Parameters
     ----------
-    data_dict (dict): Dictionary of dataframes from bonsai and arduino csvs
-        KEY = animal_id
-        VALUE = list of df_bon and df_ard
+    session_dict (dict): KEY = animal_id, VALUE = Session, see load_csv
     df_cs (pandas.Dataframe): Dataframe containing columns:
         animal_id (str)
-        cs_id (str): Trial 1, Trial 2, etc
+        cs_id (str): TRIAL 01, TRIAL 02, etc
         ts_start (DateTime): timestamp when a trial begins
         ts_end (DateTime): timestamp when trial ends
 
@@ -303,265 +939,820 @@ def extract_acclimation_timestamps(
 
     # instantiate empty lists. Appending list data is cheaper and requires less memory than appending dataframes
     animal_id = []
-    cs_id = []
     ts_start = []
     ts_end = []
 
-    # for each animal id, extract out id, timestamps, and trial id
-    for key in data_dict:
-        # pull df_ard out of dictionary
-        df_ard = data_dict[key][1]
+    # for each animal id, extract out id and timestamps
+    for key, session in session_dict.items():
+        # acclimation begins at the ACCLIMATION output and ends when trial 1 starts
+        acclimation = session.event_ts[session.event_mask('ACCLIMATION')]
+        trial_one = session.event_ts[session.event_mask('TRIAL_START') & (session.event_trial == 1)]
+        nat = np.iinfo(np.int64).min
+        start, end = session.to_datetime(np.array([acclimation[0] if len(acclimation) else nat,
+                                                   trial_one[0] if len(trial_one) else nat]))
 
-        # find animal_id
         animal_id.append(key)
-
-        # give cs_id
-        cs_id.append('ACCLIMATION')
-
-        # find timestamps when acclimation begins using regex
-        cond = df_ard['ard_output'].str.contains('(ACCLIMATION)')
-        df_ts_start = df_ard[cond].drop(['ard_output'], axis=1)
-        ts_start.append(df_ts_start['timestamp'].tolist())
-
-        # find timestamps when acclimation ends using regex
-        cond = df_ard['ard_output'].str.contains('(TRIAL NUMBER 1 > START)')
-        df_ts_end = df_ard[cond].reset_index().drop(['ard_output'], axis=1)
-        ts_end.append(df_ts_end['timestamp'].tolist())
+        ts_start.append(start)
+        ts_end.append(end)
 
     # create dataframe for acclimation periods and place into a holder
-    df_holder = pd.DataFrame(zip(animal_id, cs_id, ts_start, ts_end), columns=['animal_id', 'cs_id', 'ts_start', 'ts_end'])
-    df_holder = df_holder.set_index(['animal_id']).apply(pd.Series.explode).reset_index()
+    df_holder = pd.DataFrame({
+        'animal_id': animal_id,
+        'cs_id': 'ACCLIMATION',
+        'ts_start': ts_start,
+        'ts_end': ts_end
+    })
 
     # join master dataframe with acclimation periods dataframe
     df_cs = pd.concat([df_holder, df_cs], ignore_index=True)
 
-    # print message to user
-    print('Merging timestamps done.')
-
     return df_cs
 
-def get_frame_timestamps (
-    data_dict: dict,
+def _nearest_frames(
+    frame_ns: np.ndarray,
+    query_ns: np.ndarray
+) -> np.ndarray:
+    """ Find the position of the nearest frame timestamp for every query timestamp
+
+    Parameters
+    ----------
+    frame_ns (np.ndarray): sorted int64 frame timestamps
+    query_ns (np.ndarray): int64 timestamps to match against frame_ns
+
+    Returns
+    ----------
+    pos (np.ndarray): positions in frame_ns. Ties go to the later frame, same as
+        pandas' Index.get_loc(..., method='nearest')
+    """
+
+    # binary search every query at once, then compare the neighbours on both sides
+    pos = np.searchsorted(frame_ns, query_ns, side='left')
+    right = np.clip(pos, 0, len(frame_ns) - 1)
+    left = np.clip(pos - 1, 0, len(frame_ns) - 1)
+    use_left = np.abs(query_ns - frame_ns[left]) < np.abs(frame_ns[right] - query_ns)
+
+    return np.where(use_left, left, right)
+
+@stage('align_cs_frames', message='Aligning cs timestamps to video frames')
+def align_cs_frames(
+    session_dict: dict,
     df_cs: pd.DataFrame
 ) -> pd.DataFrame:
-    """ Extract frame index from df_bon using ts_start and ts_end. Add to df_cs
+    """ Match ts_start and ts_end to the nearest video frame. Add frame timestamps,
+    frame indices and alignment error to df_cs
 
     Parameters
     ----------
-    data_dict (dict): Dictionary of dataframes from bonsai and arduino csvs
-        KEY = animal_id
-        VALUE = list of df_bon and df_ard
+    session_dict (dict): KEY = animal_id, VALUE = Session, see load_csv
     df_cs (pandas.Dataframe): Dataframe containing columns:
         animal_id (str)
-        cs_id (str): Trial 1, Trial 2, etc
+        cs_id (str): TRIAL 01, TRIAL 02, etc
         ts_start (DateTime): timestamp when a trial begins
         ts_end (DateTime): timestamp when trial ends
 
     Returns
     ----------
     df_cs (pandas.DataFrame): Dataframe containing new columns:
-        frame_start (): frame index for ts_start
-        frame_end (): frame index for ts_end
+        vid_start (DateTime): timestamp of the video frame nearest to ts_start
+        vid_end (DateTime): timestamp of the video frame nearest to ts_end
+        idx_start (int): frame index for ts_start
+        idx_end (int): frame index for ts_end
+        err_start_ms (float): vid_start - ts_start in milliseconds
+        err_end_ms (float): vid_end - ts_end in milliseconds
     """
 
+    df_cs = df_cs.reset_index(drop=True)
+    n_rows = len(df_cs)
+
+    # instantiate holders for every row. Filled once per animal with a single batched lookup
+    vid_start = []
+    vid_end = []
+    idx_start = np.full(n_rows, -1, dtype=np.int64)
+    idx_end = np.full(n_rows, -1, dtype=np.int64)
+    err_start = np.full(n_rows, np.nan)
+    err_end = np.full(n_rows, np.nan)
+
+    for key, rows in df_cs.groupby('animal_id').indices.items():
+        if key not in session_dict:
+            continue
+
+        # frame index is the position in the bonsai csv
+        session = session_dict[key]
+        frame_ns = session.frame_ts
+
+        # sort the bonsai timestamps once. They are almost always already in order
+        order = None
+        if np.any(frame_ns[1:] < frame_ns[:-1]):
+            order = np.argsort(frame_ns, kind='stable')
+            frame_ns = frame_ns[order]
+
+        # drop rows without a timestamp (e.g. animals with no trials)
+        ts_start = pd.DatetimeIndex(df_cs['ts_start'].values[rows])
+        ts_end = pd.DatetimeIndex(df_cs['ts_end'].values[rows])
+        valid = ~(ts_start.isna() | ts_end.isna())
+        rows = rows[valid]
+        n = len(rows)
+        if n == 0:
+            continue
+
+        # resolve the start and end of every trial in one pass
+        query_ns = np.concatenate([_timestamps_to_ns(ts_start[valid]),
+                                   _timestamps_to_ns(ts_end[valid])])
+        pos = _nearest_frames(frame_ns, query_ns)
+        err_ms = (frame_ns[pos] - query_ns) / 1e6
+        frame_idx = pos if order is None else order[pos]
+
+        frame_ts = session.to_datetime(session.frame_ts[frame_idx])
+        vid_start.append(pd.Series(frame_ts[:n], index=rows))
+        vid_end.append(pd.Series(frame_ts[n:], index=rows))
+        idx_start[rows] = frame_idx[:n]
+        idx_end[rows] = frame_idx[n:]
+        err_start[rows] = err_ms[:n]
+        err_end[rows] = err_ms[n:]
+        count('frames_aligned', 2 * n, animal_id=key)
+
+    df_cs['vid_start'] = pd.concat(vid_start).reindex(df_cs.index) if vid_start else pd.NaT
+    df_cs['vid_end'] = pd.concat(vid_end).reindex(df_cs.index) if vid_end else pd.NaT
+    df_cs['idx_start'] = idx_start
+    df_cs['idx_end'] = idx_end
+    df_cs['err_start_ms'] = err_start
+    df_cs['err_end_ms'] = err_end
+
     # print message to user
-    print()
-    print('Extracting video frame timestamps...')
+    print('Max alignment error:',
+          np.nanmax(np.abs(np.concatenate([err_start, err_end])), initial=0), 'ms')
+
+    return df_cs
 
-    # create empty holder column to fill vid_start indices
-    df_cs['holder'] = np.nan
 
-    # for each animal, extract out the vid_start index
-    for key in data_dict:
-        # pull df_bon out of dictionary
-        df_bon = data_dict[key][0]
+def _frame_stats(
+    frame_ns: np.ndarray,
+    gap_factor: float = 1.5
+) -> dict:
+    """ Frame rate and frame timing statistics of one video, from int64 ns timestamps
 
-        # iterate through the master dataframe to access ts_start and match to df_bon timestamps
-        for i, row in enumerate(df_cs.itertuples(), 0):
-            if key == row.animal_id:
-                idx = df_bon.index.get_loc(row.ts_start, method='nearest')
-                df_cs.loc[i, row.holder] = df_bon.index[idx]
+    Parameters
+    ----------
+    frame_ns (np.ndarray): int64 timestamp of every frame, in logged order
+    gap_factor (float): intervals longer than gap_factor * the median interval are gaps
+
+    Returns
+    ----------
+    stats (dict): see calculate_frame_rate
+    """
 
-    # BUG: When trying to fill holder column, indices seem to only fill column next. This is a cheap workaround... :(
-    df_cs = df_cs.drop(['holder'], axis=1)
-    df_cs = df_cs.set_axis([*df_cs.columns[:-1], 'vid_start'], axis=1, inplace=False)
+    n_frames = len(frame_ns)
+
+    # frames per whole second. Drop first and last seconds: they are incomplete and unreliable
+    seconds = frame_ns // 1000000000
+    edges = np.flatnonzero(np.concatenate([[True], seconds[1:] != seconds[:-1], [True]]))
+    per_second = np.diff(edges)[1:-1]
+    mean = round(per_second.mean(), 2) if len(per_second) else np.nan
+    std = round(per_second.std(ddof=1), 2) if len(per_second) > 1 else np.nan
+
+    # inter-frame intervals in ms
+    interval = np.diff(frame_ns) / 1e6
+    if len(interval) == 0:
+        interval = np.array([np.nan])
+    median = np.median(interval)
+    p50, p95, p99 = np.percentile(np.abs(interval - median), [50, 95, 99])
+
+    # gaps and the number of frames missing in each of them
+    gap = np.flatnonzero(interval > gap_factor * median)
+    dropped = np.rint(interval[gap] / median).astype(np.int64) - 1
+
+    return {
+        'mean_framerate': mean,
+        'std_framerate': std,
+        'n_frames': n_frames,
+        'median_interval_ms': round(median, 3),
+        'jitter_p50_ms': round(p50, 3),
+        'jitter_p95_ms': round(p95, 3),
+        'jitter_p99_ms': round(p99, 3),
+        'dropped_frames': int(dropped.sum()),
+        'n_gaps': len(gap),
+        'max_gap_ms': round(interval[gap].max(), 3) if len(gap) else 0.0,
+        'gap_frames': ' '.join(map(str, gap + 1))
+    }
+
+@stage('calculate_frame_rate', message='Calculating frame rates')
+def calculate_frame_rate(
+    session_dict: dict
+) -> pd.DataFrame:
+    """Calculate frame rate and frame timing quality based on timestamp information
 
-    # repeated code to find vid_end
-    df_cs['holder'] = np.nan
-    for key in data_dict:
-        # pull df_bon out of dictionary
-        df_bon = data_dict[key][0]
+    Parameters
+    ----------
+    session_dict (dict): KEY = animal_id, VALUE = Session, see load_csv
 
-        for i, row in enumerate(df_cs.itertuples(), 0):
-            if key == row.animal_id:
-                idx = df_bon.index.get_loc(row.ts_end, method='nearest')
-                df_cs.loc[i, row.holder] = df_bon.index[idx]
+    Returns
+    ----------
+    df_framerate (pd.DataFrame): Contains information on
+        animal_id (str)
+        mean_framerate (float): mean frames per second, rounded to two decimals
+        std_framerate (float): standard deviation of frames per second, rounded to two decimals
+        n_frames (int): number of frames logged by bonsai
+        median_interval_ms (float): median time between frames
+        jitter_p50_ms, jitter_p95_ms, jitter_p99_ms (float): percentiles of the deviation
+            of frame intervals from the median interval
+        dropped_frames (int): frames missing from gaps, estimated from the median interval
+        n_gaps (int): intervals longer than 1.5 times the median interval
+        max_gap_ms (float): longest gap
+        gap_frames (str): index of the first frame after every gap, separated by spaces
+    """
 
-    df_cs = df_cs.drop(['holder'], axis=1)
-    df_cs = df_cs.set_axis([*df_cs.columns[:-1], 'vid_end'], axis=1, inplace=False)
+    # instantiate empty lists. Appending list data is cheaper and requires less memory than appending dataframes
+    frame_rate = []
 
-    # print message to user
-    print('Extracting timestamps done. ')
+    # for every animal id, work from the timestamps already loaded in memory
+    for key, session in session_dict.items():
+        frame_rate.append({'animal_id': key, **_frame_stats(session.frame_ts)})
+        count('frames', len(session.frame_ts), animal_id=key)
 
-    return df_cs
+    # create dataframe from frame_rate
+    df_framerate = pd.DataFrame(frame_rate)
+    return df_framerate
 
-def get_frame_idx(
-    data_dict: dict,
-    df_cs: pd.DataFrame
+@stage('check_video_frames')
+def check_video_frames(
+    df_framerate: pd.DataFrame,
+    fp_dict: dict
 ) -> pd.DataFrame:
+    """ Compare the frames logged by bonsai with the frames in each video. Video
+    metadata comes from the video index (see video_index.load_video_index), so each
+    video is only probed once across runs
+
+    Parameters
+    ----------
+    df_framerate (pd.DataFrame): Info on video frame rate, see calculate_frame_rate
+    fp_dict (dict): Dictionary with all filepaths necessary for preprocessing csvs
+        KEY = animal_id
+        VALUE = list of bonsai, arduino, and video data filepaths
+
+    Returns
+    ----------
+    df_framerate (pd.DataFrame): Dataframe containing new columns:
+        video_frames (int): frames in the video container, -1 if the video cannot be probed
+        video_fps (float): nominal frame rate of the video
+        frame_mismatch (int): n_frames - video_frames. 0 if the video cannot be probed
     """
+
+    video_frames = []
+    video_fps = []
+    for key in df_framerate['animal_id']:
+        index = load_video_index(fp_dict[key][2]) if key in fp_dict and len(fp_dict[key]) > 2 else None
+        video_frames.append(index['n_frames'] if index else -1)
+        video_fps.append(index['fps'] if index else np.nan)
+
+    df_framerate = df_framerate.copy()
+    df_framerate['video_frames'] = np.array(video_frames, dtype=np.int64)
+    df_framerate['video_fps'] = np.array(video_fps, dtype=np.float64)
+    df_framerate['frame_mismatch'] = np.where(df_framerate['video_frames'] >= 0,
+                                              df_framerate['n_frames'] - df_framerate['video_frames'], 0)
+
+    for row in df_framerate[df_framerate['frame_mismatch'] != 0].itertuples():
+        print('WARNING >', row.animal_id, 'bonsai logged', row.n_frames, 'frames but the video has',
+              row.video_frames)
+
+    return df_framerate
+
+def fingerprint_file(
+    fp: str,
+    previous: dict = None,
+    sample_bytes: int = 1 << 20
+) -> dict:
+    """ Fingerprint a datafile by size, mtime and a blake2b hash of its content.
+    Files larger than two samples (e.g. videos) hash only the first and last
+    sample_bytes, plus the size
+
+    Parameters
+    ----------
+    fp (str): filepath
+    previous (dict): fingerprint from an earlier run. Reused without hashing if the
+        size and mtime did not change
+    sample_bytes (int): bytes hashed from each end of large files
+
+    Returns
+    ----------
+    fingerprint (dict): size, mtime and hash of the file
     """
-    # print message to user
-    print()
-    print('Extracting video frame indices...')
 
-    # create empty holder column to fill frame_start indices
-    df_cs['holder'] = np.nan
+    stat = os.stat(fp)
+    if previous and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime:
+        return previous
 
-    # for each animal, extract out the frame_start index
-    for key in data_dict:
-        # pull df_bon out of dictionary
-        df_bon = data_dict[key][0]
+    digest = hashlib.blake2b(str(stat.st_size).encode(), digest_size=16)
+    with open(fp, 'rb') as f:
+        if stat.st_size <= 2 * sample_bytes:
+            digest.update(f.read())
+        else:
+            digest.update(f.read(sample_bytes))
+            f.seek(-sample_bytes, os.SEEK_END)
+            digest.update(f.read(sample_bytes))
+    count('bytes_read', min(stat.st_size, 2 * sample_bytes))
 
-        # iterate through the master dataframe to access ts_start and match to df_bon timestamps
-        for i, row in enumerate(df_cs.itertuples(), 0):
-            if key == row.animal_id:
-                idx = df_bon.index.get_loc(row.vid_start)
-                df_cs.loc[i, row.holder] = idx
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': digest.hexdigest()}
 
-    # BUG: When trying to fill holder column, indices seem to only fill column next. This is a cheap workaround... :(
-    df_cs = df_cs.drop(['holder'], axis=1)
-    df_cs = df_cs.set_axis([*df_cs.columns[:-1], 'idx_start'], axis=1, inplace=False)
+def load_manifest(
+    dir_fp: str
+) -> dict:
+    """ Load the manifest of a datafile directory
 
-    # repeated code to find idx_end
-    df_cs['holder'] = np.nan
-    for key in data_dict:
-        df_bon = data_dict[key][0]
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
 
-        for i, row in enumerate(df_cs.itertuples(), 0):
-            if key == row.animal_id:
-                idx = df_bon.index.get_loc(row.vid_end)
-                df_cs.loc[i, row.holder] = idx
+    Returns
+    ----------
+    manifest (dict): Dictionary containing:
+        files (dict): KEY = filepath relative to dir_fp, VALUE = fingerprint, see fingerprint_file
+        animals (dict): KEY = animal_id, VALUE = dict with the relative filepaths and
+            params the animal was last processed with
+        clips (dict): KEY = sliced video relative to dir_fp, VALUE = dict with the source
+            hash and ffmpeg arguments it was written with, and its size
+    """
 
-    df_cs = df_cs.drop(['holder'], axis=1)
-    df_cs = df_cs.set_axis([*df_cs.columns[:-1], 'idx_end'], axis=1, inplace=False)
+    manifest = {'files': {}, 'animals': {}, 'clips': {}}
+    fp = os.path.join(dir_fp, manifestBasename)
+    if os.path.exists(fp):
+        with open(fp) as f:
+            manifest.update(json.load(f))
 
-    # print message to user
-    print('Extracting video frame indices done.')
-    return df_cs
+    return manifest
 
+def save_manifest(
+    dir_fp: str,
+    manifest: dict
+):
+    """ Atomically replace the manifest of a datafile directory
 
-def calculate_frame_rate(
-    fp_dict: dict
-) -> pd.DataFrame:
-    """Calculate frame rate based on timestamp information
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    manifest (dict): see load_manifest
+    """
+
+    fp = os.path.join(dir_fp, manifestBasename)
+    tmp = fp+'.'+str(os.getpid())+'.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, fp)
+
+@stage('select_changed_animals')
+def select_changed_animals(
+    dir_fp: str,
+    fp_dict: dict,
+    manifest: dict,
+    params: dict
+) -> dict:
+    """ Find animals that are new, whose datafiles changed, that were processed with
+    different params, or whose outputs were deleted. Updates manifest['files'] and manifest['animals'] for those animals,
+    so save the manifest only once their outputs are saved
 
     Parameters
     ----------
-    fp_dict (dict): Dictionary containing filepaths for the timestamp csv
+    dir_fp (str): Absolute path to the directory containing datafiles
+    fp_dict (dict): Dictionary with all filepaths necessary for preprocessing csvs
+    manifest (dict): see load_manifest
+    params (dict): JSON-serializable parameters that change the outputs
 
     Returns
     ----------
-    df_framerate (pd.DataFrame): Contains information on
-        animal_id (str)
-        mean_framerate (float): mean rounded to two decimals
-        std_framerate (float): standard deviation rounded to two decimals
+    changed_dict (dict): subset of fp_dict that needs processing
+    """
+
+    # outputs deleted since the last run are regenerated for every animal
+    fmt = params.get('outputFormat', outputFormat)
+    missing = not all(os.path.exists(os.path.join(dir_fp, name+'.'+fmt)) for name in datasetDtypes)
+
+    changed_dict = {}
+    for key, fp_list in fp_dict.items():
+        rel_list = [os.path.relpath(fp, dir_fp) for fp in fp_list if fp]
+
+        # compare fingerprints. Hashes are only recomputed for files whose size or mtime changed
+        changed = False
+        for fp, rel in zip([fp for fp in fp_list if fp], rel_list):
+            previous = manifest['files'].get(rel)
+            fingerprint = fingerprint_file(fp, previous)
+            if previous is None or fingerprint['hash'] != previous['hash']:
+                changed = True
+            manifest['files'][rel] = fingerprint
+
+        record = manifest['animals'].get(key)
+        if missing or changed or record is None or record['files'] != rel_list or record['params'] != params:
+            changed_dict[key] = fp_list
+            manifest['animals'][key] = {'files': rel_list, 'params': params}
+
+    return changed_dict
+
+def preprocessing_params(
+    fmt: str = outputFormat
+) -> dict:
+    """ Parameters recorded in the manifest for every preprocessed animal. Outputs
+    change with the event pattern, the saved columns and the output format (see save_data)
+    """
+
+    return {'ardEventPattern': ardEventPattern,
+            'datasetColumns': {name: list(dtypes) for name, dtypes in datasetDtypes.items()},
+            'outputFormat': fmt}
+
+def preprocess_animal(
+    animal_id: str,
+    fp_list: list,
+    events: tuple = None
+) -> tuple:
+    """ Run the full preprocessing chain for a single animal
+
+    Parameters
+    ----------
+    animal_id (str): animal_id key in fp_dict
+    fp_list (list): bon_csv, ard_csv and vid_fp for the animal
+    events (tuple): Optional arduino events already parsed, (events, tz), see load_arduino_events
+
+    Returns
+    ----------
+    df_cs (pd.DataFrame): Info of animal id, trial id, timestamps, frame indices
+    df_framerate (pd.DataFrame): Info on video frame rate
+    """
+
+    fp_dict = {animal_id: fp_list}
+    event_dict = {} if events is None else {animal_id: events}
+
+    with stage('preprocess_animal', animal_id=animal_id):
+        # load the animal's csvs and extract timestamp data
+        session_dict = load_csv(fp_dict, event_dict)
+        df_cs = extract_cs_timestamps(session_dict)
+        df_cs = extract_acclimation_timestamps(session_dict, df_cs)
+        df_cs = align_cs_frames(session_dict, df_cs)
+
+        # extract metadata on the video
+        df_framerate = calculate_frame_rate(session_dict)
+        df_framerate = check_video_frames(df_framerate, fp_dict)
+
+    return df_cs, df_framerate
+
+def _call_captured(
+    func,
+    *args
+) -> tuple:
+    """ Run func(*args) and return what it printed with its result, so the messages of
+    worker processes are printed together by the parent instead of interleaving
+    """
+
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        result = func(*args)
+    return result, output.getvalue()
+
+@stage('preprocess_animals')
+def preprocess_animals(
+    fp_dict: dict,
+    event_dict: dict = None,
+    max_workers: int = None
+) -> tuple:
+    """ Run preprocess_animal for every animal in fp_dict across a process pool
+
+    Parameters
+    ----------
+    fp_dict (dict): Dictionary with all filepaths necessary for preprocessing csvs
+        KEY = animal_id
+        VALUE = list of bonsai, arduino, and video data filepaths
+    event_dict (dict): Optional arduino events already parsed, KEY = animal_id,
+        VALUE = (events, tz), see load_arduino_events
+    max_workers (int): Number of worker processes. None uses every core, 1 runs serially
+
+    Returns
+    ----------
+    cs_list (list): df_cs of every animal. Merged in save_data
+    framerate_list (list): df_framerate of every animal. Merged in save_data
     """
 
     # print message to user
     print()
-    print('Calculating frame rates...')
+    print('Preprocessing', len(fp_dict), 'animals...')
+
+    if event_dict is None:
+        event_dict = {}
+
+    cs_list = []
+    framerate_list = []
+
+    # run serially in this process. Useful for debugging
+    if max_workers == 1:
+        for key in fp_dict:
+            df_cs, df_framerate = preprocess_animal(key, fp_dict[key], event_dict.get(key))
+            cs_list.append(df_cs)
+            framerate_list.append(df_framerate)
+
+    # each animal's bonsai/arduino/video triple is independent, so every animal is its own job.
+    # Workers send their instrumentation records and printed messages back with the results
+    else:
+        worker_settings = settings()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(call_with_snapshot, worker_settings, _call_captured, preprocess_animal,
+                                       key, fp_dict[key], event_dict.get(key)): key
+                       for key in fp_dict}
+            for i, future in enumerate(as_completed(futures), 1):
+                key = futures[future]
+                try:
+                    ((df_cs, df_framerate), output), snap = future.result()
+                except Exception:
+                    print('Preprocessing failed for', key)
+                    raise
+                merge(snap)
+                print(output, end='')
+                cs_list.append(df_cs)
+                framerate_list.append(df_framerate)
+                print('Preprocessed', key, '('+str(i)+'/'+str(len(futures))+')')
 
-    # instantiate empty lists. Appending list data is cheaper and requires less memory than appending dataframes
-    frame_rate = []
+    # print message to user
+    print('Preprocessing done.')
 
-    # for every animal id, find the frame rate mean and std of their corresponding video
-    for key in fp_dict:
-        # read video timestamp csv and turn into dataframe
-        bon_csv = fp_dict[key][0]
-        df = pd.read_csv(bon_csv, names = ['timestamp'], parse_dates = True)
+    return cs_list, framerate_list
 
-        # transform timestamps into timedelta objects represented in seconds
-        df['timestamp'] = pd.to_datetime(df['timestamp'], utc = False)
-        df['timestamp'] = pd.to_timedelta(df['timestamp'].dt.strftime('%H:%M:%S')).dt.total_seconds().astype(int)
+def _apply_dtypes(
+    df: pd.DataFrame,
+    name: str
+) -> pd.DataFrame:
+    """ Give an output dataframe the dtypes listed in datasetDtypes. animal_id becomes a
+    zero-padded categorical string
+    """
+
+    df['animal_id'] = df['animal_id'].astype(str).str.zfill(6).astype('category')
+    for column, dtype in datasetDtypes[name].items():
+        if column not in df.columns:
+            continue
+        if dtype == 'datetime':
+            # timestamps with mixed utc offsets can only be stored in utc. Saved csvs drop
+            # zero fractional seconds, so the format cannot be inferred from the first row
+            if df[column].dtype == object:
+                try:
+                    df[column] = pd.to_datetime(df[column], format='ISO8601')
+                except (ValueError, TypeError):
+                    pass
+                if df[column].dtype == object:
+                    df[column] = pd.to_datetime(df[column], format='ISO8601', utc=True)
+        elif dtype != 'str':
+            df[column] = df[column].astype(dtype)
+
+    return df
+
+def load_dataset(
+    dir_fp: str,
+    name: str,
+    columns: list = None,
+    animal_ids: list = None,
+    fmt: str = None
+) -> pd.DataFrame:
+    """ Load cs_timestamps or frame_rate saved by save_data, with typed columns
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    name (str): 'cs_timestamps' or 'frame_rate'
+    columns (list): Optional columns to read. animal_id is always read
+    animal_ids (list): Optional animal_ids to read. Parquet datasets only read the
+        partitions of these animals
+    fmt (str): 'csv' or 'parquet'. By default the parquet dataset is read if there is
+        one, otherwise the csv
+
+    Returns
+    ----------
+    df (pd.DataFrame): animal_id as a zero-padded categorical string, timestamps as
+        datetimes and frame indices as integers
+    """
 
-        # create a timedelta with the first timestamp
-        df["net_timestamp"] = df["timestamp"] - df["timestamp"][0]
+    assert name in datasetDtypes, "name must be one of " + ', '.join(datasetDtypes)
+    if columns is not None:
+        columns = ['animal_id'] + [column for column in columns if column != 'animal_id']
+
+    dataset = os.path.join(dir_fp, name+'.parquet')
+    if fmt is None:
+        fmt = 'parquet' if os.path.isdir(dataset) else 'csv'
+
+    if fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+
+        # animal_id partitions are read as strings so the leading zeros are kept
+        partitioning = ds.partitioning(pa.schema([('animal_id', pa.string())]), flavor='hive')
+        filters = None if animal_ids is None else [('animal_id', 'in', [str(x) for x in animal_ids])]
+        df = pq.read_table(dataset, columns=columns, filters=filters,
+                           partitioning=partitioning).to_pandas()
+
+        # partition columns are read last. Use the csv layout, so both formats have the same column order
+        layout = ['animal_id'] + list(datasetDtypes[name])
+        df = df[[column for column in layout if column in df.columns]
+                + [column for column in df.columns if column not in layout]]
+    else:
+        df = pd.read_csv(os.path.join(dir_fp, name+'.csv'), usecols=columns,
+                         dtype={'animal_id': str})
+        df = df.drop(columns=[column for column in df.columns if column.startswith('Unnamed')])
+        df['animal_id'] = df['animal_id'].str.zfill(6)
+        if animal_ids is not None:
+            df = df[df['animal_id'].isin([str(x) for x in animal_ids])].reset_index(drop=True)
+
+    return _apply_dtypes(df, name)
+
+def _concat_frames(
+    frames: list
+) -> pd.DataFrame:
+    """ Concatenate output dataframes, leaving out empty frames and all-NA columns so they
+    do not decide the merged dtypes (deprecated in pandas). See _apply_dtypes
+    """
 
-        # create a column of ones for each frame. Used to count total number of frames in each second
-        df["frames_count"] = np.ones(len(df))
+    columns = list(dict.fromkeys(column for df in frames for column in df.columns))
+    frames = [df.dropna(axis=1, how='all') for df in frames if len(df)]
+    if not frames:
+        return pd.DataFrame(columns=columns)
 
-        # group timestamps together (== one second) and sum all frames in each grouped second
-        df_1 = df.groupby("timestamp").sum().reset_index()
+    return pd.concat(frames, ignore_index=True).reindex(columns=columns)
 
-        # remove first and last elements. these are incomplete "seconds" and contain unreliable framerate measurements
-        df_1.drop(index=[df_1.index.max(), df_1.index.min()], inplace=True)
+def _save_dataset(
+    dataset: str,
+    df: pd.DataFrame,
+    keep_animals: list = None
+):
+    """ Save df as a parquet dataset partitioned by animal_id. Partitions of animals in
+    df are replaced. Other partitions are kept only if their animal is in keep_animals
+    """
 
-        # calculate average frame rate and std
-        mean = round(df_1['frames_count'].mean(), 2)
-        std = round(df_1['frames_count'].std(), 2)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
 
-        # create a list for each animal_id and calculated mean + std
-        frame_rate.append([key, mean, std])
+    if keep_animals is None and os.path.isdir(dataset):
+        shutil.rmtree(dataset)
 
-    # print message to user
-    print('Calculating frame rates done. ')
+    df = df.copy()
+    df['animal_id'] = df['animal_id'].astype(str)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_to_dataset(table, dataset, partition_cols=['animal_id'],
+                        existing_data_behavior='delete_matching')
 
-    # create dataframe from frame_rate (nested list)
-    df_framerate = pd.DataFrame(frame_rate, columns=['animal_id', 'mean_framerate', 'std_framerate'])
-    return df_framerate
+    # drop partitions of animals that no longer exist
+    if keep_animals is not None:
+        keep = set(keep_animals) | set(df['animal_id'])
+        for basename in os.listdir(dataset):
+            if basename.startswith('animal_id=') and basename[len('animal_id='):] not in keep:
+                shutil.rmtree(os.path.join(dataset, basename))
 
+@stage('save_data', message='Saving data to original filepath')
 def save_data(
     dir_fp: str,
-    df_cs: pd.DataFrame,
-    df_framerate: pd.DataFrame
+    df_cs,
+    df_framerate,
+    keep_animals: list = None,
+    fmt: str = outputFormat,
+    db_path: str = dbFp
 ):
-    """Save a csv file with df_cs and df_framerate
+    """Save df_cs and df_framerate as csv files or parquet datasets
 
     Parameters
     ----------
     dir_fp (str): Absolute path to the directory containing datafiles
-    df_cs (pd.DataFrame): Info of animal id, trial id, timestamps, frame indices
-    df_framerate (pd.DataFrame): Info on video frame rate
+    df_cs (pd.DataFrame or list): Info of animal id, trial id, timestamps, frame indices.
+        A list of per-animal dataframes (see preprocess_animals) is merged here
+    df_framerate (pd.DataFrame or list): Info on video frame rate. Same as above
+    keep_animals (list): If given, rows of existing outputs for these animal_ids are kept,
+        unless df_cs/df_framerate replace them. Used for incremental runs
+    fmt (str): 'csv' or 'parquet'. Parquet datasets are partitioned by animal_id, so
+        incremental runs only rewrite the partitions of reprocessed animals
+    db_path (str): Optional SQLite trial index receiving the rows of df_cs and
+        df_framerate, see trial_index.upsert_outputs
     """
 
-    # print message to user
-    print()
-    print('Saving data to original filepath...')
+    # merge per-animal results
+    if isinstance(df_cs, list):
+        df_cs = _concat_frames(df_cs)
+    if isinstance(df_framerate, list):
+        df_framerate = _concat_frames(df_framerate)
+
+    assert fmt in ('csv', 'parquet'), "fmt must be 'csv' or 'parquet'"
+
+    # give every column its saved dtype
+    df_cs = _apply_dtypes(df_cs, 'cs_timestamps')
+    df_framerate = _apply_dtypes(df_framerate, 'frame_rate')
+
+    # index the new rows. Rows of animals that were not reprocessed are already indexed
+    if db_path is not None:
+        if __package__:
+            from .trial_index import upsert_outputs
+        else:
+            from trial_index import upsert_outputs
+        upsert_outputs(db_path, dir_fp, df_cs, df_framerate)
+        print('Trial index updated at:', db_path)
+
+    if fmt == 'parquet':
+        cs = os.path.join(dir_fp, 'cs_timestamps.parquet')
+        _save_dataset(cs, df_cs, keep_animals)
+        count('rows_written', len(df_cs))
+        print('CS timestamps and frames info saved at: ', cs)
+
+        framerate = os.path.join(dir_fp, 'frame_rate.parquet')
+        _save_dataset(framerate, df_framerate, keep_animals)
+        count('rows_written', len(df_framerate))
+        print('Frame rate info saved at:', framerate)
+        return
+
+    cs = os.path.join(dir_fp, 'cs_timestamps.csv')
+    framerate = os.path.join(dir_fp, 'frame_rate.csv')
+
+    # merge with rows of animals that were not reprocessed
+    if keep_animals is not None:
+        keep = set(keep_animals)
+        if os.path.exists(cs):
+            df_old = load_dataset(dir_fp, 'cs_timestamps', fmt='csv')
+            df_old = df_old[df_old['animal_id'].isin(keep - set(df_cs['animal_id']))]
+            df_cs = _concat_frames([df_old.astype({'animal_id': str}), df_cs.astype({'animal_id': str})])
+        if os.path.exists(framerate):
+            df_old = load_dataset(dir_fp, 'frame_rate', fmt='csv')
+            df_old = df_old[df_old['animal_id'].isin(keep - set(df_framerate['animal_id']))]
+            df_framerate = _concat_frames([df_old.astype({'animal_id': str}),
+                                           df_framerate.astype({'animal_id': str})])
 
     # sort master dataframe by animal_id and cs_id
     df_cs['animal_id'] = df_cs['animal_id'].astype(int)
     df_cs = df_cs.sort_values(['animal_id', 'cs_id']).reset_index(drop=True)
 
     # save master dataframe as a csv
-    cs = os.path.join(dir_fp, 'cs_timestamps.csv')
     df_cs.to_csv(cs)
+    count('rows_written', len(df_cs))
+    count('bytes_written', os.path.getsize(cs))
     print('CS timestamps and frames info saved at: ', cs)
 
     # sort framerate dataframe by animal_id
     df_framerate = df_framerate.sort_values('animal_id').reset_index(drop=True)
 
     # save framerate dataframe as a csv
-    framerate = os.path.join(dir_fp, 'frame_rate.csv')
     df_framerate.to_csv(framerate)
+    count('rows_written', len(df_framerate))
+    count('bytes_written', os.path.getsize(framerate))
     print('Frame rate info saved at:', framerate)
 
 
+def preprocess_session(
+    dir_fp: str,
+    fp_dict: dict,
+    max_workers: int = maxWorkers,
+    incremental: bool = incremental,
+    policy: str = completenessPolicy,
+    fmt: str = outputFormat,
+    db_path: str = dbFp
+):
+    """ Preprocess the animals of one session directory and save its outputs
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    fp_dict (dict): Dictionary with all filepaths necessary for preprocessing csvs
+    max_workers (int): Number of worker processes. See preprocess_animals
+    incremental (bool): Only preprocess new or changed animals. See select_changed_animals
+    policy (str): What to do with incomplete animals. See check_datafile_complete
+    fmt (str): 'csv' or 'parquet'. See save_data
+    db_path (str): Optional SQLite trial index. See save_data
+    """
+
+    # Only keep new or changed animals
+    manifest = load_manifest(dir_fp)
+    changed_dict = fp_dict
+    if incremental:
+        changed_dict = select_changed_animals(dir_fp, fp_dict, manifest, preprocessing_params(fmt))
+        print(len(changed_dict), 'of', len(fp_dict), 'animals are new or changed.')
+
+    if changed_dict:
+        df_validation = validate_datafiles(changed_dict)
+        valid_dict = check_datafile_complete(changed_dict, policy, df_validation=df_validation)
+        df_validation.to_csv(os.path.join(dir_fp, 'validation_report.csv'))
+
+        # animals that failed validation are retried on the next run
+        for key in set(changed_dict) - set(valid_dict):
+            manifest['animals'].pop(key, None)
+
+        if valid_dict:
+            # Transform and extract timestamp data, and extract metadata on videos, one animal per worker
+            cs_list, framerate_list = preprocess_animals(valid_dict, max_workers=max_workers)
+
+            # Merge and save data
+            save_data(dir_fp, cs_list, framerate_list, list(fp_dict) if incremental else None, fmt, db_path)
+        save_manifest(dir_fp, manifest)
+
+
 if __name__ == '__main__':
-    # Grab raw data
-    pathList = get_datafiles(dirFp, basenameExtensions)
-    filepathDict = create_path_dict(pathList)
-    check_datafile_complete(filepathDict)
-    dataDict = load_csv(filepathDict)
-
-    # Transform and extract timestamp data
-    dfMaster = extract_cs_timestamps(dataDict)
-    dfMaster = extract_acclimation_timestamps(dataDict, dfMaster)
-    dfMaster = get_frame_timestamps(dataDict, dfMaster)
-    dfMaster = get_frame_idx(dataDict, dfMaster)
-
-    # Extract metadeta on videos
-    dfFrameRate = calculate_frame_rate(filepathDict)
-
-    # Save data
-    save_data(dirFp, dfMaster, dfFrameRate)
+    if instrument:
+        enable(profileStage, dirFp)
+
+    if recursive:
+        # Grab raw data of every session in the tree
+        sessionDict, incompleteDict = discover_sessions(dirFp, basenameExtensions)
+        for sessionFp, filepathDict in group_sessions(sessionDict).items():
+            print()
+            print('Session', sessionFp)
+            preprocess_session(sessionFp, filepathDict)
+    else:
+        # Grab raw data
+        pathList = get_datafiles(dirFp, basenameExtensions)
+        filepathDict = create_path_dict(pathList)
+        preprocess_session(dirFp, filepathDict)
+
+    if instrument:
+        save_report(os.path.join(dirFp, 'run_report.json'))
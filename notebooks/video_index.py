@@ -0,0 +1,307 @@
+################################################################################
+# Filename: video_index.py
+# Description: Probes every video once for its frame count, nominal fps, duration,
+#              codec and keyframe table, and keeps the result in a sidecar index
+#              next to the video
+# Outputs: <video>.index.json
+# Author: Audrey Yin, ay2376@nyu.edu
+# Created On: 2022-07-18 14:25
+# Last Modified Date:
+# Last Modified By:
+################################################################################
+
+# import modules
+import numpy as np
+import os
+import json
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# suffix of the sidecar index written next to every video
+indexSuffix = '.index.json'
+
+# codecs where every frame is a keyframe. Their keyframe table is not stored
+intraCodecs = {'mjpeg', 'rawvideo', 'huffyuv', 'ffvhuff', 'ffv1', 'png', 'utvideo'}
+
+# value of a missing pts (AV_NOPTS_VALUE) in ffmpeg's framecrc output
+noPts = -2**63
+
+# number of videos probed at the same time
+maxJobs = 4
+
+def _probe_ffprobe(
+    video_path: str
+) -> dict:
+    """ Probe a video with ffprobe. Every packet of the first video stream is listed
+    with its pts and keyframe flag. See probe_video
+    """
+
+    proc = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                           '-show_entries', 'stream=codec_name,width,height,time_base,r_frame_rate',
+                           '-show_entries', 'packet=pts,dts,duration,flags',
+                           '-of', 'json', video_path],
+                          stdin=subprocess.DEVNULL, capture_output=True, check=True)
+    info = json.loads(proc.stdout)
+    stream = info['streams'][0]
+    tb_num, tb_den = map(int, stream['time_base'].split('/'))
+    packets = info.get('packets', [])
+
+    pts = np.array([int(p['pts'] if p.get('pts') not in (None, 'N/A') else p['dts']) for p in packets],
+                   dtype=np.int64)
+    duration = np.array([int(p.get('duration') or 0) for p in packets], dtype=np.int64)
+    key = np.array(['K' in p.get('flags', '') for p in packets], dtype=bool)
+
+    return _packet_index(stream['codec_name'], int(stream['width']), int(stream['height']),
+                         (tb_num, tb_den), pts, duration, key, 'ffprobe')
+
+def _probe_ffmpeg(
+    video_path: str
+) -> dict:
+    """ Probe a video with ffmpeg alone, for installs without ffprobe. The framecrc
+    muxer lists every packet of the first video stream with its pts, duration and
+    flags. Packets are stream copied, so nothing is decoded. See probe_video
+    """
+
+    proc = subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', video_path,
+                           '-map', '0:v:0', '-c', 'copy', '-f', 'framecrc', '-'],
+                          stdin=subprocess.DEVNULL, capture_output=True, check=True)
+
+    header = {}
+    pts = []
+    duration = []
+    key = []
+    for line in proc.stdout.decode().splitlines():
+        if line.startswith('#'):
+            name, _, value = line[1:].partition(':')
+            header[name.strip()] = value.strip()
+            continue
+        # stream, dts, pts, duration, size, crc[, F=flags]. Missing pts are printed as INT64_MIN
+        fields = [field.strip() for field in line.split(',')]
+        pts.append(int(fields[2]) if int(fields[2]) != noPts else int(fields[1]))
+        duration.append(int(fields[3]))
+        flags = [field for field in fields[6:] if field.startswith('F=')]
+        key.append(not flags or bool(int(flags[0][2:], 16) & 1))
+
+    tb_num, tb_den = map(int, header['tb 0'].split('/'))
+    width, height = map(int, header['dimensions 0'].split('x'))
+
+    return _packet_index(header['codec_id 0'], width, height, (tb_num, tb_den),
+                         np.array(pts, dtype=np.int64), np.array(duration, dtype=np.int64),
+                         np.array(key, dtype=bool), 'ffmpeg')
+
+def _packet_index(
+    codec: str,
+    width: int,
+    height: int,
+    time_base: tuple,
+    pts: np.ndarray,
+    duration: np.ndarray,
+    key: np.ndarray,
+    method: str
+) -> dict:
+    """ Build an index from the packets of a video stream. Frame indices are in
+    presentation order
+    """
+
+    tb = time_base[0] / time_base[1]
+    order = np.argsort(pts, kind='stable')
+    pts = pts[order]
+    key = key[order]
+
+    # nominal fps from the typical frame duration. Packets without a duration fall back to pts steps
+    step = duration[duration > 0] if (duration > 0).any() else np.diff(pts)
+    fps = 1 / (np.median(step) * tb) if len(step) else np.nan
+
+    n_frames = len(pts)
+    intra_only = codec in intraCodecs or bool(key.all())
+    keyframes = [] if intra_only else [[int(i), round(float(pts[i] * tb), 6)] for i in np.flatnonzero(key)]
+
+    return {
+        'method': method,
+        'codec': codec,
+        'width': width,
+        'height': height,
+        'n_frames': n_frames,
+        'fps': round(float(fps), 6),
+        'start_s': round(float(pts[0] * tb), 6) if n_frames else 0.0,
+        'duration_s': round(float(n_frames / fps), 6) if n_frames else 0.0,
+        'intra_only': intra_only,
+        'keyframes': keyframes
+    }
+
+def _probe_cv2(
+    video_path: str
+) -> dict:
+    """ Probe a video with OpenCV, when ffmpeg is not installed. The frame count and
+    fps come from the container header, and keyframes are only known for intra-only
+    codecs. See probe_video
+    """
+
+    import cv2
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError('OpenCV cannot open '+video_path)
+    fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+    codec = fourcc.to_bytes(4, 'little').decode(errors='replace').strip().lower()
+    n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+
+    codec = {'mjpg': 'mjpeg'}.get(codec, codec)
+    return {
+        'method': 'cv2',
+        'codec': codec,
+        'width': width,
+        'height': height,
+        'n_frames': n_frames,
+        'fps': round(fps, 6),
+        'start_s': 0.0,
+        'duration_s': round(n_frames / fps, 6) if fps else 0.0,
+        'intra_only': codec in intraCodecs,
+        'keyframes': []
+    }
+
+def probe_video(
+    video_path: str
+) -> dict:
+    """ Scan a video once for its metadata and keyframe table. Uses ffprobe if it is
+    installed, then ffmpeg, then OpenCV
+
+    Parameters
+    ----------
+    video_path (str): Absolute path to the video
+
+    Returns
+    ----------
+    index (dict): containing:
+        method (str): ffprobe, ffmpeg or cv2
+        codec (str)
+        width (int)
+        height (int)
+        n_frames (int): frames in the container
+        fps (float): nominal frame rate
+        start_s (float): pts of the first frame in seconds
+        duration_s (float)
+        intra_only (bool): every frame is a keyframe
+        keyframes (list): [frame index, pts in seconds] of every keyframe. Empty if
+            intra_only, or if keyframes are unknown (cv2 on inter-frame codecs)
+    """
+
+    for tool, probe in (('ffprobe', _probe_ffprobe), ('ffmpeg', _probe_ffmpeg)):
+        if shutil.which(tool) is None:
+            continue
+        try:
+            return probe(video_path)
+        except (subprocess.CalledProcessError, KeyError, ValueError, IndexError):
+            pass
+
+    return _probe_cv2(video_path)
+
+def load_video_index(
+    video_path: str,
+    probe: bool = True
+) -> dict:
+    """ Load the sidecar index of a video. The video is probed, and the sidecar
+    written, if it is missing or the video changed (size or mtime)
+
+    Parameters
+    ----------
+    video_path (str): Absolute path to the video
+    probe (bool): probe the video if the index is not current. Otherwise return None
+
+    Returns
+    ----------
+    index (dict): see probe_video, plus source_size and source_mtime_ns. None if the
+        video does not exist, cannot be probed, or the index is not current and probe is False
+    """
+
+    if not os.path.exists(video_path):
+        return None
+
+    stat = os.stat(video_path)
+    index_fp = video_path+indexSuffix
+    if os.path.exists(index_fp):
+        with open(index_fp) as f:
+            index = json.load(f)
+        if index['source_size'] == stat.st_size and index['source_mtime_ns'] == stat.st_mtime_ns:
+            return index
+
+    if not probe:
+        return None
+    try:
+        index = probe_video(video_path)
+    except IOError:
+        return None
+    index['source_size'] = stat.st_size
+    index['source_mtime_ns'] = stat.st_mtime_ns
+
+    # write atomically. Skipped if the directory is not writable
+    try:
+        tmp = index_fp+'.'+str(os.getpid())+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, index_fp)
+    except OSError:
+        pass
+
+    return index
+
+def build_video_index(
+    video_paths: list,
+    max_jobs: int = maxJobs
+) -> dict:
+    """ Load or build the index of every video, see load_video_index
+
+    Parameters
+    ----------
+    video_paths (list): List with all absolute paths for video datafiles
+    max_jobs (int): number of videos probed at the same time
+
+    Returns
+    ----------
+    index_dict (dict): KEY = video path, VALUE = index, or None if the video cannot be probed
+    """
+
+    # probing runs in ffmpeg/ffprobe subprocesses, so threads are enough
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        return dict(zip(video_paths, executor.map(load_video_index, video_paths)))
+
+def frame_pts(
+    index: dict,
+    frame_idx: int
+) -> float:
+    """ Presentation time of a frame in seconds, assuming a constant frame rate
+    """
+
+    return index['start_s'] + frame_idx / index['fps']
+
+def seek_point(
+    index: dict,
+    frame_idx: int
+) -> tuple:
+    """ The keyframe at or before a frame, where a stream copy of that frame must start
+
+    Parameters
+    ----------
+    index (dict): see probe_video
+    frame_idx (int): video frame index
+
+    Returns
+    ----------
+    keyframe_idx (int): frame index of the keyframe. The frame itself for intra-only
+        codecs, or if keyframes are unknown
+    keyframe_s (float): pts of the keyframe in seconds
+    """
+
+    if index['intra_only'] or not index['keyframes']:
+        return frame_idx, round(frame_pts(index, frame_idx), 6)
+
+    keyframes = index['keyframes']
+    pos = np.searchsorted([idx for idx, _ in keyframes], frame_idx, side='right') - 1
+    keyframe_idx, keyframe_s = keyframes[max(pos, 0)]
+
+    return keyframe_idx, keyframe_s
@@ -0,0 +1,317 @@
+################################################################################
+# Filename: watch_folder.py
+# Description: Watches the acquisition directory while sessions are recorded and
+#              preprocesses and slices every animal as soon as its bonsai csv,
+#              arduino csv and video are complete and no longer being written
+# Outputs: cs_timestamps.csv, frame_rate.csv, <id>_videos, manifest.json
+# Author: Audrey Yin, ay2376@nyu.edu
+# Created On: 2022-07-22 09:15
+# Last Modified Date:
+# Last Modified By:
+################################################################################
+
+# import modules
+import regex as re
+import os
+import time
+import queue
+import threading
+
+# relative imports when installed as the video_processing_tools package, flat ones when run from notebooks/
+if __package__:
+    from .ts_preprocessing import (basenameExtensions, _validate_animal, select_changed_animals, preprocessing_params,
+                                   preprocess_animal, save_data, load_manifest, save_manifest)
+    from . import extract_frames
+else:
+    from ts_preprocessing import (basenameExtensions, _validate_animal, select_changed_animals, preprocessing_params,
+                                  preprocess_animal, save_data, load_manifest, save_manifest)
+    import extract_frames
+
+# inotify is only available on linux, with the inotify_simple package. Otherwise the directory is polled
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# specify location of the datafiles
+dirFp = r'/Users/audreyyin/Documents/LeDoux/Sample Data'
+
+# seconds between scans of the directory. With inotify, a scan also runs when a file is written
+pollInterval = 10.0
+
+# datafiles must keep the same size and mtime for stableSeconds before an animal is processed
+stableSeconds = 30.0
+
+# animals waiting to be processed. The scan waits when the queue is full
+queueSize = 8
+
+# animals processed at the same time
+maxWorkers = 1
+
+# slice the videos of every preprocessed animal (see extract_frames.slice_videos)
+sliceVideos = True
+
+def scan_directory(
+    dir_fp: str,
+    basename_extensions: dict = basenameExtensions
+) -> dict:
+    """ List the datafiles of every animal in a directory, with one os.scandir pass
+
+    Returns
+    ----------
+    fp_dict (dict): KEY = animal_id, VALUE = list of bon_csv, ard_csv, vid_fp, with ''
+        for files that are not there yet
+    """
+
+    extension_tuple = (basename_extensions.get('bonsai_ts'), basename_extensions.get('arduino_ts'),
+                       basename_extensions.get('video'))
+
+    fp_dict = {}
+    with os.scandir(dir_fp) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.endswith(extension_tuple):
+                continue
+            animal_id = re.search(r'_(\d{6})_', entry.name)
+            if animal_id is None:
+                continue
+            slot = [entry.name.endswith(extension) for extension in extension_tuple].index(True)
+            fp_dict.setdefault(animal_id.group(1), ['', '', ''])[slot] = entry.path
+
+    return fp_dict
+
+def _signature(
+    fp_list: list
+) -> tuple:
+    """ Size and mtime of every datafile, None if one is missing
+    """
+
+    try:
+        return tuple((stat.st_size, stat.st_mtime_ns) for stat in map(os.stat, fp_list))
+    except (FileNotFoundError, TypeError):
+        return None
+
+def find_ready_animals(
+    fp_dict: dict,
+    seen: dict,
+    stable_s: float = stableSeconds,
+    now: float = None
+) -> list:
+    """ Find animals whose datafiles are complete: all three files exist, none changed
+    for stable_s seconds, and the arduino csv ends with SESSION > END (see
+    ts_preprocessing._validate_animal)
+
+    Parameters
+    ----------
+    fp_dict (dict): see scan_directory
+    seen (dict): KEY = animal_id, VALUE = (signature, time it was first seen). Updated here
+    stable_s (float): seconds the datafiles must stay unchanged
+    now (float): Optional time of the scan
+
+    Returns
+    ----------
+    ready (list): animal_ids ready to be processed
+    """
+
+    now = time.time() if now is None else now
+    ready = []
+    for key, fp_list in fp_dict.items():
+        signature = _signature(fp_list) if all(fp_list) else None
+        if signature is None:
+            seen.pop(key, None)
+            continue
+
+        # restart the clock whenever a datafile changes
+        previous = seen.get(key)
+        if previous is None or previous[0] != signature:
+            seen[key] = (signature, now)
+            if stable_s > 0:
+                continue
+        elif now - previous[1] < stable_s:
+            continue
+
+        if _validate_animal(key, fp_list)['status'] == 'ok':
+            ready.append(key)
+
+    return ready
+
+def process_animal(
+    dir_fp: str,
+    animal_id: str,
+    fp_list: list,
+    lock: threading.Lock,
+    slice_videos: bool = sliceVideos
+):
+    """ Preprocess and slice one animal, and merge its outputs with those of the other
+    animals of the directory. Outputs and the manifest are only written while holding lock
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the directory containing datafiles
+    animal_id (str)
+    fp_list (list): bon_csv, ard_csv and vid_fp
+    lock (threading.Lock): shared by every worker of the watcher
+    slice_videos (bool): slice the video once the animal is preprocessed
+    """
+
+    # fingerprint the datafiles before they are read. If one changes while the animal is
+    # processed, the manifest keeps the old fingerprint and the next scan queues it again
+    with lock:
+        records = load_manifest(dir_fp)
+    select_changed_animals(dir_fp, {animal_id: fp_list}, records, preprocessing_params())
+
+    df_cs, df_framerate = preprocess_animal(animal_id, fp_list)
+    with lock:
+        # rows of every animal with complete datafiles now are kept, including animals
+        # saved by other workers since this one was queued
+        keep_animals = sorted(key for key, fps in scan_directory(dir_fp).items() if all(fps))
+        save_data(dir_fp, [df_cs], [df_framerate], keep_animals)
+
+        manifest = load_manifest(dir_fp)
+        for fp in fp_list:
+            rel = os.path.relpath(fp, dir_fp)
+            manifest['files'][rel] = records['files'][rel]
+        manifest['animals'][animal_id] = records['animals'][animal_id]
+        save_manifest(dir_fp, manifest)
+
+    if not slice_videos:
+        return
+
+    # slice from a copy of the manifest, and record the new clips once they are written
+    manifest = load_manifest(dir_fp)
+    df_cs, df_framerate = extract_frames.load_csv(dir_fp, [animal_id])
+    extract_frames.slice_videos(dir_fp, [fp_list[2]], df_cs, df_framerate, manifest=manifest)
+    with lock:
+        merged = load_manifest(dir_fp)
+        video_rel = os.path.relpath(fp_list[2], dir_fp)
+        merged['files'][video_rel] = manifest['files'][video_rel]
+        clips_rel = animal_id+'_videos'+os.sep
+        merged['clips'].update({rel: record for rel, record in manifest['clips'].items() if rel.startswith(clips_rel)})
+        save_manifest(dir_fp, merged)
+
+def _worker(
+    dir_fp: str,
+    work: queue.Queue,
+    pending: set,
+    failed: dict,
+    lock: threading.Lock,
+    slice_videos: bool
+):
+    """ Process animals from the work queue until it yields None
+    """
+
+    while True:
+        item = work.get()
+        if item is None:
+            return
+        animal_id, fp_list = item
+        start = time.perf_counter()
+        print('Processing', animal_id+'...')
+        try:
+            process_animal(dir_fp, animal_id, fp_list, lock, slice_videos)
+            print('Processed', animal_id, 'in', round(time.perf_counter() - start, 1), 's.')
+        except Exception as error:
+            # retried only once its datafiles change
+            failed[animal_id] = _signature(fp_list)
+            print('WARNING >', animal_id, 'failed:', repr(error))
+        finally:
+            pending.discard(animal_id)
+
+def _wait_for_changes(
+    notifier,
+    timeout: float
+):
+    """ Sleep until a file in the directory is written or moved in, or until timeout
+    """
+
+    if notifier is None:
+        time.sleep(timeout)
+    else:
+        notifier.read(timeout=int(timeout * 1000), read_delay=100)
+
+def watch(
+    dir_fp: str,
+    poll_interval: float = pollInterval,
+    stable_s: float = stableSeconds,
+    max_workers: int = maxWorkers,
+    queue_size: int = queueSize,
+    slice_videos: bool = sliceVideos,
+    once: bool = False
+) -> list:
+    """ Watch a directory and process every animal once its datafiles are complete.
+    Animals already processed with the same datafiles (see manifest.json) are skipped,
+    so restarting the watcher does not reprocess the directory. Stop with Ctrl+C
+
+    Parameters
+    ----------
+    dir_fp (str): Absolute path to the acquisition directory
+    poll_interval (float): seconds between scans
+    stable_s (float): seconds the datafiles must stay unchanged, see find_ready_animals
+    max_workers (int): animals processed at the same time
+    queue_size (int): animals waiting to be processed
+    slice_videos (bool): slice the videos of processed animals
+    once (bool): process the animals that are ready now, then return
+
+    Returns
+    ----------
+    queued (list): animal_ids queued for processing, in order
+    """
+
+    # Make sure path is valid
+    assert os.path.isdir(dir_fp), "The path provided does not point to a directory."
+
+    notifier = None
+    if INotify is not None and not once:
+        notifier = INotify()
+        notifier.add_watch(dir_fp, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.MODIFY)
+    print('Watching', dir_fp, 'with', 'inotify.' if notifier is not None else 'polling.')
+
+    work = queue.Queue(maxsize=queue_size)
+    pending = set()
+    failed = {}
+    seen = {}
+    queued = []
+    lock = threading.Lock()
+    workers = [threading.Thread(target=_worker, args=(dir_fp, work, pending, failed, lock, slice_videos),
+                                daemon=True) for _ in range(max_workers)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        while True:
+            fp_dict = scan_directory(dir_fp)
+            ready = find_ready_animals(fp_dict, seen, 0 if once else stable_s)
+
+            for key in ready:
+                if key in pending or failed.get(key, ()) == _signature(fp_dict[key]):
+                    continue
+                failed.pop(key, None)
+
+                # skip animals whose outputs are current
+                with lock:
+                    manifest = load_manifest(dir_fp)
+                if not select_changed_animals(dir_fp, {key: fp_dict[key]}, manifest, preprocessing_params()):
+                    continue
+
+                pending.add(key)
+                queued.append(key)
+                print('Queued', key+'.', work.qsize(), 'animals waiting.')
+                work.put((key, fp_dict[key]))
+
+            if once:
+                break
+            _wait_for_changes(notifier, poll_interval)
+    except KeyboardInterrupt:
+        print('Stopping. Waiting for', len(pending), 'animals in progress...')
+    finally:
+        for _ in workers:
+            work.put(None)
+        for worker in workers:
+            worker.join()
+        if notifier is not None:
+            notifier.close()
+
+    return queued
+
+
+if __name__ == '__main__':
+    watch(dirFp)